@@ -0,0 +1,127 @@
+"""
+Caller identity asserted by the API gateway.
+
+After verifying a bearer token, the gateway forwards its claims in the
+X-MedX-Principal header ("<base64url JSON>.<base64url HMAC-SHA256>", see
+api-gateway/auth.py). Services check the signature with the shared
+PRINCIPAL_SIGNING_KEY (default: SECRET_KEY) instead of decoding the JWT.
+Services calling each other directly sign their own principal with role
+"service" (service_principal_header).
+
+acting_user() decides whose records a request may touch: callers act for
+themselves, the service role for anyone, staff for users of their own
+organization (looked up in auth-service's users collection).
+
+This file is kept identical in every service that reads the header.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import Header, HTTPException
+
+PRINCIPAL_SIGNING_KEY = os.getenv("PRINCIPAL_SIGNING_KEY") or os.getenv(
+    "SECRET_KEY", "YOUR_SUPER_SECRET_KEY_CHANGE_THIS_IN_PROD"
+)
+# Roles that may act on other users' records
+STAFF_ROLES = ("provider", "doctor", "organization_admin")
+SERVICE_ROLE = "service"
+SERVICE_PRINCIPAL_TTL = 300
+USERS_COLLECTION = "users"  # auth-service, keyed by email (the principal's sub)
+USER_ORG_TTL = 60
+
+_user_orgs: Dict[str, Tuple[Optional[str], float]] = {}
+_user_orgs_lock = threading.Lock()
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def principal_from_header(value: Optional[str], key: str = PRINCIPAL_SIGNING_KEY) -> Optional[dict]:
+    """Claims from a gateway-signed X-MedX-Principal header, or None if absent, forged or expired."""
+    if not value or not key:
+        return None
+    payload, _, signature = value.partition(".")
+    expected = hmac.new(key.encode("utf-8"), payload.encode("ascii", "replace"), hashlib.sha256).digest()
+    try:
+        if not hmac.compare_digest(_b64decode(signature), expected):
+            return None
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or not claims.get("sub"):
+        return None
+    if claims.get("exp") is not None and claims["exp"] <= time.time():
+        return None
+    return claims
+
+
+def sign_principal(claims: dict, key: str = PRINCIPAL_SIGNING_KEY) -> str:
+    payload = _b64encode(json.dumps(claims, separators=(",", ":"), sort_keys=True).encode("utf-8"))
+    signature = hmac.new(key.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest()
+    return f"{payload}.{_b64encode(signature)}"
+
+
+def service_principal_header(service: str) -> dict:
+    """Headers identifying this service on a direct service-to-service call."""
+    claims = {"sub": service, "role": SERVICE_ROLE, "exp": int(time.time()) + SERVICE_PRINCIPAL_TTL}
+    return {"X-MedX-Principal": sign_principal(claims)}
+
+
+async def get_principal(x_medx_principal: Optional[str] = Header(None)) -> Optional[dict]:
+    """FastAPI dependency: the verified caller, or None (no header, or not via the gateway)."""
+    return principal_from_header(x_medx_principal)
+
+
+def require_principal(principal: Optional[dict]) -> dict:
+    if principal is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return principal
+
+
+def user_organization(db, user_id: str) -> Optional[str]:
+    """Organization of a user, cached for USER_ORG_TTL seconds."""
+    now = time.monotonic()
+    with _user_orgs_lock:
+        cached = _user_orgs.get(user_id)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+    user = db.get(USERS_COLLECTION, user_id) if db is not None else None
+    organization_id = user.get("organization_id") if user else None
+    with _user_orgs_lock:
+        if len(_user_orgs) > 10000:
+            _user_orgs.clear()
+        _user_orgs[user_id] = (organization_id, now + USER_ORG_TTL)
+    return organization_id
+
+
+def may_act_for(principal: dict, user_id: Optional[str], db=None) -> bool:
+    """True if the principal may touch `user_id`'s records."""
+    if principal.get("role") == SERVICE_ROLE or user_id == principal["sub"]:
+        return True
+    if principal.get("role") not in STAFF_ROLES or not user_id or not principal.get("organization_id"):
+        return False
+    return user_organization(db, user_id) == principal["organization_id"]
+
+
+def acting_user(principal: Optional[dict], user_id: Optional[str], db=None) -> str:
+    """
+    The user a request acts for: `user_id` if the caller may act for that user (403 otherwise),
+    else the caller. Requests without a principal are rejected (401).
+    """
+    principal = require_principal(principal)
+    if not user_id or user_id == principal["sub"]:
+        return principal["sub"]
+    if not may_act_for(principal, user_id, db):
+        raise HTTPException(status_code=403, detail="Not allowed to act for this user")
+    return user_id
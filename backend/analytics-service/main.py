@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from google.cloud import bigquery
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import os
 import datetime
+import json
+from identity import get_principal, require_principal, acting_user, SERVICE_ROLE
+from storage import store_from_env
+from rollups import AdherenceRollups
 
 # --- App Initialization ---
 app = FastAPI(title="MedX Analytics Service")
@@ -20,13 +24,69 @@ app.add_middleware(
 
 # --- Configuration ---
 # Project and Dataset should ideally come from env vars, hardcoding for MVP based on Terraform output
-PROJECT_ID = "medx-health-platform" 
+PROJECT_ID = "medx-health-platform"
 DATASET_ID = "medx_analytics"
 TABLE_ID = "medication_events"
 
 # --- BigQuery Client ---
-# Using Application Default Credentials (ADC)
-client = bigquery.Client(project=PROJECT_ID)
+# Using Application Default Credentials (ADC). Only needed for backfills now.
+try:
+    client = bigquery.Client(project=PROJECT_ID)
+    print("✅ BigQuery Client Initialized")
+except Exception as e:
+    print(f"❌ BigQuery Init Failed: {e}")
+    client = None
+
+# Document store, for the organization of users staff ask about (auth-service's users collection)
+db = store_from_env()
+
+# --- Adherence Rollups ---
+# Maintained from medication-service events (POST /events), see rollups.py
+rollups = AdherenceRollups(os.getenv("ANALYTICS_DB_PATH", "medx_analytics.db"))
+# Raw events for backfills when BigQuery is not used (medication-service EVENT_SINK=jsonl output)
+BACKFILL_JSONL_PATH = os.getenv("ANALYTICS_BACKFILL_JSONL")
+
+@app.on_event("startup")
+async def startup_event():
+    rollups.prune()
+
+# --- Models ---
+class MedicationEvent(BaseModel):
+    event_id: Optional[str] = None
+    med_id: Optional[str] = None
+    user_id: Optional[str] = None
+    event_type: str
+    status: Optional[str] = None
+    timestamp: str
+    details: Optional[str] = None
+    local_day: Optional[str] = None # Medication's local date (YYYY-MM-DD); older events have none
+
+class BackfillRequest(BaseModel):
+    days: int = 30
+    source: Optional[str] = None # bigquery | jsonl; default: bigquery when available
+
+# --- Helpers ---
+def require_service(principal: Optional[dict]):
+    if principal is None or principal.get("role") != SERVICE_ROLE:
+        raise HTTPException(status_code=403, detail="Internal endpoint")
+
+def bigquery_events(since: datetime.date) -> List[Dict[str, Any]]:
+    query = f"""
+        SELECT event_id, med_id, user_id, event_type, status, timestamp, local_day
+        FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
+        WHERE DATE(timestamp) >= @since
+        ORDER BY timestamp
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("since", "DATE", since)]
+    )
+    return [dict(row) for row in client.query(query, job_config=job_config).result()]
+
+def jsonl_events(path: str, since: datetime.date) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    events = [e for e in events if str(e.get("timestamp", ""))[:10] >= since.isoformat()]
+    return sorted(events, key=lambda e: e["timestamp"])
 
 # --- Routes ---
 
@@ -35,49 +95,58 @@ async def root():
     return {"status": "Analytics Service Running", "project": PROJECT_ID}
 
 @app.get("/weekly-adherence")
-async def get_weekly_adherence():
+def get_weekly_adherence(user_id: Optional[str] = None, principal: Optional[dict] = Depends(get_principal)):
     """
-    Calculates medication adherence for the last 7 days.
-    Returns a list of objects: {"day": "Mon", "value": 85.0}
+    Medication adherence for the last 7 days, from the precomputed rollups.
+    Returns a list of objects: {"day": "Mon", "value": 85.0, "date", "taken", "scheduled"}
+    value = doses taken / doses scheduled (the user's active medications that day).
     """
+    # Patients see their own adherence, staff that of users of their organization. Only internal
+    # callers may leave user_id out for the whole platform.
+    principal = require_principal(principal)
+    if user_id is not None or principal.get("role") != SERVICE_ROLE:
+        user_id = acting_user(principal, user_id, db)
     try:
-        # Query BigQuery to get counts of TAKEN vs TOTAL scheduled
-        # Note: accurate total requires scheduling info. 
-        # For this MVP, we will count 'TAKEN' events and assume a fixed schedule or 
-        # estimate based on missed events if we logged them.
-        # Alternatively, simpler metric: Count 'TAKEN' events per day.
-        
-        query = f"""
-            SELECT
-                FORMAT_DATE('%a', DATE(timestamp)) as day_name,
-                COUNT(*) as taken_count
-            FROM
-                `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            WHERE
-                DATE(timestamp) >= DATE_SUB(CURRENT_DATE(), INTERVAL 6 DAY)
-                AND event_type = 'MEDICATION_TOGGLED'
-                AND status = 'TAKEN'
-            GROUP BY
-                day_name
-            ORDER BY
-                MIN(timestamp)
-        """
-        
-        query_job = client.query(query)
-        results = query_job.result()
-        
-        stats = []
-        for row in results:
-            # Simple heuristic: Assume 3 meds/day = 100%
-            # If count is 3, value is 100. If 1, 33.
-            val = min((row.taken_count / 3) * 100, 100)
-            stats.append({
-                "day": row.day_name,
-                "value": round(val, 1)
-            })
-            
-        return stats
+        return rollups.weekly(user_id)
+    except Exception as e:
+        print(f"Rollup Read Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/events")
+def ingest_events(events: List[MedicationEvent], principal: Optional[dict] = Depends(get_principal)):
+    """Batches of medication events pushed by medication-service (service principal only)."""
+    require_service(principal)
+    try:
+        applied = rollups.apply(e.dict() for e in events)
+    except Exception as e:
+        print(f"Rollup Write Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"received": len(events), "applied": applied}
 
+@app.post("/rollups/backfill")
+def backfill_rollups(req: BackfillRequest, principal: Optional[dict] = Depends(get_principal)):
+    """Rebuilds the last `days` days of rollups from raw events (BigQuery or a JSONL event log)."""
+    if principal is None or principal.get("role") not in ("organization_admin", SERVICE_ROLE):
+        raise HTTPException(status_code=403, detail="Not allowed")
+    source = req.source or ("bigquery" if client else "jsonl")
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=req.days - 1)
+    try:
+        if source == "bigquery":
+            if not client:
+                raise HTTPException(status_code=503, detail="BigQuery unavailable")
+            events = bigquery_events(since)
+        elif source == "jsonl" and BACKFILL_JSONL_PATH:
+            events = jsonl_events(BACKFILL_JSONL_PATH, since)
+        else:
+            raise HTTPException(status_code=400, detail="No backfill source configured")
+        applied = rollups.backfill(events, since.isoformat())
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"BigQuery Error: {e}")
+        print(f"Backfill Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    return {"source": source, "since": since.isoformat(), "events": len(events), "applied": applied}
+
+@app.get("/rollups/stats")
+def rollup_stats():
+    return rollups.snapshot()
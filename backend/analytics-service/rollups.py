@@ -0,0 +1,195 @@
+"""
+Incremental adherence rollups.
+
+Medication events are folded into a small SQLite file as they arrive, so the
+dashboard reads a handful of precomputed rows instead of scanning
+medication_events in BigQuery on every load:
+
+- schedules:   one row per (user, medication) with the first day it was
+               scheduled. Each medication is one dose a day, so "scheduled"
+               for a day is the number of the user's medications active by then.
+- dose_status: latest taken/not-taken state per (user, day, medication).
+               Events older than the stored state are ignored (late delivery).
+- daily:       taken doses per (user, day), adjusted by +1/-1 as states change.
+- seen_events: event ids already applied; redelivered events are no-ops.
+
+Days are the medication's local dates (the event's local_day, the day
+medication-service counts a dose as taken on). Events logged before
+local_day existed fall back to the UTC date, matching BigQuery's DATE(timestamp).
+Everything can be rebuilt from raw events with backfill().
+"""
+import datetime
+import sqlite3
+import threading
+from typing import Iterable, List, Optional
+
+EVENT_ADDED = "MEDICATION_ADDED"
+EVENT_TOGGLED = "MEDICATION_TOGGLED"
+SEEN_EVENTS_DAYS = 35  # Redelivery window kept for de-duplication
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS schedules ("
+    "user_id TEXT NOT NULL, med_id TEXT NOT NULL, start_day TEXT NOT NULL, "
+    "PRIMARY KEY (user_id, med_id)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS dose_status ("
+    "user_id TEXT NOT NULL, day TEXT NOT NULL, med_id TEXT NOT NULL, taken INTEGER NOT NULL, ts TEXT NOT NULL, "
+    "PRIMARY KEY (user_id, day, med_id)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS daily ("
+    "user_id TEXT NOT NULL, day TEXT NOT NULL, taken INTEGER NOT NULL, "
+    "PRIMARY KEY (user_id, day)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS idx_daily_day ON daily(day)",
+    "CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, day TEXT NOT NULL) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS idx_seen_events_day ON seen_events(day)",
+)
+
+
+def _timestamp(value) -> str:
+    """ISO-8601 UTC string for a datetime or string timestamp."""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    return str(value).replace(" ", "T").replace("+00:00", "").rstrip("Z")
+
+
+class AdherenceRollups:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        self.stats = {"applied": 0, "duplicates": 0, "stale": 0, "unattributed": 0}
+
+    # --- Ingest ---
+    def apply(self, events: Iterable[dict]) -> int:
+        """Folds raw medication events into the rollups (one transaction). Returns the number applied."""
+        return self._transaction(lambda: self._apply_many(events))
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                applied = fn()
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        self.stats["applied"] += applied
+        return applied
+
+    def _apply_many(self, events: Iterable[dict]) -> int:
+        return sum(self._apply_one(event) for event in events)
+
+    def _apply_one(self, event: dict) -> int:
+        user_id, med_id = event.get("user_id"), event.get("med_id")
+        if not user_id or not med_id:
+            # Events logged before medications had owners cannot be attributed
+            self.stats["unattributed"] += 1
+            return 0
+        ts = _timestamp(event["timestamp"])
+        day = str(event.get("local_day") or ts[:10])[:10]
+
+        if event.get("event_id"):
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO seen_events (event_id, day) VALUES (?, ?)", (event["event_id"], day)
+            )
+            if cur.rowcount == 0:
+                self.stats["duplicates"] += 1
+                return 0
+
+        # Any event proves the medication was scheduled by that day
+        self._db.execute(
+            "INSERT INTO schedules (user_id, med_id, start_day) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, med_id) DO UPDATE SET start_day = MIN(start_day, excluded.start_day)",
+            (user_id, med_id, day),
+        )
+        if event.get("event_type") != EVENT_TOGGLED:
+            return 1
+
+        taken = 1 if event.get("status") == "TAKEN" else 0
+        row = self._db.execute(
+            "SELECT taken, ts FROM dose_status WHERE user_id = ? AND day = ? AND med_id = ?", (user_id, day, med_id)
+        ).fetchone()
+        if row is not None and row[1] > ts:
+            self.stats["stale"] += 1
+            return 1
+        self._db.execute(
+            "INSERT OR REPLACE INTO dose_status (user_id, day, med_id, taken, ts) VALUES (?, ?, ?, ?, ?)",
+            (user_id, day, med_id, taken, ts),
+        )
+        delta = taken - (row[0] if row else 0)
+        if delta:
+            self._db.execute(
+                "INSERT INTO daily (user_id, day, taken) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, day) DO UPDATE SET taken = taken + excluded.taken",
+                (user_id, day, delta),
+            )
+        return 1
+
+    def backfill(self, events: Iterable[dict], since_day: str) -> int:
+        """
+        Rebuilds per-day state from `since_day` on from raw events (which must cover that window).
+        Schedules are only ever widened, so older medications keep their start days.
+        All or nothing: the window is only replaced if every event applies.
+        """
+        def rebuild() -> int:
+            for table in ("dose_status", "daily", "seen_events"):
+                self._db.execute(f"DELETE FROM {table} WHERE day >= ?", (since_day,))
+            return self._apply_many(events)
+
+        return self._transaction(rebuild)
+
+    def prune(self, today: Optional[datetime.date] = None):
+        horizon = ((today or datetime.datetime.utcnow().date()) - datetime.timedelta(days=SEEN_EVENTS_DAYS)).isoformat()
+        with self._lock:
+            self._db.execute("DELETE FROM seen_events WHERE day < ?", (horizon,))
+
+    # --- Reads ---
+    def weekly(self, user_id: Optional[str], days: int = 7, today: Optional[datetime.date] = None) -> List[dict]:
+        """
+        Adherence for the last `days` days (oldest first): taken / scheduled doses.
+        user_id=None aggregates every user.
+        """
+        today = today or datetime.datetime.utcnow().date()
+        dates = [today - datetime.timedelta(days=offset) for offset in range(days - 1, -1, -1)]
+        first, last = dates[0].isoformat(), dates[-1].isoformat()
+        user_filter, params = ("AND user_id = ?", [user_id]) if user_id else ("", [])
+
+        with self._lock:
+            taken = dict(self._db.execute(
+                f"SELECT day, SUM(taken) FROM daily WHERE day BETWEEN ? AND ? {user_filter} GROUP BY day",
+                [first, last, *params],
+            ).fetchall())
+            # Medications already scheduled before the window, plus those added within it
+            before = self._db.execute(
+                f"SELECT COUNT(*) FROM schedules WHERE start_day < ? {user_filter}", [first, *params]
+            ).fetchone()[0]
+            added = dict(self._db.execute(
+                f"SELECT start_day, COUNT(*) FROM schedules WHERE start_day BETWEEN ? AND ? {user_filter} "
+                "GROUP BY start_day",
+                [first, last, *params],
+            ).fetchall())
+
+        stats, scheduled = [], before
+        for date in dates:
+            day = date.isoformat()
+            scheduled += added.get(day, 0)
+            count = taken.get(day, 0)
+            stats.append({
+                "day": date.strftime("%a"),
+                "date": day,
+                "taken": count,
+                "scheduled": scheduled,
+                "value": round(min(count / scheduled * 100, 100), 1) if scheduled else 0.0,
+            })
+        return stats
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rows = {
+                table: self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("schedules", "daily", "seen_events")
+            }
+        return {**self.stats, "rows": rows}
@@ -26,6 +26,16 @@ try:
         print("Adding details...")
         added = True
         
+    if "user_id" not in existing_fields:
+        new_schema.append(bigquery.SchemaField("user_id", "STRING", mode="NULLABLE"))
+        print("Adding user_id...")
+        added = True
+
+    if "local_day" not in existing_fields:
+        new_schema.append(bigquery.SchemaField("local_day", "STRING", mode="NULLABLE"))
+        print("Adding local_day...")
+        added = True
+
     if added:
         table.schema = new_schema
         client.update_table(table, ["schema"])
@@ -0,0 +1,153 @@
+"""
+Edge token verification for the gateway.
+
+Bearer tokens are verified here, once, before any upstream is contacted:
+HS256 with the shared SECRET_KEY (the key auth-service signs with), or any
+JWKS-published key when GATEWAY_JWKS_URL is set (fetched at startup and
+refetched, at most once a minute, when a token names an unknown `kid`).
+
+- Bad or expired token: 401 at the edge, no upstream hop.
+- No token: passed through (public routes such as login), or 401 when
+  GATEWAY_REQUIRE_AUTH=true and the route is not in PUBLIC_ROUTES.
+- Valid token: the verified claims travel downstream in X-MedX-Principal,
+  "<base64url JSON>.<base64url HMAC-SHA256>", signed with
+  PRINCIPAL_SIGNING_KEY (defaults to SECRET_KEY), so services can trust the
+  identity without decoding the JWT again. A client-supplied X-MedX-Principal
+  is always stripped (see proxy._EXCLUDED_REQUEST_HEADERS).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, Request
+from jose import JWTError, jwt
+
+PRINCIPAL_HEADER = "x-medx-principal"
+# Claims forwarded downstream (auth-service's token_claims plus expiry)
+PRINCIPAL_CLAIMS = ("sub", "role", "organization_id", "name", "exp")
+JWKS_REFRESH_SECONDS = 60
+
+
+def b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def sign_principal(claims: dict, key: str) -> str:
+    payload = b64encode(json.dumps(claims, separators=(",", ":"), sort_keys=True).encode("utf-8"))
+    signature = hmac.new(key.encode("utf-8"), payload.encode("ascii"), hashlib.sha256).digest()
+    return f"{payload}.{b64encode(signature)}"
+
+
+class EdgeAuth:
+    def __init__(self, secret: Optional[str], signing_key: Optional[str] = None,
+                 algorithms: Iterable[str] = ("HS256",), jwks_url: Optional[str] = None,
+                 require_auth: bool = False, public_routes: Dict[str, Iterable[str]] = None):
+        self.secret = secret
+        self.signing_key = signing_key or secret
+        self.algorithms = list(algorithms)
+        self.jwks_url = jwks_url
+        self.require_auth = require_auth
+        self.public_routes = {service: tuple(paths) for service, paths in (public_routes or {}).items()}
+        self._jwks: Optional[dict] = None
+        self._jwks_fetched_at = 0.0
+        self.stats = {"verified": 0, "rejected": 0, "anonymous": 0, "jwks_fetches": 0}
+
+    # --- JWKS ---
+    async def load(self, client: Optional[httpx.AsyncClient] = None):
+        """Fetches the JWKS (if configured). Called at startup; failures leave the old key set."""
+        if not self.jwks_url:
+            return
+        self._jwks_fetched_at = time.monotonic()
+        try:
+            if client is None:
+                async with httpx.AsyncClient(timeout=5) as c:
+                    r = await c.get(self.jwks_url)
+            else:
+                r = await client.get(self.jwks_url)
+            r.raise_for_status()
+            self._jwks = r.json()
+            self.stats["jwks_fetches"] += 1
+            print(f"✅ Gateway JWKS loaded ({len(self._jwks.get('keys', []))} keys)")
+        except Exception as e:
+            print(f"❌ Gateway JWKS fetch failed: {e}")
+
+    def _known_kid(self, token: str) -> bool:
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except JWTError:
+            return True  # Malformed; a refetch would not help
+        return kid is None or any(k.get("kid") == kid for k in (self._jwks or {}).get("keys", []))
+
+    # --- Verification ---
+    def _decode(self, token: str) -> dict:
+        key = self._jwks if self.jwks_url else self.secret
+        if not key:
+            raise JWTError("No verification key configured")
+        return jwt.decode(token, key, algorithms=self.algorithms, options={"verify_aud": False})
+
+    async def verify(self, token: str) -> dict:
+        if self.jwks_url and not self._known_kid(token) \
+                and time.monotonic() - self._jwks_fetched_at > JWKS_REFRESH_SECONDS:
+            await self.load()  # Key rotation
+        claims = self._decode(token)
+        if claims.get("sub") is None:
+            raise JWTError("Token has no subject")
+        return claims
+
+    def _is_public(self, service: str, path: str) -> bool:
+        return any(path.startswith(prefix) for prefix in self.public_routes.get(service, ()))
+
+    @staticmethod
+    def _bearer(request: Request) -> Tuple[bool, Optional[str]]:
+        """(has Authorization header, bearer token or None)."""
+        auth = request.headers.get("authorization")
+        if not auth:
+            return False, None
+        scheme, _, token = auth.partition(" ")
+        return True, token.strip() if scheme.lower() == "bearer" and token.strip() else None
+
+    async def authenticate(self, service: str, path: str, request: Request) -> Optional[dict]:
+        """
+        Verifies the caller and sets request.state.principal / forward_headers for the proxy.
+        Returns the verified claims, or None for anonymous requests. Raises 401 on bad tokens.
+        """
+        request.state.principal = None
+        request.state.forward_headers = ()
+        has_auth, token = self._bearer(request)
+
+        if token is None:
+            # Non-bearer schemes are left for the upstream to judge
+            if not has_auth and self.require_auth and not self._is_public(service, path):
+                self.stats["rejected"] += 1
+                raise HTTPException(status_code=401, detail="Not authenticated",
+                                    headers={"WWW-Authenticate": "Bearer"})
+            self.stats["anonymous"] += 1
+            return None
+
+        try:
+            claims = await self.verify(token)
+        except JWTError:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=401, detail="Could not validate credentials",
+                                headers={"WWW-Authenticate": "Bearer"})
+
+        self.stats["verified"] += 1
+        principal = {k: claims[k] for k in PRINCIPAL_CLAIMS if k in claims}
+        request.state.principal = principal
+        if self.signing_key:
+            request.state.forward_headers = (
+                (PRINCIPAL_HEADER.encode("ascii"), sign_principal(principal, self.signing_key).encode("ascii")),
+            )
+        return principal
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "mode": "jwks" if self.jwks_url else "shared_key",
+            "require_auth": self.require_auth,
+            "jwks_keys": len((self._jwks or {}).get("keys", [])),
+        }
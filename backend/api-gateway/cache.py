@@ -0,0 +1,258 @@
+"""
+Gateway response cache for idempotent GETs.
+
+Only routes listed in the cache rules are cached, each with its own TTL.
+Entries are keyed on service + path + sorted query + principal (the subject
+verified by auth.py, else a hash of the Authorization header), so users never
+see each other's responses.
+
+- ETag / If-None-Match: every cached response carries an ETag (the upstream's,
+  or a body hash); a matching If-None-Match is answered with 304.
+- Coalescing: concurrent misses for the same key share one upstream call.
+- Only JSON is cached: requests asking for another representation (format=ndjson
+  exports, non-JSON Accept) go straight to the streaming proxy instead of being
+  buffered in gateway memory.
+- Invalidation: a write (POST/PUT/PATCH/DELETE) through the gateway drops every
+  entry of that service (and of any service listed as depending on it). A
+  per-service generation counter stops a fetch that raced a write from storing
+  a stale body.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+RawHeaders = List[Tuple[bytes, bytes]]
+Fetch = Callable[[], Awaitable[Tuple[int, RawHeaders, bytes]]]
+
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+@dataclass
+class CacheRule:
+    prefix: str  # path prefix relative to the service
+    ttl: float   # seconds
+
+
+@dataclass
+class CachedResponse:
+    status_code: int
+    headers: RawHeaders
+    body: bytes
+    etag: str
+    stored_at: float
+    expires_at: float
+
+
+def principal_of(request: Request) -> str:
+    verified = getattr(request.state, "principal", None)
+    if verified:
+        # Every token of the same user shares entries (role/org are part of the identity)
+        raw = "\0".join(str(verified.get(k)) for k in ("sub", "role", "organization_id"))
+        return "sub:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+    auth = request.headers.get("authorization", "")
+    return hashlib.sha256(auth.encode("utf-8")).hexdigest()[:32] if auth else "anonymous"
+
+
+def wants_json(request: Request) -> bool:
+    if request.query_params.get("format", "json").lower() != "json":
+        return False
+    accept = request.headers.get("accept")
+    if not accept:
+        return True
+    types = [part.split(";")[0].strip().lower() for part in accept.split(",")]
+    return any(t in ("application/json", "application/*", "*/*") or t.endswith("+json") for t in types)
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison (RFC 7232 2.3.2)
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in header.split(","))
+
+
+class ResponseCache:
+    def __init__(self, rules: Dict[str, List[CacheRule]], dependents: Optional[Dict[str, Iterable[str]]] = None,
+                 max_entries: int = 5000, max_body_bytes: int = 1024 * 1024):
+        # Longest prefix first so the most specific rule wins
+        self.rules = {service: sorted(r, key=lambda rule: -len(rule.prefix)) for service, r in rules.items()}
+        self.dependents = {service: set(deps) for service, deps in (dependents or {}).items()}
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._by_service: Dict[str, Set[str]] = {}
+        self._generation: Dict[str, int] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    # --- Rules / keys ---
+    def rule_for(self, service: str, path: str) -> Optional[CacheRule]:
+        for rule in self.rules.get(service, ()):
+            if path.startswith(rule.prefix):
+                return rule
+        return None
+
+    @staticmethod
+    def make_key(service: str, path: str, request: Request) -> str:
+        query = "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+        raw = "\0".join((service, path, query, principal_of(request)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    # --- Storage ---
+    def _get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.time():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, service: str, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._by_service.setdefault(service, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest, _ = self._entries.popitem(last=False)
+            for keys in self._by_service.values():
+                keys.discard(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        self._entries.pop(key, None)
+        for keys in self._by_service.values():
+            keys.discard(key)
+
+    def invalidate(self, service: str):
+        for name in {service} | self.dependents.get(service, set()):
+            self._generation[name] = self._generation.get(name, 0) + 1
+            for key in self._by_service.pop(name, set()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._by_service.clear()
+
+    def _cacheable(self, status_code: int, headers: RawHeaders, body: bytes) -> bool:
+        if status_code != 200 or len(body) > self.max_body_bytes:
+            return False
+        for k, v in headers:
+            name = k.lower()
+            if name == b"set-cookie":
+                return False
+            if name == b"cache-control" and (b"no-store" in v.lower() or b"no-cache" in v.lower()):
+                return False
+        return True
+
+    # --- Serving ---
+    async def _fill(self, service: str, key: str, rule: CacheRule, fetch: Fetch) -> Tuple[CachedResponse, bool]:
+        """Runs the upstream call once per key. Returns (response, stored)."""
+        generation = self._generation.get(service, 0)
+        status_code, headers, body = await fetch()
+
+        etag = next((v.decode("latin-1") for k, v in headers if k.lower() == b"etag"), None)
+        if etag is None:
+            etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+            headers = headers + [(b"etag", etag.encode("latin-1"))]
+
+        now = time.time()
+        entry = CachedResponse(status_code, headers, body, etag, now, now + rule.ttl)
+        stored = self._cacheable(status_code, headers, body) and self._generation.get(service, 0) == generation
+        if stored:
+            self._store(service, key, entry)
+        return entry, stored
+
+    async def serve(self, service: str, path: str, request: Request, fetch: Fetch) -> Optional[Response]:
+        """Returns a cached/coalesced response, or None when the request is not cacheable."""
+        if request.method != "GET":
+            return None
+        rule = self.rule_for(service, path)
+        if rule is None:
+            return None
+        if not wants_json(request):
+            self.bypassed += 1
+            return None
+
+        key = self.make_key(service, path, request)
+        entry = self._get(key)
+        if entry is not None:
+            self.hits += 1
+            return self._respond(entry, request, "HIT")
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            entry, _ = await asyncio.shield(pending)
+            return self._respond(entry, request, "COALESCED")
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._fill(service, key, rule, fetch)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters re-raise it; mark retrieved so an unshared failure is not logged as unhandled
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        entry, stored = result
+        return self._respond(entry, request, "MISS" if stored else "BYPASS")
+
+    def _respond(self, entry: CachedResponse, request: Request, state: str) -> Response:
+        max_age = max(0, int(entry.expires_at - time.time()))
+        extra = [
+            (b"x-cache", state.encode("latin-1")),
+            (b"cache-control", f"private, max-age={max_age}".encode("latin-1")),
+            (b"age", str(int(time.time() - entry.stored_at)).encode("latin-1")),
+        ]
+        if entry.status_code == 200 and _etag_matches(request.headers.get("if-none-match"), entry.etag):
+            self.not_modified += 1
+            response = Response(status_code=304)
+            response.raw_headers = [(b"etag", entry.etag.encode("latin-1"))] + extra
+            return response
+
+        response = Response(content=entry.body, status_code=entry.status_code)
+        passthrough = [
+            (k, v) for k, v in entry.headers
+            if k.lower() not in (b"cache-control", b"age", b"content-length")
+        ]
+        # Response() computed content-length from the body; keep it and replace the rest
+        response.raw_headers = [h for h in response.raw_headers if h[0] == b"content-length"] + passthrough + extra
+        return response
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
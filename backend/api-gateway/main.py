@@ -1,7 +1,10 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-import httpx
+import os
+from proxy import ProxyCore, PoolConfig, Timeouts
+from resilience import BreakerConfig
+from cache import ResponseCache, CacheRule, SAFE_METHODS
+from auth import EdgeAuth
 
 app = FastAPI(title="MedX API Gateway")
 
@@ -15,12 +18,12 @@ app.add_middleware(
 )
 
 # Service URLs (Cloud Run)
-AUTH_SERVICE_URL = "https://auth-service-zxsaiaxzjq-uc.a.run.app"
-CLINICAL_SERVICE_URL = "https://clinical-service-zxsaiaxzjq-uc.a.run.app"
-MEDICATION_SERVICE_URL = "https://medication-service-zxsaiaxzjq-uc.a.run.app"
-ANALYTICS_SERVICE_URL = "https://analytics-service-zxsaiaxzjq-uc.a.run.app"
-NOTIFICATION_SERVICE_URL = "https://notification-service-zxsaiaxzjq-uc.a.run.app"
-APPOINTMENT_SERVICE_URL = "https://appointment-service-zxsaiaxzjq-uc.a.run.app"
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "https://auth-service-zxsaiaxzjq-uc.a.run.app")
+CLINICAL_SERVICE_URL = os.getenv("CLINICAL_SERVICE_URL", "https://clinical-service-zxsaiaxzjq-uc.a.run.app")
+MEDICATION_SERVICE_URL = os.getenv("MEDICATION_SERVICE_URL", "https://medication-service-zxsaiaxzjq-uc.a.run.app")
+ANALYTICS_SERVICE_URL = os.getenv("ANALYTICS_SERVICE_URL", "https://analytics-service-zxsaiaxzjq-uc.a.run.app")
+NOTIFICATION_SERVICE_URL = os.getenv("NOTIFICATION_SERVICE_URL", "https://notification-service-zxsaiaxzjq-uc.a.run.app")
+APPOINTMENT_SERVICE_URL = os.getenv("APPOINTMENT_SERVICE_URL", "https://appointment-service-zxsaiaxzjq-uc.a.run.app")
 
 # Service Mappings
 SERVICES = {
@@ -32,53 +35,115 @@ SERVICES = {
     "appointments": APPOINTMENT_SERVICE_URL
 }
 
-client = httpx.AsyncClient(timeout=60.0)
-
-async def forward_request(service_url: str, path: str, request: Request):
-    url = f"{service_url}/{path}"
-    
-    # Forward headers, excluding host
-    headers = dict(request.headers)
-    headers.pop("host", None)
-    headers.pop("content-length", None) # Let httpx handle this
-
-    try:
-        req = client.build_request(
-            request.method,
-            url,
-            headers=headers,
-            content=request.stream(),
-            cookies=request.cookies,
-            params=request.query_params
-        )
-        
-        r = await client.send(req, stream=True)
-        
-        return StreamingResponse(
-            r.aiter_raw(),
-            status_code=r.status_code,
-            headers=dict(r.headers),
-            background=None
-        )
-    except httpx.ConnectError:
-        raise HTTPException(status_code=503, detail="Service Unavailable")
-    except Exception as e:
-        import traceback
-        return StreamingResponse(
-            iter([traceback.format_exc().encode()]),
-            status_code=500
-        )
+# Connection pool, timeout, breaker and bulkhead tuning per upstream (env overrides: see proxy._env_override).
+# Each upstream is isolated: a slow clinical-service can only exhaust its own bulkhead, never auth's.
+POOL_CONFIGS = {
+    # Logins must fail fast rather than queue behind a slow instance
+    "auth": PoolConfig(
+        max_connections=100, max_keepalive=50, timeouts=Timeouts(connect=2, read=10, write=10, pool=2),
+        max_queue=100, breaker=BreakerConfig(slow_call_seconds=3), hedge_after=1.0,
+    ),
+    "medications": PoolConfig(
+        max_connections=100, max_keepalive=50, timeouts=Timeouts(connect=3, read=15, write=15),
+        breaker=BreakerConfig(slow_call_seconds=5), hedge_after=1.5,
+    ),
+    # Gemini-backed: long reads, document uploads need long writes too. Slow calls are normal here,
+    # so the breaker only trips on errors/timeouts; hedging would double Gemini spend.
+    "clinical": PoolConfig(
+        max_connections=50, max_keepalive=20,
+        timeouts=Timeouts(connect=3, read=60, write=30),
+        routes={
+            "documents/": Timeouts(connect=3, read=120, write=120),
+            "nlp/deidentify/stream": Timeouts(connect=3, read=300, write=300),
+        },
+        max_in_flight=40, max_queue=20, breaker=BreakerConfig(slow_call_seconds=60, slow_rate=1.0),
+    ),
+    "analytics": PoolConfig(
+        max_connections=30, max_keepalive=10, timeouts=Timeouts(connect=3, read=30, write=10),
+        max_queue=20, breaker=BreakerConfig(slow_call_seconds=15),
+    ),
+    "notifications": PoolConfig(max_connections=50, max_keepalive=20, timeouts=Timeouts(connect=3, read=30, write=30)),
+    "appointments": PoolConfig(
+        max_connections=50, max_keepalive=20, timeouts=Timeouts(connect=3, read=15, write=15),
+        breaker=BreakerConfig(slow_call_seconds=5), hedge_after=1.5,
+    ),
+}
+
+proxy = ProxyCore(SERVICES, POOL_CONFIGS)
+
+# Gateway response cache: GET routes (relative to the service) and their TTLs in seconds.
+# Any write to a service drops that service's entries, so TTLs only bound staleness from
+# changes made outside the gateway.
+CACHE_RULES = {
+    "auth": [CacheRule("users/doctors", 120), CacheRule("me", 30)],
+    "appointments": [CacheRule("availability/", 60), CacheRule("appointments", 15)],
+    # Rollups update a few seconds after the medication write (batched events), so keep this short
+    "analytics": [CacheRule("weekly-adherence", 30)],
+    "medications": [CacheRule("medications", 15)],
+}
+# Writes to the key service also invalidate these (adherence is computed from medication events)
+CACHE_DEPENDENTS = {
+    "medications": ["analytics"],
+}
+
+response_cache = ResponseCache(
+    CACHE_RULES if os.getenv("GATEWAY_CACHE_ENABLED", "true").lower() == "true" else {},
+    CACHE_DEPENDENTS,
+    max_entries=int(os.getenv("GATEWAY_CACHE_MAX_ENTRIES", "5000")),
+)
+
+# Edge token verification (see auth.py). SECRET_KEY must match auth-service's;
+# GATEWAY_JWKS_URL switches to verifying against a published key set instead.
+SECRET_KEY = os.getenv("SECRET_KEY", "YOUR_SUPER_SECRET_KEY_CHANGE_THIS_IN_PROD")
+GATEWAY_VERIFY_TOKENS = os.getenv("GATEWAY_VERIFY_TOKENS", "true").lower() == "true"
+# Reachable without a token when GATEWAY_REQUIRE_AUTH=true (paths relative to the service)
+PUBLIC_ROUTES = {
+    "auth": ["token", "register", "register-org"],
+}
+
+edge_auth = EdgeAuth(
+    SECRET_KEY,
+    signing_key=os.getenv("PRINCIPAL_SIGNING_KEY"),
+    algorithms=os.getenv("GATEWAY_JWT_ALGORITHMS", "HS256").split(","),
+    jwks_url=os.getenv("GATEWAY_JWKS_URL"),
+    require_auth=os.getenv("GATEWAY_REQUIRE_AUTH", "false").lower() == "true",
+    public_routes=PUBLIC_ROUTES,
+)
+
+async def forward_request(service: str, path: str, request: Request):
+    if GATEWAY_VERIFY_TOKENS and request.method != "OPTIONS":
+        await edge_auth.authenticate(service, path, request)
+
+    if request.method not in SAFE_METHODS:
+        # Before: in-flight reads may not store. After: reads racing the write are dropped.
+        response_cache.invalidate(service)
+        try:
+            return await proxy.forward(service, path, request)
+        finally:
+            response_cache.invalidate(service)
+
+    cached = await response_cache.serve(
+        service, path, request, lambda: proxy.pools[service].fetch(path, request)
+    )
+    if cached is not None:
+        return cached
+    return await proxy.forward(service, path, request)
+
+@app.on_event("startup")
+async def startup_event():
+    if GATEWAY_VERIFY_TOKENS:
+        await edge_auth.load()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await client.aclose()
+    await proxy.aclose()
 
 # Routes
 
 # Auth Service
 @app.api_route("/auth/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def auth_proxy(path: str, request: Request):
-    return await forward_request(SERVICES["auth"], path, request)
+    return await forward_request("auth", path, request)
 
 # Medication Service
 @app.api_route("/medications/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
@@ -86,7 +151,7 @@ async def medication_proxy(path: str, request: Request):
     # Note: The medication service likely expects paths starting with /medications or root.
     # If the service endpoint is /medications, and we strip it, it might fail.
     # Adjusting based on standard pattern: usually standard is Gateway /service/path -> Service /path
-    return await forward_request(SERVICES["medications"], path, request)
+    return await forward_request("medications", path, request)
 
 # Clinical Service
 @app.api_route("/clinical/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
@@ -95,23 +160,32 @@ async def clinical_proxy(path: str, request: Request):
     # But path mapping needs to be accurate. 
     # Current Clinical endpoints: /nlp/extract, /interactions/check, /documents/analyze
     # So if frontend calls /clinical/nlp/extract, we forward to 8002/nlp/extract.
-    return await forward_request(SERVICES["clinical"], path, request)
+    return await forward_request("clinical", path, request)
 
 # Analytics Service
 @app.api_route("/analytics/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def analytics_proxy(path: str, request: Request):
-    return await forward_request(SERVICES["analytics"], path, request)
+    return await forward_request("analytics", path, request)
 
 # Notification Service
 @app.api_route("/notifications/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def notifications_proxy(path: str, request: Request):
-    return await forward_request(SERVICES["notifications"], path, request)
+    return await forward_request("notifications", path, request)
 
 # Appointment Service
 @app.api_route("/appointments/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def appointments_proxy(path: str, request: Request):
-    return await forward_request(SERVICES["appointments"], path, request)
+    return await forward_request("appointments", path, request)
 
 @app.get("/")
 def root():
     return {"status": "MedX Gateway Running", "services": SERVICES}
+
+@app.get("/gateway/metrics")
+def gateway_metrics():
+    """Per-upstream pool utilization, breaker/bulkhead state, error counters, response cache and edge auth stats."""
+    return {
+        "pools": proxy.metrics(),
+        "cache": response_cache.stats(),
+        "auth": edge_auth.snapshot() if GATEWAY_VERIFY_TOKENS else None,
+    }
@@ -0,0 +1,289 @@
+"""
+Reverse-proxy core for the gateway.
+
+Each upstream in SERVICES gets its own httpx.AsyncClient (its own connection
+pool), sized and timed for that service, with HTTP/2 when `h2` is installed.
+Individual routes can override the service timeouts (e.g. long reads for
+clinical document uploads, fast failure for auth).
+
+Every pool is also guarded by its own circuit breaker and bulkhead (see
+resilience.py), so a degraded upstream sheds load with fast 503s instead of
+holding gateway connections open; idempotent GETs can optionally be hedged.
+"""
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from resilience import (
+    BreakerConfig, Bulkhead, BulkheadFullError, CircuitBreaker, CircuitOpenError, hedged,
+)
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Hop-by-hop headers (RFC 7230 6.1) plus ones httpx recomputes itself
+_EXCLUDED_REQUEST_HEADERS = frozenset({
+    b"host", b"content-length", b"connection", b"keep-alive", b"proxy-authenticate",
+    b"proxy-authorization", b"te", b"trailer", b"transfer-encoding", b"upgrade",
+    # Only the gateway may assert a principal (see auth.py)
+    b"x-medx-principal",
+})
+# Cached fetches are revalidated by the gateway itself, never by the upstream
+_CONDITIONAL_HEADERS = frozenset({b"if-none-match", b"if-modified-since"})
+_EXCLUDED_RESPONSE_HEADERS = frozenset({
+    b"content-length", b"connection", b"keep-alive", b"transfer-encoding", b"upgrade", b"trailer",
+})
+
+
+@dataclass
+class Timeouts:
+    connect: float = 3.0
+    read: float = 30.0
+    write: float = 30.0
+    pool: float = 5.0  # max wait for a free connection before shedding with 503
+
+    def to_httpx(self) -> httpx.Timeout:
+        return httpx.Timeout(connect=self.connect, read=self.read, write=self.write, pool=self.pool)
+
+
+@dataclass
+class PoolConfig:
+    max_connections: int = 100
+    max_keepalive: int = 20
+    keepalive_expiry: float = 30.0
+    timeouts: Timeouts = field(default_factory=Timeouts)
+    # path prefix (relative to the service) -> timeouts for that route
+    routes: Dict[str, Timeouts] = field(default_factory=dict)
+    # Bulkhead: requests beyond max_in_flight wait (at most max_queue of them, for at most
+    # queue_timeout seconds) and are otherwise rejected with 503
+    max_in_flight: Optional[int] = None  # defaults to max_connections
+    max_queue: int = 50
+    queue_timeout: Optional[float] = None  # defaults to timeouts.pool
+    breaker: BreakerConfig = field(default_factory=BreakerConfig)
+    # Send a second attempt for GETs that haven't answered after this many seconds (None = off)
+    hedge_after: Optional[float] = None
+
+
+def _env_override(service: str, config: PoolConfig) -> PoolConfig:
+    """
+    GATEWAY_<SERVICE>_MAX_CONNECTIONS / _MAX_KEEPALIVE / _CONNECT_TIMEOUT / _READ_TIMEOUT / _WRITE_TIMEOUT
+    / _MAX_IN_FLIGHT / _MAX_QUEUE / _HEDGE_AFTER (0 disables hedging)
+    """
+    prefix = f"GATEWAY_{service.upper()}_"
+    config.max_connections = int(os.getenv(prefix + "MAX_CONNECTIONS", config.max_connections))
+    config.max_keepalive = int(os.getenv(prefix + "MAX_KEEPALIVE", config.max_keepalive))
+    config.timeouts.connect = float(os.getenv(prefix + "CONNECT_TIMEOUT", config.timeouts.connect))
+    config.timeouts.read = float(os.getenv(prefix + "READ_TIMEOUT", config.timeouts.read))
+    config.timeouts.write = float(os.getenv(prefix + "WRITE_TIMEOUT", config.timeouts.write))
+    if os.getenv(prefix + "MAX_IN_FLIGHT"):
+        config.max_in_flight = int(os.getenv(prefix + "MAX_IN_FLIGHT"))
+    config.max_queue = int(os.getenv(prefix + "MAX_QUEUE", config.max_queue))
+    if os.getenv(prefix + "HEDGE_AFTER"):
+        config.hedge_after = float(os.getenv(prefix + "HEDGE_AFTER")) or None
+    return config
+
+
+async def _discard(response: httpx.Response):
+    await response.aclose()
+
+
+class UpstreamPool:
+    def __init__(self, name: str, base_url: str, config: PoolConfig):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.config = config
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            timeout=config.timeouts.to_httpx(),
+            http2=HTTP2_AVAILABLE,
+        )
+        # Route prefixes sorted longest-first so the most specific override wins
+        self._routes: Tuple[Tuple[str, httpx.Timeout], ...] = tuple(
+            (prefix, t.to_httpx()) for prefix, t in sorted(config.routes.items(), key=lambda kv: -len(kv[0]))
+        )
+
+        self.breaker = CircuitBreaker(config.breaker)
+        self.bulkhead = Bulkhead(
+            config.max_in_flight or config.max_connections,
+            config.max_queue,
+            config.queue_timeout if config.queue_timeout is not None else config.timeouts.pool,
+        )
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_latency = 0.0
+        self.hedges = 0
+
+    def timeout_for(self, path: str) -> Optional[httpx.Timeout]:
+        for prefix, timeout in self._routes:
+            if path.startswith(prefix):
+                return timeout
+        return None
+
+    def metrics(self) -> dict:
+        return {
+            "url": self.base_url,
+            "http2": HTTP2_AVAILABLE,
+            "max_connections": self.config.max_connections,
+            "max_keepalive": self.config.max_keepalive,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "utilization": round(self.in_flight / self.config.max_connections, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg_latency_ms": round(self.total_latency / self.requests * 1000, 1) if self.requests else 0.0,
+            "hedges": self.hedges,
+            "breaker": self.breaker.snapshot(),
+            "bulkhead": self.bulkhead.snapshot(),
+        }
+
+    def _begin(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def _end(self, started: float):
+        self.in_flight -= 1
+        self.total_latency += time.perf_counter() - started
+        self.bulkhead.release()
+
+    def _on_hedge(self):
+        self.hedges += 1
+
+    def _build(self, path: str, request: Request, content=None, exclude=frozenset()) -> httpx.Request:
+        headers = [
+            (k, v) for k, v in request.headers.raw if k not in _EXCLUDED_REQUEST_HEADERS and k not in exclude
+        ]
+        headers.extend(getattr(request.state, "forward_headers", ()))
+        timeout = self.timeout_for(path)
+        return self.client.build_request(
+            request.method,
+            f"{self.base_url}/{path}",
+            headers=headers,
+            content=content,
+            params=request.query_params,
+            **({"timeout": timeout} if timeout else {}),
+        )
+
+    async def _send(self, req: httpx.Request, started: float, stream: bool) -> httpx.Response:
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError as e:
+            raise HTTPException(status_code=503, detail="Service Unavailable",
+                                headers={"Retry-After": str(math.ceil(e.retry_after))})
+        try:
+            await self.bulkhead.acquire()
+        except BulkheadFullError:
+            self.breaker.cancel()
+            raise HTTPException(status_code=503, detail="Service Busy", headers={"Retry-After": "1"})
+
+        self._begin()
+        # Hedge only idempotent reads, and never while requests are already queueing
+        hedge_after = self.config.hedge_after if req.method == "GET" and not self.bulkhead.waiting else None
+        try:
+            if hedge_after:
+                r = await hedged(lambda: self.client.send(req, stream=stream), hedge_after, _discard, self._on_hedge)
+            else:
+                r = await self.client.send(req, stream=stream)
+        except httpx.TimeoutException as e:
+            self._end(started)
+            self.timeouts += 1
+            self.errors += 1
+            if isinstance(e, httpx.PoolTimeout):
+                self.breaker.cancel()  # Local saturation, not an upstream failure
+                raise HTTPException(status_code=503, detail="Service Busy")
+            self.breaker.record(False, time.perf_counter() - started)
+            raise HTTPException(status_code=504, detail="Upstream Timeout")
+        except httpx.TransportError:
+            self._end(started)
+            self.errors += 1
+            self.breaker.record(False, time.perf_counter() - started)
+            raise HTTPException(status_code=503, detail="Service Unavailable")
+        except BaseException:
+            # Client went away mid-request
+            self._end(started)
+            self.breaker.cancel()
+            raise
+
+        if r.status_code >= 500:
+            self.errors += 1
+        self.breaker.record(r.status_code < 500, time.perf_counter() - started)
+        return r
+
+    async def fetch(self, path: str, request: Request) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+        """Buffered round trip for bodiless requests (used by the response cache)."""
+        started = time.perf_counter()
+        r = await self._send(self._build(path, request, exclude=_CONDITIONAL_HEADERS), started, stream=False)
+        self._end(started)
+        headers = [(k, v) for k, v in r.headers.raw if k.lower() not in _EXCLUDED_RESPONSE_HEADERS]
+        # httpx has already decoded the body
+        headers = [(k, v) for k, v in headers if k.lower() != b"content-encoding"]
+        return r.status_code, headers, r.content
+
+    async def forward(self, path: str, request: Request) -> StreamingResponse:
+        started = time.perf_counter()
+        # GET bodies (rare, small) are buffered so a hedged attempt can resend them
+        content = await request.body() if request.method == "GET" else request.stream()
+        r = await self._send(self._build(path, request, content), started, stream=True)
+
+        closed = False
+
+        async def close():
+            # Runs from the body iterator or the background task, whichever comes first
+            nonlocal closed
+            if not closed:
+                closed = True
+                await r.aclose()
+                self._end(started)
+
+        async def body():
+            try:
+                async for chunk in r.aiter_raw():
+                    yield chunk
+            finally:
+                await close()
+
+        response = StreamingResponse(body(), status_code=r.status_code, background=BackgroundTask(close))
+        response.raw_headers = [
+            (k, v) for k, v in r.headers.raw if k.lower() not in _EXCLUDED_RESPONSE_HEADERS
+        ]
+        return response
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class ProxyCore:
+    def __init__(self, services: Dict[str, str], configs: Dict[str, PoolConfig]):
+        self.pools = {
+            name: UpstreamPool(name, url, _env_override(name, configs.get(name) or PoolConfig()))
+            for name, url in services.items()
+        }
+
+    async def forward(self, service: str, path: str, request: Request) -> StreamingResponse:
+        return await self.pools[service].forward(path, request)
+
+    def metrics(self) -> dict:
+        return {name: pool.metrics() for name, pool in self.pools.items()}
+
+    async def aclose(self):
+        for pool in self.pools.values():
+            await pool.aclose()
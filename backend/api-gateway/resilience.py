@@ -0,0 +1,215 @@
+"""
+Per-upstream failure isolation for the gateway.
+
+- CircuitBreaker: opens when the error rate or slow-call rate over a rolling
+  time window crosses its threshold, rejects calls while open, then lets a
+  few probe calls through (half-open) before closing again.
+- Bulkhead: caps in-flight requests per upstream with a short bounded wait
+  queue; anything beyond that is shed immediately with a 503.
+- hedged(): for idempotent GETs, sends a second attempt if the first has not
+  answered after a delay and keeps whichever finishes first.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Circuit open")
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(Exception):
+    pass
+
+
+@dataclass
+class BreakerConfig:
+    window_seconds: float = 30.0
+    min_calls: int = 10            # don't judge an upstream on fewer calls than this
+    failure_rate: float = 0.5      # errors / calls that opens the circuit
+    slow_call_seconds: float = 10.0
+    slow_rate: float = 0.8         # slow calls / calls that opens the circuit
+    open_seconds: float = 15.0     # how long to reject before probing
+    half_open_probes: int = 3      # successful probes needed to close
+
+
+class CircuitBreaker:
+    def __init__(self, config: Optional[BreakerConfig] = None):
+        self.config = config or BreakerConfig()
+        self.state = CLOSED
+        self._calls = deque()  # (timestamp, failed, slow)
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    def _prune(self, now: float):
+        horizon = now - self.config.window_seconds
+        while self._calls and self._calls[0][0] < horizon:
+            self._calls.popleft()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self.opened += 1
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not go upstream."""
+        if self.state == OPEN:
+            remaining = self._opened_at + self.config.open_seconds - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(remaining)
+            self.state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+        if self.state == HALF_OPEN:
+            if self._probes_in_flight >= self.config.half_open_probes:
+                self.rejected += 1
+                raise CircuitOpenError(1.0)
+            self._probes_in_flight += 1
+
+    def cancel(self):
+        """The call allowed by before_call() never reached the upstream."""
+        if self.state == HALF_OPEN and self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+
+    def record(self, success: bool, latency: float):
+        now = time.monotonic()
+        slow = latency >= self.config.slow_call_seconds
+
+        if self.state == HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if not success or slow:
+                self._open(now)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.config.half_open_probes:
+                self.state = CLOSED
+                self._calls.clear()
+            return
+
+        if self.state == OPEN:
+            return  # A call that started before the circuit opened
+
+        self._calls.append((now, not success, slow))
+        self._prune(now)
+        total = len(self._calls)
+        if total < self.config.min_calls:
+            return
+        failures = sum(1 for _, failed, _ in self._calls if failed)
+        slow_calls = sum(1 for _, _, s in self._calls if s)
+        if failures / total >= self.config.failure_rate or slow_calls / total >= self.config.slow_rate:
+            self._open(now)
+
+    def snapshot(self) -> dict:
+        self._prune(time.monotonic())
+        total = len(self._calls)
+        return {
+            "state": self.state,
+            "window_calls": total,
+            "error_rate": round(sum(1 for c in self._calls if c[1]) / total, 3) if total else 0.0,
+            "slow_rate": round(sum(1 for c in self._calls if c[2]) / total, 3) if total else 0.0,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class Bulkhead:
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters = deque()  # FIFO of futures; release() hands its slot to the oldest
+        self.shed = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            raise BulkheadFullError()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                return  # The slot was handed over as the timeout fired
+            self.shed += 1
+            raise BulkheadFullError()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # The slot was handed over just as we were cancelled
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            waiter.cancel()
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # Slot passes straight to the waiter; in_flight is unchanged
+                return
+        self.in_flight -= 1
+
+    def snapshot(self) -> dict:
+        return {"max_in_flight": self.max_in_flight, "max_queue": self.max_queue, "in_flight": self.in_flight,
+                "waiting": self.waiting, "shed": self.shed}
+
+
+async def hedged(call: Callable[[], Awaitable[T]], delay: float,
+                 discard: Callable[[T], Awaitable[None]], on_hedge: Callable[[], None] = lambda: None) -> T:
+    """
+    Runs call(); if it hasn't finished after `delay` seconds, runs it again concurrently.
+    Returns the first successful result (or the last error) and discards the other.
+    """
+    first = asyncio.ensure_future(call())
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+    except asyncio.CancelledError:
+        first.cancel()
+        raise
+    if done:
+        return first.result()
+
+    on_hedge()
+    pending = {first, asyncio.ensure_future(call())}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if not t.cancelled() and t.exception() is None), None)
+            if winner is not None:
+                for task in done:
+                    if task is not winner and not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
+                return winner.result()
+            error = next(iter(done)).exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if not isinstance(result, BaseException):
+                await discard(result)
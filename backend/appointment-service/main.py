@@ -1,10 +1,14 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 import os
-from google.cloud import firestore
+from storage import store_from_env, new_id, InvalidCursorError
+from scheduling import (
+    SlotEngine, SlotConflictError, SlotUnavailableError, DEFAULT_SLOT_MINUTES, WEEKDAYS, parse_minutes,
+)
 
 app = FastAPI(title="MedX Appointment Service")
 
@@ -17,13 +21,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database
-try:
-    db = firestore.Client()
-    print("✅ Firestore Client Initialized")
-except Exception as e:
-    print(f"❌ Firestore Init Failed: {e}")
-    db = None
+# Database: Firestore by default, STORAGE_BACKEND=local for the embedded store (see storage.py)
+db = store_from_env()
+
+# Slot expansion, booked-interval index and double-booking locks (see scheduling.py)
+slot_engine = SlotEngine(
+    db,
+    ttl=float(os.getenv("SLOT_CACHE_SECONDS", "15")),
+    horizon_days=int(os.getenv("SLOT_HORIZON_DAYS", "14")),
+) if db else None
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
 
 # Models
 class Availability(BaseModel):
@@ -31,6 +40,8 @@ class Availability(BaseModel):
     day_of_week: str # e.g., "Monday"
     start_time: str # "09:00"
     end_time: str # "17:00"
+    slot_minutes: int = DEFAULT_SLOT_MINUTES
+    organization_id: Optional[str] = None # Needed for organization-wide slot search
 
 class AppointmentCreate(BaseModel):
     doctor_id: str
@@ -41,6 +52,22 @@ class AppointmentCreate(BaseModel):
 class Appointment(AppointmentCreate):
     id: str
     status: str = "scheduled" # scheduled, completed, cancelled
+    duration_minutes: int = DEFAULT_SLOT_MINUTES
+
+class Slot(BaseModel):
+    doctor_id: str
+    start: str
+    end: str
+
+def parse_datetime(value: str) -> datetime:
+    """Naive clinic-local datetime (see scheduling.py); offsets are rejected, not silently dropped."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid datetime: {value}")
+    if parsed.tzinfo is not None:
+        raise HTTPException(status_code=400, detail=f"Datetime must be clinic-local, without a timezone: {value}")
+    return parsed
 
 # Endpoints
 
@@ -54,11 +81,20 @@ async def set_availability(avail: Availability):
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
     
+    if avail.day_of_week not in WEEKDAYS:
+        raise HTTPException(status_code=400, detail=f"day_of_week must be one of {', '.join(WEEKDAYS)}")
+    try:
+        valid = parse_minutes(avail.start_time) + avail.slot_minutes <= parse_minutes(avail.end_time)
+    except ValueError:
+        valid = False
+    if not valid or avail.slot_minutes <= 0:
+        raise HTTPException(status_code=400, detail="Availability must fit at least one slot")
+
     try:
         # Store in a subcollection or root collection
         # Let's use root collection 'availabilities' for simple querying
-        doc_ref = db.collection("availabilities").document(f"{avail.doctor_id}_{avail.day_of_week}")
-        doc_ref.set(avail.dict())
+        db.set("availabilities", f"{avail.doctor_id}_{avail.day_of_week}", avail.dict())
+        slot_engine.availability_changed(avail.organization_id)
         return {"message": "Availability set successfully"}
     except Exception as e:
         print(f"Error setting availability: {e}")
@@ -71,45 +107,132 @@ async def get_availability(doctor_id: str):
         raise HTTPException(status_code=503, detail="Database unavailable")
         
     try:
-        docs = db.collection("availabilities").where("doctor_id", "==", doctor_id).stream()
-        return [doc.to_dict() for doc in docs]
+        docs = db.query("availabilities", where=[("doctor_id", "==", doctor_id)])
+        return [doc.data for doc in docs]
     except Exception as e:
         print(f"Error fetching availability: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch availability")
 
+@app.get("/availability/{doctor_id}/slots", response_model=List[Slot])
+def get_doctor_slots(doctor_id: str, date: Optional[str] = None, days: int = Query(1, ge=1, le=31)):
+    """Free slots of a doctor from `date` (default: now) for `days` days"""
+    if not db:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+
+    after = parse_datetime(date) if date else datetime.now()
+    try:
+        return slot_engine.free_slots(doctor_id, after, days)
+    except Exception as e:
+        print(f"Error computing slots: {e}")
+        raise HTTPException(status_code=500, detail="Failed to compute slots")
+
+@app.get("/slots/next", response_model=List[Slot])
+def next_free_slots(
+    organization_id: str,
+    n: int = Query(10, ge=1, le=100),
+    after: Optional[str] = None,
+    days: Optional[int] = Query(None, ge=1, le=62),
+):
+    """Earliest `n` free slots across every doctor of an organization"""
+    if not db:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+
+    start = parse_datetime(after) if after else datetime.now()
+    try:
+        return slot_engine.next_free_slots(organization_id, start, n, days)
+    except Exception as e:
+        print(f"Error searching slots: {e}")
+        raise HTTPException(status_code=500, detail="Failed to search slots")
+
+@app.get("/slots/stats")
+def slot_stats():
+    return slot_engine.snapshot() if slot_engine else {}
+
 @app.post("/appointments", response_model=Appointment)
-async def book_appointment(appt: AppointmentCreate):
-    """Book a new appointment"""
+def book_appointment(appt: AppointmentCreate):
+    """Book a new appointment. The datetime must be a free slot of the doctor's availability."""
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
-        
+
+    start = parse_datetime(appt.datetime)
     try:
-        doc_ref = db.collection("appointments").document()
-        new_appt = appt.dict()
-        new_appt["id"] = doc_ref.id
-        new_appt["status"] = "scheduled"
-        
-        doc_ref.set(new_appt)
+        minutes = slot_engine.validate(appt.doctor_id, start)
+    except SlotUnavailableError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    new_appt = appt.dict()
+    new_appt["id"] = new_id()
+    new_appt["datetime"] = start.isoformat()
+    new_appt["duration_minutes"] = minutes
+    new_appt["status"] = "scheduled"
+
+    try:
+        # Atomic claim on the slot: a concurrent booking of the same slot gets 409
+        slot_engine.reserve(appt.doctor_id, start, new_appt["id"], minutes)
+    except SlotConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        print(f"Error booking appointment: {e}")
+        raise HTTPException(status_code=500, detail="Failed to book appointment")
+
+    try:
+        db.set("appointments", new_appt["id"], new_appt)
         return new_appt
     except Exception as e:
         print(f"Error booking appointment: {e}")
+        slot_engine.release(appt.doctor_id, start, minutes)
         raise HTTPException(status_code=500, detail="Failed to book appointment")
 
 @app.get("/appointments")
-async def list_appointments(doctor_id: Optional[str] = None, patient_id: Optional[str] = None):
-    """List appointments filterable by doctor or patient"""
+def list_appointments(
+    doctor_id: Optional[str] = None,
+    patient_id: Optional[str] = None,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    status: Optional[str] = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+    group_by: Optional[str] = Query(None, pattern="^day$"),
+):
+    """
+    List appointments filterable by doctor or patient, datetime range [from, to) and status,
+    in datetime order. Pages are cursor-based: when more remain, the X-Next-Cursor header
+    (group_by=day: `next_cursor`) holds the `start_after` value for the next page.
+    group_by=day buckets the page into calendar days.
+    """
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
-        
+
+    # Every combination here is backed by a composite index (infrastructure/firestore.tf)
+    where = []
+    if doctor_id:
+        where.append(("doctor_id", "==", doctor_id))
+    if patient_id:
+        where.append(("patient_id", "==", patient_id))
+    if status:
+        where.append(("status", "==", status))
+    if from_:
+        where.append(("datetime", ">=", parse_datetime(from_).isoformat()))
+    if to:
+        where.append(("datetime", "<", parse_datetime(to).isoformat()))
+
     try:
-        ref = db.collection("appointments")
-        if doctor_id:
-            ref = ref.where("doctor_id", "==", doctor_id)
-        if patient_id:
-            ref = ref.where("patient_id", "==", patient_id)
-            
-        docs = ref.stream()
-        return [doc.to_dict() for doc in docs]
+        docs = db.query("appointments", where=where, order_by="datetime", limit=page_size, start_after=start_after)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Unknown start_after cursor")
     except Exception as e:
         print(f"Error listing appointments: {e}")
         raise HTTPException(status_code=500, detail="Failed to list appointments")
+
+    page = [doc.data for doc in docs]
+    next_cursor = docs[-1].id if len(docs) == page_size else None
+
+    if group_by == "day":
+        days = {}
+        for appt in page:
+            days.setdefault(appt["datetime"][:10], []).append(appt)
+        return {
+            "days": [{"date": day, "appointments": items} for day, items in days.items()],
+            "next_cursor": next_cursor,
+        }
+    return JSONResponse(page, headers={"X-Next-Cursor": next_cursor} if next_cursor else {})
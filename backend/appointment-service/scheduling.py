@@ -0,0 +1,294 @@
+"""
+Slot computation and conflict detection for appointments.
+
+Weekly availability ("Monday 09:00-17:00", `slot_minutes` long slots) is
+expanded into bookable slots on the fly. Booked appointments are kept in an
+IntervalIndex per doctor per day (sorted, non-overlapping intervals searched
+with bisect), so checking a slot or walking a day's free slots never touches
+the store.
+
+next_free_slots() answers "the next N free slots across an organization" with
+one availability query plus one appointments query per 30 doctors, then a
+k-way merge over every doctor's slot stream.
+
+Double bookings are rejected atomically by the store: every booking first
+create()s one lock document per LOCK_BLOCK_MINUTES block of the doctor's day
+that its [start, end) touches, and create() fails if another booking holds
+the block, across all instances (a booking losing any block releases the ones
+it got). Overlapping intervals always share a block, whatever their starts and
+lengths. Slots not aligned to the block size may also share a block with an
+adjacent, non-overlapping slot and be refused (never double-booked). Booked
+intervals are cached for `ttl` seconds; bookings made on this instance update
+the cache immediately, others show up after the TTL (the locks still stop
+them from double-booking).
+
+All times are naive clinic-local datetimes, like the stored ISO strings.
+"""
+import bisect
+import datetime
+import heapq
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage import AlreadyExistsError
+
+AVAILABILITY_COLLECTION = "availabilities"
+APPOINTMENT_COLLECTION = "appointments"
+LOCK_COLLECTION = "slot_locks"
+DEFAULT_SLOT_MINUTES = 30
+IN_QUERY_LIMIT = 30  # Firestore caps "in" filters at 30 values
+LOCK_BLOCK_MINUTES = 5  # Lock granularity; slot starts and lengths are usually multiples of it
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+Interval = Tuple[int, int]  # [start, end) in minutes since midnight
+
+
+class SlotUnavailableError(Exception):
+    pass
+
+
+class SlotConflictError(Exception):
+    pass
+
+
+def parse_minutes(value: str) -> int:
+    """'09:30' -> 570."""
+    hours, minutes = value.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def lock_id(doctor_id: str, start: datetime.datetime) -> str:
+    return f"{doctor_id}_{start:%Y%m%dT%H%M}"
+
+
+def lock_ids(doctor_id: str, start: datetime.datetime, minutes: int) -> List[str]:
+    """Ids of the LOCK_BLOCK_MINUTES blocks touched by [start, start + minutes)."""
+    day = datetime.datetime.combine(start.date(), datetime.time())
+    begin = start.hour * 60 + start.minute
+    first, last = begin // LOCK_BLOCK_MINUTES, (begin + max(minutes, 1) - 1) // LOCK_BLOCK_MINUTES
+    return [lock_id(doctor_id, day + datetime.timedelta(minutes=block * LOCK_BLOCK_MINUTES))
+            for block in range(first, last + 1)]
+
+
+class IntervalIndex:
+    """Sorted, non-overlapping [start, end) intervals of one doctor on one day."""
+
+    def __init__(self, intervals: Iterable[Interval] = ()):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for start, end in sorted(intervals):
+            self.add(start, end)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        # The only candidates: the last interval starting before `end`
+        i = bisect.bisect_left(self._starts, end) - 1
+        return i >= 0 and self._ends[i] > start
+
+    def add(self, start: int, end: int):
+        i = bisect.bisect_left(self._starts, start)
+        # Merge with touching/overlapping neighbours (legacy data may overlap)
+        while i > 0 and self._ends[i - 1] >= start:
+            i -= 1
+            start, end = min(start, self._starts[i]), max(end, self._ends[i])
+            del self._starts[i], self._ends[i]
+        while i < len(self._starts) and self._starts[i] <= end:
+            end = max(end, self._ends[i])
+            del self._starts[i], self._ends[i]
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+    def __len__(self):
+        return len(self._starts)
+
+
+class SlotEngine:
+    def __init__(self, db, ttl: float = 15.0, horizon_days: int = 14, availability_ttl: float = 60.0):
+        self.db = db
+        self.ttl = ttl
+        self.horizon_days = horizon_days
+        self.availability_ttl = availability_ttl
+        self._org_cache: Dict[str, Tuple[Dict[str, Dict[int, List[Tuple[int, int, int]]]], float]] = {}
+        self._booked: Dict[Tuple[str, datetime.date], Tuple[IntervalIndex, float]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"searches": 0, "bookings": 0, "conflicts": 0, "day_loads": 0}
+
+    # --- Availability ---
+    @staticmethod
+    def _windows(availability: List[dict]) -> Dict[int, List[Tuple[int, int, int]]]:
+        """weekday -> [(start, end, slot_minutes)] from availability documents."""
+        windows: Dict[int, List[Tuple[int, int, int]]] = {}
+        for a in availability:
+            if a.get("day_of_week") not in WEEKDAYS:
+                continue
+            start, end = parse_minutes(a["start_time"]), parse_minutes(a["end_time"])
+            step = int(a.get("slot_minutes") or DEFAULT_SLOT_MINUTES)
+            windows.setdefault(WEEKDAYS.index(a["day_of_week"]), []).append((start, end, step))
+        return windows
+
+    def _doctor_windows(self, doctor_id: str) -> Dict[int, List[Tuple[int, int, int]]]:
+        docs = self.db.query(AVAILABILITY_COLLECTION, where=[("doctor_id", "==", doctor_id)])
+        return self._windows([d.data for d in docs])
+
+    def _org_windows(self, organization_id: str) -> Dict[str, Dict[int, List[Tuple[int, int, int]]]]:
+        """Availability of every doctor in the organization (cached: it changes rarely)."""
+        cached = self._org_cache.get(organization_id)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        docs = self.db.query(AVAILABILITY_COLLECTION, where=[("organization_id", "==", organization_id)])
+        by_doctor: Dict[str, List[dict]] = {}
+        for d in docs:
+            by_doctor.setdefault(d.data["doctor_id"], []).append(d.data)
+        windows = {doctor: self._windows(items) for doctor, items in by_doctor.items()}
+        self._org_cache[organization_id] = (windows, time.monotonic() + self.availability_ttl)
+        return windows
+
+    def availability_changed(self, organization_id: Optional[str]):
+        if organization_id:
+            self._org_cache.pop(organization_id, None)
+
+    # --- Booked intervals ---
+    def _load(self, doctor_ids: List[str], first: datetime.date, last: datetime.date):
+        """Loads (or refreshes) the interval indexes of these doctors for [first, last]."""
+        now = time.monotonic()
+        days = [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+        with self._lock:
+            stale = self._stale(doctor_ids, days, now)
+        if not stale:
+            return
+
+        intervals: Dict[Tuple[str, datetime.date], List[Interval]] = {}
+        for i in range(0, len(stale), IN_QUERY_LIMIT):
+            docs = self.db.query(APPOINTMENT_COLLECTION, where=[
+                ("doctor_id", "in", stale[i:i + IN_QUERY_LIMIT]),
+                ("datetime", ">=", first.isoformat()),
+                ("datetime", "<", (last + datetime.timedelta(days=1)).isoformat()),
+            ])
+            for doc in docs:
+                if doc.data.get("status") == "cancelled":
+                    continue
+                start = datetime.datetime.fromisoformat(doc.data["datetime"])
+                minutes = int(doc.data.get("duration_minutes") or DEFAULT_SLOT_MINUTES)
+                begin = start.hour * 60 + start.minute
+                intervals.setdefault((doc.data["doctor_id"], start.date()), []).append((begin, begin + minutes))
+
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for doctor in stale:
+                for day in days:
+                    self._booked[(doctor, day)] = (IntervalIndex(intervals.get((doctor, day), ())), expires)
+            self.stats["day_loads"] += len(stale) * len(days)
+            self._evict(datetime.date.today())
+
+    def _stale(self, doctor_ids: List[str], days: List[datetime.date], now: float) -> List[str]:
+        stale = set()
+        for doctor in doctor_ids:
+            for day in days:
+                entry = self._booked.get((doctor, day))
+                if entry is None or entry[1] <= now:
+                    stale.add(doctor)
+                    break
+        return sorted(stale)
+
+    def _evict(self, today: datetime.date):
+        for key in [k for k in self._booked if k[1] < today]:
+            del self._booked[key]
+
+    def _index(self, doctor_id: str, day: datetime.date) -> IntervalIndex:
+        with self._lock:
+            entry = self._booked.get((doctor_id, day))
+        return entry[0] if entry else IntervalIndex()
+
+    # --- Slots ---
+    def _doctor_slots(self, doctor_id: str, windows: Dict[int, List[Tuple[int, int, int]]],
+                      after: datetime.datetime, days: int) -> Iterator[Tuple[datetime.datetime, str, int]]:
+        """Free slots of one doctor in time order: (start, doctor_id, slot_minutes)."""
+        for offset in range(days):
+            day = after.date() + datetime.timedelta(days=offset)
+            index = self._index(doctor_id, day)
+            midnight = datetime.datetime.combine(day, datetime.time())
+            for start, end, step in sorted(windows.get(day.weekday(), ())):
+                for minute in range(start, end - step + 1, step):
+                    slot = midnight + datetime.timedelta(minutes=minute)
+                    if slot >= after and not index.overlaps(minute, minute + step):
+                        yield slot, doctor_id, step
+
+    def free_slots(self, doctor_id: str, after: datetime.datetime, days: int = 1) -> List[dict]:
+        windows = self._doctor_windows(doctor_id)
+        self._load([doctor_id], after.date(), after.date() + datetime.timedelta(days=days - 1))
+        return [_slot(*s) for s in self._doctor_slots(doctor_id, windows, after, days)]
+
+    def next_free_slots(self, organization_id: str, after: datetime.datetime, n: int = 10,
+                        days: Optional[int] = None) -> List[dict]:
+        """The earliest `n` free slots across every doctor of the organization."""
+        days = days or self.horizon_days
+        self.stats["searches"] += 1
+        windows = self._org_windows(organization_id)
+        if not windows:
+            return []
+        self._load(list(windows), after.date(), after.date() + datetime.timedelta(days=days - 1))
+        streams = [self._doctor_slots(doctor, w, after, days) for doctor, w in windows.items()]
+        merged = heapq.merge(*streams)
+        return [_slot(*s) for _, s in zip(range(n), merged)]
+
+    # --- Booking ---
+    def validate(self, doctor_id: str, start: datetime.datetime) -> int:
+        """Slot length if `start` is a slot of the doctor's availability; raises SlotUnavailableError."""
+        doc = self.db.get(AVAILABILITY_COLLECTION, f"{doctor_id}_{WEEKDAYS[start.weekday()]}")
+        minute = start.hour * 60 + start.minute
+        if doc is not None and not start.second and not start.microsecond:
+            for begin, end, step in self._windows([doc]).get(start.weekday(), ()):
+                if begin <= minute <= end - step and (minute - begin) % step == 0:
+                    return step
+        raise SlotUnavailableError(f"{start.isoformat()} is not an available slot for {doctor_id}")
+
+    def reserve(self, doctor_id: str, start: datetime.datetime, appointment_id: str, minutes: int):
+        """Claims the slot for an appointment; raises SlotConflictError if it is taken."""
+        # Appointments booked before slot locks existed have no lock document
+        self._load([doctor_id], start.date(), start.date())
+        begin = start.hour * 60 + start.minute
+        if self._index(doctor_id, start.date()).overlaps(begin, begin + minutes):
+            self.stats["conflicts"] += 1
+            raise SlotConflictError(f"{start.isoformat()} is already booked for {doctor_id}")
+        held = []
+        try:
+            for block in lock_ids(doctor_id, start, minutes):
+                self.db.create(LOCK_COLLECTION, block,
+                               {"doctor_id": doctor_id, "datetime": start.isoformat(), "appointment_id": appointment_id})
+                held.append(block)
+        except AlreadyExistsError:
+            for block in held:
+                self.db.delete(LOCK_COLLECTION, block)
+            self.stats["conflicts"] += 1
+            raise SlotConflictError(f"{start.isoformat()} is already booked for {doctor_id}")
+        except Exception:
+            for block in held:
+                self.db.delete(LOCK_COLLECTION, block)
+            raise
+        self.stats["bookings"] += 1
+        self._mark(doctor_id, start, minutes)
+
+    def release(self, doctor_id: str, start: datetime.datetime, minutes: int):
+        """Frees the slot locks (booking failed after reserve, or cancellation)."""
+        for block in lock_ids(doctor_id, start, minutes):
+            self.db.delete(LOCK_COLLECTION, block)
+        with self._lock:
+            self._booked.pop((doctor_id, start.date()), None)  # Reloaded on next use
+
+    def _mark(self, doctor_id: str, start: datetime.datetime, minutes: int):
+        with self._lock:
+            entry = self._booked.get((doctor_id, start.date()))
+            if entry is not None:
+                begin = start.hour * 60 + start.minute
+                entry[0].add(begin, begin + minutes)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "cached_days": len(self._booked)}
+
+
+def _slot(start: datetime.datetime, doctor_id: str, minutes: int) -> dict:
+    return {
+        "doctor_id": doctor_id,
+        "start": start.isoformat(),
+        "end": (start + datetime.timedelta(minutes=minutes)).isoformat(),
+    }
@@ -0,0 +1,92 @@
+"""
+Password hashing benchmarks for auth-service (no database, no network).
+
+Usage:
+    python benchmarks.py cost      # ms per bcrypt hash at each work factor
+    python benchmarks.py logins    # sustained logins/s through the hashing pool
+    BCRYPT_ROUNDS=10 python benchmarks.py logins
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import bcrypt
+
+from hashing import PasswordHasher, DEFAULT_ROUNDS
+
+
+def bench_cost(rounds=(10, 11, 12, 13), samples: int = 5):
+    print(f"{'rounds':>6} {'ms/hash':>9}")
+    for cost in rounds:
+        salt = bcrypt.gensalt(cost)
+        start = time.perf_counter()
+        for _ in range(samples):
+            bcrypt.hashpw(b"correct horse battery staple", salt)
+        print(f"{cost:>6} {(time.perf_counter() - start) / samples * 1000:>9.1f}")
+
+
+async def _login_storm(hasher: PasswordHasher, stored: str, logins: int, concurrency: int):
+    """Runs `logins` verifications from `concurrency` clients; returns (elapsed, rejected, max loop lag)."""
+    rejected = 0
+    max_lag = 0.0
+    done = asyncio.Event()
+
+    async def watch_loop():
+        # If hashing blocked the event loop, these wakeups would arrive late
+        nonlocal max_lag
+        while not done.is_set():
+            expected = time.perf_counter() + 0.01
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - expected)
+
+    queue = asyncio.Queue()
+    for _ in range(logins):
+        queue.put_nowait(None)
+
+    async def client():
+        nonlocal rejected
+        while not queue.empty():
+            queue.get_nowait()
+            try:
+                await hasher.verify("correct horse battery staple", stored)
+            except Exception:
+                rejected += 1
+
+    watcher = asyncio.create_task(watch_loop())
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await watcher
+    return elapsed, rejected, max_lag
+
+
+def bench_logins(logins: int = 64, concurrency: int = 32):
+    rounds = int(os.getenv("BCRYPT_ROUNDS", str(DEFAULT_ROUNDS)))
+    cores = os.cpu_count() or 1
+    stored = bcrypt.hashpw(b"correct horse battery staple", bcrypt.gensalt(rounds)).decode("utf-8")
+
+    print(f"bcrypt rounds={rounds}, {cores} cores, {logins} logins from {concurrency} concurrent clients")
+    print(f"{'workers':>7} {'logins/s':>9} {'rejected':>9} {'loop lag ms':>12}")
+    for workers in sorted({1, max(1, cores // 2), cores, cores * 2}):
+        hasher = PasswordHasher(rounds, workers=workers, max_pending=logins)
+        elapsed, rejected, lag = asyncio.run(_login_storm(hasher, stored, logins, concurrency))
+        hasher.shutdown()
+        print(f"{workers:>7} {(logins - rejected) / elapsed:>9.1f} {rejected:>9} {lag * 1000:>12.1f}")
+
+
+BENCHMARKS = {
+    "cost": bench_cost,
+    "logins": bench_logins,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MedX auth-service benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS) + ["all"])
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        if args.name in (name, "all"):
+            print(f"\n=== {name} ===")
+            bench()
@@ -0,0 +1,109 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is deliberately slow (~100-300ms of CPU per call at cost 12). The
+hasher runs it on a dedicated, bounded thread pool (bcrypt releases the GIL,
+so threads hash in parallel across cores) and refuses new work once
+`max_pending` calls are queued, so a login storm gets fast 503s instead of
+an ever-growing backlog.
+
+The work factor comes from BCRYPT_ROUNDS; hashes made with a different cost
+are reported by needs_rehash() so login can upgrade them transparently.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+
+
+class HasherBusyError(Exception):
+    pass
+
+
+def hash_cost(hashed: str) -> Optional[int]:
+    """Cost factor of a "$2b$12$..." hash, or None if unparseable."""
+    parts = hashed.split("$")
+    try:
+        return int(parts[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = DEFAULT_ROUNDS, workers: Optional[int] = None, max_pending: Optional[int] = None):
+        self.rounds = rounds
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 8
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.stats = {"hashes": 0, "verifies": 0, "rejected": 0, "busy_seconds": 0.0}
+
+    def _timed(self, kind: str, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.stats[kind] += 1
+                self.stats["busy_seconds"] += time.perf_counter() - started
+
+    async def _submit(self, kind: str, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise HasherBusyError("Password hashing queue is full")
+            self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._timed, kind, fn, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    # --- Blocking primitives (run on the pool) ---
+    def hash_sync(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self.rounds)).decode("utf-8")
+
+    @staticmethod
+    def verify_sync(password: str, hashed: str) -> bool:
+        try:
+            return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+        except ValueError:  # Malformed stored hash
+            return False
+
+    # --- Async API ---
+    async def hash(self, password: str) -> str:
+        return await self._submit("hashes", self.hash_sync, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._submit("verifies", self.verify_sync, password, hashed)
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return hash_cost(hashed) != self.rounds
+
+    def snapshot(self) -> dict:
+        calls = self.stats["hashes"] + self.stats["verifies"]
+        return {
+            **{k: v for k, v in self.stats.items() if k != "busy_seconds"},
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "avg_ms": round(self.stats["busy_seconds"] / calls * 1000, 1) if calls else 0.0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def hasher_from_env() -> PasswordHasher:
+    workers = int(os.getenv("HASH_WORKERS", "0")) or None
+    max_pending = int(os.getenv("HASH_MAX_PENDING", "0")) or None
+    return PasswordHasher(int(os.getenv("BCRYPT_ROUNDS", str(DEFAULT_ROUNDS))), workers, max_pending)
@@ -1,13 +1,15 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, status, BackgroundTasks
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-import bcrypt
 import os
-from google.cloud import firestore
+from storage import store_from_env, new_id, AlreadyExistsError
+from principals import PrincipalCache
+from identity import principal_from_header
+from hashing import hasher_from_env, HasherBusyError
 
 # --- Configuration ---
 SECRET_KEY = os.getenv("SECRET_KEY", "YOUR_SUPER_SECRET_KEY_CHANGE_THIS_IN_PROD") 
@@ -28,16 +30,25 @@ app.add_middleware(
 )
 
 # --- Database Client ---
-try:
-    db = firestore.Client()
-    print("✅ Firestore Client Initialized")
-except Exception as e:
-    print(f"❌ Firestore Init Failed: {e}")
-    db = None
+# Firestore by default; STORAGE_BACKEND=local for the embedded store (see storage.py)
+db = store_from_env()
 
 # --- Security ---
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# bcrypt runs on a bounded pool off the event loop (BCRYPT_ROUNDS / HASH_WORKERS / HASH_MAX_PENDING)
+hasher = hasher_from_env()
+
+# Verified users per token (see principals.py): repeat requests skip the JWT decode and the DB read
+principal_cache = PrincipalCache(
+    max_entries=int(os.getenv("AUTH_PRINCIPAL_CACHE_SIZE", "10000")),
+    max_ttl=float(os.getenv("AUTH_PRINCIPAL_CACHE_TTL", "300")),
+)
+
+# Stateless mode: endpoints that only need identity/role/org trust the signed token claims
+# and never touch the database. Trade-off: role or org changes apply only to new tokens.
+AUTH_STATELESS = os.getenv("AUTH_STATELESS", "false").lower() == "true"
+
 # --- Models ---
 class UserBase(BaseModel):
     email: str
@@ -59,16 +70,44 @@ class Token(BaseModel):
 class UserResponse(UserBase):
     pass
 
+@app.on_event("shutdown")
+def shutdown_hasher():
+    hasher.shutdown()
+
 # --- Helper Functions ---
-def verify_password(plain_password, hashed_password):
-    return bcrypt.checkpw(
-        plain_password.encode('utf-8'), 
-        hashed_password.encode('utf-8')
-    )
+_busy_exception = HTTPException(
+    status_code=503, detail="Authentication busy, retry shortly", headers={"Retry-After": "1"}
+)
+
+async def verify_password(plain_password, hashed_password):
+    try:
+        return await hasher.verify(plain_password, hashed_password)
+    except HasherBusyError:
+        raise _busy_exception
 
-def get_password_hash(password):
-    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    return hashed.decode('utf-8')
+async def get_password_hash(password):
+    try:
+        return await hasher.hash(password)
+    except HasherBusyError:
+        raise _busy_exception
+
+async def _rehash_password(email: str, password: str):
+    """Upgrades a hash made with an old BCRYPT_ROUNDS; runs after the login response."""
+    try:
+        hashed = await hasher.hash(password)
+        db.update(COLLECTION_NAME, email, {"hashed_password": hashed})
+        principal_cache.invalidate(email)
+    except Exception as e:
+        print(f"Rehash Error: {e}")
+
+def token_claims(user: dict) -> dict:
+    """Signed claims carried by every access token (used by stateless mode)."""
+    return {
+        "sub": user["email"],
+        "role": user.get("role"),
+        "organization_id": user.get("organization_id"),
+        "name": user.get("full_name"),
+    }
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -80,36 +119,65 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def decode_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
     except JWTError:
         raise credentials_exception
-        
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
+
+async def get_current_user(token: str = Depends(oauth2_scheme), x_medx_principal: Optional[str] = Header(None)):
+    """Full user profile. Cached per token until the token expires (or the profile changes)."""
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return cached
+
+    # Already verified at the gateway: no need to decode the JWT again
+    payload = principal_from_header(x_medx_principal) or decode_token(token)
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
-    doc_ref = db.collection(COLLECTION_NAME).document(email)
-    doc = doc_ref.get()
-    
-    if not doc.exists:
+    user = db.get(COLLECTION_NAME, payload["sub"])
+    if user is None:
         raise credentials_exception
-        
-    return doc.to_dict()
+
+    principal_cache.put(token, user, payload.get("exp"))
+    return user
+
+async def get_current_principal(token: str = Depends(oauth2_scheme), x_medx_principal: Optional[str] = Header(None)):
+    """
+    Identity, role and organization of the caller. In stateless mode this comes from the
+    token claims alone; otherwise it is the (cached) user profile.
+    """
+    if AUTH_STATELESS:
+        payload = principal_from_header(x_medx_principal) or decode_token(token)
+        # Tokens minted before claims were added still need a lookup
+        if "role" in payload and "organization_id" in payload:
+            return {
+                "email": payload["sub"],
+                "role": payload["role"],
+                "organization_id": payload["organization_id"],
+                "full_name": payload.get("name"),
+            }
+    return await get_current_user(token, x_medx_principal)
 
 # --- Endpoints ---
 
 @app.get("/")
 async def root():
-    return {"status": "Auth Service Running (Firestore)"}
+    return {"status": f"Auth Service Running ({os.getenv('STORAGE_BACKEND', 'firestore')})"}
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {"principals": principal_cache.snapshot(), "stateless": AUTH_STATELESS, "hasher": hasher.snapshot()}
 
 @app.get("/me", response_model=UserResponse)
 async def read_users_me(current_user: dict = Depends(get_current_user)):
@@ -123,28 +191,29 @@ async def register(user: UserCreate):
 
     try:
         # 1. Check if user exists (Use email as Document ID)
-        doc_ref = db.collection(COLLECTION_NAME).document(user.email)
-        if doc_ref.get().exists:
+        if db.get(COLLECTION_NAME, user.email) is not None:
              raise HTTPException(
                 status_code=400, 
                 detail="Email already registered"
             )
 
         # 2. Hash Password
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash(user.password)
 
-        # 3. Create User in Firestore
+        # 3. Create User (create() fails if a concurrent registration got there first)
         user_data = user.dict()
         user_data["hashed_password"] = hashed_password
         user_data["created_at"] = datetime.utcnow().isoformat()
         del user_data["password"] # Don't store plain password
         
-        doc_ref.set(user_data)
+        try:
+            db.create(COLLECTION_NAME, user.email, user_data)
+        except AlreadyExistsError:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        principal_cache.invalidate(user.email)
         
         # 4. Generate Token
-        access_token = create_access_token(
-            data={"sub": user.email, "role": user.role}
-        )
+        access_token = create_access_token(data=token_claims(user_data))
         return {"access_token": access_token, "token_type": "bearer"}
     
     except HTTPException as he:
@@ -154,60 +223,54 @@ async def register(user: UserCreate):
         raise HTTPException(status_code=500, detail="Registration failed")
 
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login_for_access_token(background_tasks: BackgroundTasks, form_data: OAuth2PasswordRequestForm = Depends()):
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
     try:
-        # 1. Fetch user from Firestore
-        doc_ref = db.collection(COLLECTION_NAME).document(form_data.username)
-        doc = doc_ref.get()
+        # 1. Fetch user
+        user_data = db.get(COLLECTION_NAME, form_data.username)
         
-        if not doc.exists:
+        if user_data is None:
              raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
-        
-        user_data = doc.to_dict()
 
         # 2. Verify Password
-        if not verify_password(form_data.password, user_data['hashed_password']):
+        if not await verify_password(form_data.password, user_data['hashed_password']):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password",
                 headers={"WWW-Authenticate": "Bearer"},
             )
+        if hasher.needs_rehash(user_data['hashed_password']):
+            background_tasks.add_task(_rehash_password, user_data['email'], form_data.password)
             
         # 3. Generate Token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
-            data={"sub": user_data['email'], "role": user_data['role']}, 
+            data=token_claims(user_data), 
             expires_delta=access_token_expires
         )
         return {"access_token": access_token, "token_type": "bearer"}
 
+    except HTTPException as he:
+        raise he
     except Exception as e:
         print(f"Login Error: {e}")
         raise HTTPException(status_code=500, detail="Login failed")
 
 @app.get("/users/doctors", response_model=list[UserResponse])
-async def get_doctors(organization_id: str, current_user: dict = Depends(get_current_user)):
+async def get_doctors(organization_id: str, current_user: dict = Depends(get_current_principal)):
     """Get all doctors for a specific organization"""
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
         
     try:
-        users_ref = db.collection(COLLECTION_NAME)
-        query = users_ref.where("organization_id", "==", organization_id).where("role", "==", "doctor")
-        docs = query.stream()
-        
-        doctors = []
-        for doc in docs:
-            doctors.append(doc.to_dict())
-            
-        return doctors
+        docs = db.query(COLLECTION_NAME, where=[("organization_id", "==", organization_id), ("role", "==", "doctor")])
+        return [doc.data for doc in docs]
     except Exception as e:
         print(f"Error fetching doctors: {e}")
         raise HTTPException(status_code=500, detail="Failed to fetch doctors")
@@ -227,34 +290,40 @@ async def register_organization(org: OrganizationRegister):
 
     try:
         # 1. Check if admin email exists
-        user_ref = db.collection(COLLECTION_NAME).document(org.admin_email)
-        if user_ref.get().exists:
+        if db.get(COLLECTION_NAME, org.admin_email) is not None:
              raise HTTPException(status_code=400, detail="Admin email already registered")
 
-        # 2. Create Organization
-        org_ref = db.collection("organizations").document()
+        # 2. Hash first: if hashing is saturated, nothing has been written yet
+        hashed_password = await get_password_hash(org.admin_password)
+
+        # 3. Create Organization
+        org_id = new_id()
         org_data = {
-            "id": org_ref.id,
+            "id": org_id,
             "name": org.org_name,
             "address": org.org_address,
             "verified": False, # Requires manual verification
             "created_at": datetime.utcnow().isoformat()
         }
-        org_ref.set(org_data)
+        db.set("organizations", org_id, org_data)
 
-        # 3. Create Admin User
-        hashed_password = get_password_hash(org.admin_password)
+        # 4. Create Admin User
         admin_user_data = {
             "email": org.admin_email,
             "full_name": org.admin_name,
             "hashed_password": hashed_password,
             "role": "organization_admin",
-            "organization_id": org_ref.id,
+            "organization_id": org_id,
             "created_at": datetime.utcnow().isoformat()
         }
-        user_ref.set(admin_user_data)
+        try:
+            db.create(COLLECTION_NAME, org.admin_email, admin_user_data)
+        except AlreadyExistsError:
+            db.delete("organizations", org_id)
+            raise HTTPException(status_code=400, detail="Admin email already registered")
+        principal_cache.invalidate(org.admin_email)
         
-        return {"message": "Organization registered successfully. Pending verification.", "org_id": org_ref.id}
+        return {"message": "Organization registered successfully. Pending verification.", "org_id": org_id}
     
     except HTTPException as he:
         raise he
@@ -0,0 +1,79 @@
+"""
+Verified-principal cache for get_current_user.
+
+Keyed by a hash of the bearer token (the token itself is never stored).
+Entries live until the token expires or max_ttl passes, whichever is first,
+and every entry for an email is dropped when that user's profile changes.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+# Never cached or returned from the cache
+PRIVATE_FIELDS = ("hashed_password",)
+
+
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class PrincipalCache:
+    def __init__(self, max_entries: int = 10000, max_ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[str, Tuple[dict, float]]" = OrderedDict()
+        self._by_email: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, token: str) -> Optional[dict]:
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._drop(key, entry[0].get("email"))
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return dict(entry[0])
+
+    def put(self, token: str, user: dict, token_exp: Optional[float] = None):
+        expires_at = time.time() + self.max_ttl
+        if token_exp:
+            expires_at = min(expires_at, token_exp)
+        principal = {k: v for k, v in user.items() if k not in PRIVATE_FIELDS}
+        key = token_key(token)
+        email = principal.get("email")
+        with self._lock:
+            self._entries[key] = (principal, expires_at)
+            self._entries.move_to_end(key)
+            if email:
+                self._by_email.setdefault(email, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest, (old_principal, _) = self._entries.popitem(last=False)
+                self._discard_email_key(old_principal.get("email"), oldest)
+
+    def invalidate(self, email: str):
+        """Call after any change to the user's profile."""
+        with self._lock:
+            for key in self._by_email.pop(email, set()):
+                self._entries.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    def _drop(self, key: str, email: Optional[str]):
+        self._entries.pop(key, None)
+        self._discard_email_key(email, key)
+
+    def _discard_email_key(self, email: Optional[str], key: str):
+        keys = self._by_email.get(email)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_email[email]
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "entries": len(self._entries), "max_entries": self.max_entries}
@@ -0,0 +1,116 @@
+"""
+Micro-benchmarks for the clinical-service hot paths (no network, no Gemini).
+
+Usage:
+    python benchmarks.py interactions
+    python benchmarks.py extraction
+"""
+import argparse
+import random
+import time
+
+from extraction import MedicationExtractor, DEFAULT_LEXICON_PATH
+from interactions import load_engine
+
+
+def _timeit(fn, iterations: int) -> float:
+    """Returns mean microseconds per call."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_interactions(iterations: int = 2000, unknown_rate: float = 0.02, seed: int = 42):
+    engine = load_engine()
+    rng = random.Random(seed)
+
+    # Mix generic names, brand aliases and dosage noise the way users type them
+    vocabulary = sorted(engine.known) + sorted(engine.aliases)
+    noise = ["", " 500mg", " 10 mg", " tablet", " 81mg"]
+
+    def random_med():
+        if rng.random() < unknown_rate:
+            return f"unlisted-drug-{rng.randint(0, 10_000)}"
+        return rng.choice(vocabulary).title() + rng.choice(noise)
+
+    print(f"Rule store: {len(engine.known)} drugs, {engine.pair_count} indexed pairs")
+    print(f"{'meds':>5} {'check us':>10} {'regimen us':>11} {'hits/regimen':>13} {'llm fallback':>13}")
+
+    for size in (1, 2, 5, 10, 20, 30, 40, 50):
+        regimens = [[random_med() for _ in range(size)] for _ in range(200)]
+
+        hit_total = 0
+        fallbacks = 0
+        for meds in regimens:
+            hits, unknown = engine.check(meds[0], meds[1:])
+            hit_total += len(engine.check_regimen(meds)[0])
+            # Mirrors check_for_interactions: the LLM is only asked when no rule fired and a drug is unknown
+            if not hits and unknown:
+                fallbacks += 1
+
+        cycle = iter(regimens * (iterations // len(regimens) + 1))
+        check_us = _timeit(lambda: (lambda m: engine.check(m[0], m[1:]))(next(cycle)), iterations)
+        cycle = iter(regimens * (iterations // len(regimens) + 1))
+        regimen_us = _timeit(lambda: engine.check_regimen(next(cycle)), iterations)
+
+        print(f"{size:>5} {check_us:>10.1f} {regimen_us:>11.1f} {hit_total / len(regimens):>13.2f} "
+              f"{fallbacks / len(regimens):>12.1%}")
+
+
+def bench_extraction(sentences: int = 50_000, lexicon_size: int = 100_000, seed: int = 7):
+    rng = random.Random(seed)
+
+    with open(DEFAULT_LEXICON_PATH, "r", encoding="utf-8") as f:
+        base_terms = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    # Pad the real lexicon with synthetic one- and two-word names up to lexicon_size
+    syllables = ["ta", "zo", "mi", "lex", "pra", "vor", "cin", "dol", "fen", "mab", "tin", "xa", "ril", "pam"]
+    terms = {t.lower(): t for t in base_terms}
+    while len(terms) < lexicon_size:
+        name = "".join(rng.choice(syllables) for _ in range(rng.randint(3, 6))).title()
+        term = name if rng.random() < 0.8 else f"{name} {rng.choice(['Er', 'Xr', 'Forte'])}"
+        terms.setdefault(term.lower(), term)
+    terms = list(terms.values())
+
+    start = time.perf_counter()
+    extractor = MedicationExtractor(terms)
+    build_s = time.perf_counter() - start
+
+    templates = [
+        "Take {drug} {dose}mg every morning",
+        "{drug} {dose} mg at {hour}pm",
+        "give {drug} {dose}ml at bedtime with food",
+        "Patient should use {drug} twice daily after lunch",
+        "{drug} {dose} units at {hour}:30 am",
+    ]
+    corpus = [
+        rng.choice(templates).format(drug=rng.choice(terms), dose=rng.choice([5, 10, 81, 250, 500]), hour=rng.randint(1, 12))
+        for _ in range(sentences)
+    ]
+
+    start = time.perf_counter()
+    results = extractor.extract_batch(corpus)
+    elapsed = time.perf_counter() - start
+
+    named = sum(1 for r in results if r.name)
+    print(f"Lexicon: {extractor.size} terms (built in {build_s:.2f}s)")
+    print(f"Extracted {sentences} sentences in {elapsed:.2f}s -> {sentences / elapsed:,.0f} sentences/s")
+    print(f"Name found in {named / sentences:.1%}, dosage in {sum(1 for r in results if r.dosage) / sentences:.1%}, "
+          f"time in {sum(1 for r in results if r.time) / sentences:.1%}")
+
+
+BENCHMARKS = {
+    "interactions": bench_interactions,
+    "extraction": bench_extraction,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MedX clinical-service benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS) + ["all"])
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        if args.name in (name, "all"):
+            print(f"\n=== {name} ===")
+            bench()
@@ -0,0 +1,155 @@
+"""
+Per-session chat history cache.
+
+Warm sessions are served from memory (LRU bound + idle eviction), so a chat
+turn needs no Firestore read. New messages are written through to the store.
+
+Prompt size stays bounded: once a session holds `recent_messages +
+summarize_batch` unsummarized messages, everything but the newest
+`recent_messages` is folded into a rolling summary (one LLM call, off the
+response path) and only the summary plus the recent messages go into prompts.
+"""
+import asyncio
+import datetime
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+Message = Dict[str, str]  # {"role": "USER" | "ASSISTANT", "content": ..., "timestamp": ISO-8601}
+
+
+@dataclass
+class Session:
+    summary: str = ""
+    summarized_until: str = ""  # timestamp of the newest message folded into the summary
+    messages: List[Message] = field(default_factory=list)
+    last_access: float = field(default_factory=time.monotonic)
+    lock: Optional[asyncio.Lock] = None
+
+
+# Blocking store hooks (run in the threadpool):
+#   loader(session_id, limit) -> Session with summary/summarized_until and up to `limit` newest messages
+#   writer(session_id, new_messages, session) persists messages and the session's summary fields
+Loader = Callable[[str, int], Session]
+Writer = Callable[[str, List[Message], Session], None]
+Summarizer = Callable[[str, List[Message]], Awaitable[str]]
+
+
+class ChatHistoryCache:
+    def __init__(self, loader: Optional[Loader] = None, writer: Optional[Writer] = None,
+                 summarizer: Optional[Summarizer] = None, max_sessions: int = 1000,
+                 idle_seconds: float = 1800, recent_messages: int = 6, summarize_batch: int = 6):
+        self.loader = loader
+        self.writer = writer
+        self.summarizer = summarizer
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.recent_messages = recent_messages
+        self.summarize_batch = summarize_batch
+
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "summaries": 0, "store_errors": 0}
+
+    # --- Cache ---
+    def _evict(self):
+        # Access order == LRU order, so idle sessions are always at the front
+        horizon = time.monotonic() - self.idle_seconds
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and oldest.last_access >= horizon:
+                break
+            self._sessions.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, session_id: str) -> Session:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            session = Session()
+            if self.loader:
+                try:
+                    session = await run_in_threadpool(
+                        self.loader, session_id, self.recent_messages + self.summarize_batch
+                    )
+                except Exception as e:
+                    self.stats["store_errors"] += 1
+                    print(f"History Fetch Error: {e}")
+            # A concurrent miss may have loaded it first
+            session = self._sessions.setdefault(session_id, session)
+
+        session.last_access = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        self._evict()
+        return session
+
+    # --- Prompt ---
+    def build_prompt(self, system_prompt: str, session: Session, message: str) -> str:
+        parts = [system_prompt, ""]
+        if session.summary:
+            parts += ["SUMMARY OF EARLIER CONVERSATION:", session.summary, ""]
+        parts.append("HISTORY:")
+        parts += [f"{m['role']}: {m['content']}" for m in session.messages]
+        parts += ["", f"USER: {message}", "ASSISTANT:"]
+        return "\n".join(parts)
+
+    # --- Updates ---
+    async def append(self, session_id: str, user_message: str, ai_reply: str):
+        """Records a finished turn. Meant to run after the response has been sent."""
+        if not ai_reply:
+            return
+        session = await self.get(session_id)
+        if session.lock is None:
+            session.lock = asyncio.Lock()
+
+        async with session.lock:
+            now = datetime.datetime.utcnow()
+            new_messages = [
+                {"role": "USER", "content": user_message, "timestamp": now.isoformat()},
+                # Strictly after the user message so ordering by timestamp is stable
+                {"role": "ASSISTANT", "content": ai_reply,
+                 "timestamp": (now + datetime.timedelta(microseconds=1)).isoformat()},
+            ]
+            session.messages.extend(new_messages)
+            await self._write(session_id, new_messages, session)
+
+            if len(session.messages) >= self.recent_messages + self.summarize_batch:
+                await self._fold(session_id, session)
+
+    async def _fold(self, session_id: str, session: Session):
+        older = session.messages[:-self.recent_messages] if self.recent_messages else list(session.messages)
+        if self.summarizer is None:
+            # No summarizer: plain sliding window
+            session.messages = session.messages[len(older):]
+            return
+        try:
+            summary = await self.summarizer(session.summary, older)
+        except Exception as e:
+            print(f"History Summary Error: {e}")
+            # Keep the prompt bounded even while summarization is failing
+            excess = len(session.messages) - (self.recent_messages + 3 * self.summarize_batch)
+            if excess > 0:
+                session.messages = session.messages[excess:]
+            return
+
+        self.stats["summaries"] += 1
+        session.summary = summary
+        session.summarized_until = older[-1]["timestamp"]
+        session.messages = session.messages[len(older):]
+        await self._write(session_id, [], session)
+
+    async def _write(self, session_id: str, new_messages: List[Message], session: Session):
+        if not self.writer:
+            return
+        try:
+            await run_in_threadpool(self.writer, session_id, new_messages, session)
+        except Exception as e:
+            self.stats["store_errors"] += 1
+            print(f"History Save Error: {e}")
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "sessions": len(self._sessions), "max_sessions": self.max_sessions}
@@ -0,0 +1,163 @@
+"""
+PHI de-identification.
+
+All categories are matched by one combined regex (single pass per text).
+StreamingScrubber keeps memory constant for arbitrarily large inputs: PHI
+tokens never contain whitespace, so each chunk is scrubbed up to its last
+whitespace and the tail is carried into the next chunk.
+
+Batch mode (all cores):
+    python deid.py notes.txt notes.clean.txt --workers 8
+    python deid.py notes.ndjson notes.clean.ndjson --ndjson --field text
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Order matters: emails first, then SSN-like IDs (3-2-4) before the looser phone pattern (3-3-4)
+_PHI_PATTERN = re.compile(
+    r"(?P<EMAIL>[\w\.-]+@[\w\.-]+\.\w+)"
+    r"|(?P<ID>\b\d{3}-\d{2}-\d{4}\b)"
+    r"|(?P<PHONE>\b\d{3}[-.]?\d{3}[-.]?\d{4}\b)"
+)
+REPLACEMENTS = {"EMAIL": "[EMAIL]", "PHONE": "[PHONE]", "ID": "[ID]"}
+
+_LAST_SPACE_PATTERN = re.compile(r"\s(?=\S*\Z)")
+
+# If a chunk has no whitespace at all, carry at most this much (longer than any email address)
+MAX_CARRY = 320
+
+
+def scrub(text: str, counts: Optional[Counter] = None) -> str:
+    """Scrubs one text in a single regex pass, optionally tallying redactions per category."""
+    if counts is None:
+        return _PHI_PATTERN.sub(lambda m: REPLACEMENTS[m.lastgroup], text)
+
+    def _replace(m):
+        counts[m.lastgroup] += 1
+        return REPLACEMENTS[m.lastgroup]
+
+    return _PHI_PATTERN.sub(_replace, text)
+
+
+def scrub_with_counts(text: str) -> Tuple[str, Dict[str, int]]:
+    counts = Counter()
+    return scrub(text, counts), dict(counts)
+
+
+class StreamingScrubber:
+    """Feed text chunks in, get scrubbed text out. Call flush() at end of input."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._carry = ""
+
+    def feed(self, chunk: str) -> str:
+        buffer = self._carry + chunk
+        match = _LAST_SPACE_PATTERN.search(buffer)
+        if match:
+            cut = match.end()
+        else:
+            cut = max(0, len(buffer) - MAX_CARRY)
+        self._carry = buffer[cut:]
+        return scrub(buffer[:cut], self.counts)
+
+    def flush(self) -> str:
+        tail, self._carry = self._carry, ""
+        return scrub(tail, self.counts)
+
+
+class NDJSONScrubber:
+    """Scrubs one field of every NDJSON record; partial lines are carried between chunks."""
+
+    def __init__(self, field: str = "text"):
+        self.field = field
+        self.counts = Counter()
+        self.records = 0
+        self._carry = ""
+
+    def _scrub_line(self, line: str) -> str:
+        record = json.loads(line)
+        record_counts = Counter()
+        value = record.get(self.field)
+        if isinstance(value, str):
+            record[self.field] = scrub(value, record_counts)
+        record["redactions"] = dict(record_counts)
+        self.counts.update(record_counts)
+        self.records += 1
+        return json.dumps(record) + "\n"
+
+    def feed(self, chunk: str) -> str:
+        lines = (self._carry + chunk).split("\n")
+        self._carry = lines.pop()
+        return "".join(self._scrub_line(line) for line in lines if line.strip())
+
+    def flush(self) -> str:
+        tail, self._carry = self._carry, ""
+        return self._scrub_line(tail) if tail.strip() else ""
+
+    def summary(self) -> str:
+        return json.dumps({"summary": {"records": self.records, "redactions": dict(self.counts)}}) + "\n"
+
+
+# --- Multi-process Batch Mode ---
+def _scrub_line_batch(args: Tuple[List[str], Optional[str]]) -> Tuple[List[str], Dict[str, int]]:
+    lines, field = args
+    counts = Counter()
+    out = []
+    for line in lines:
+        if field is None:
+            out.append(scrub(line, counts))
+        elif line.strip():
+            record = json.loads(line)
+            if isinstance(record.get(field), str):
+                record[field] = scrub(record[field], counts)
+            out.append(json.dumps(record) + "\n")
+    return out, dict(counts)
+
+
+def _batched(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scrub_file(src: str, dst: str, workers: Optional[int] = None, field: Optional[str] = None,
+               lines_per_task: int = 2000) -> Dict[str, int]:
+    """
+    Scrubs a line-oriented file across all cores. Output order is preserved and only
+    a bounded number of line batches are in flight, so memory stays flat.
+    field=None treats input as plain text; otherwise as NDJSON with that field scrubbed.
+    """
+    workers = workers or os.cpu_count() or 1
+    totals = Counter()
+    with open(src, "r", encoding="utf-8", newline="") as fin, \
+            open(dst, "w", encoding="utf-8", newline="") as fout, \
+            multiprocessing.Pool(workers) as pool:
+        tasks = ((batch, field) for batch in _batched(fin, lines_per_task))
+        for out, counts in pool.imap(_scrub_line_batch, tasks):
+            fout.writelines(out)
+            totals.update(counts)
+    return dict(totals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk PHI de-identification")
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: all cores)")
+    parser.add_argument("--ndjson", action="store_true", help="Input is NDJSON")
+    parser.add_argument("--field", default="text", help="NDJSON field to scrub")
+    args = parser.parse_args()
+
+    totals = scrub_file(args.src, args.dst, workers=args.workers, field=args.field if args.ndjson else None)
+    print(json.dumps({"redactions": totals}))
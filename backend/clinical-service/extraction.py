@@ -0,0 +1,151 @@
+"""
+Rule-based medication extractor (used when Gemini is unavailable).
+
+One precompiled tokenizer pass yields dosage, clock-time and word tokens
+together; drug names are matched against a word-level trie built from a
+lexicon file, so lookup cost depends on sentence length, not lexicon size.
+"""
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(__file__), "data", "drug_lexicon.txt")
+
+# Single combined pass: dosage (e.g. 50mg, 100 mg, 5ml), clock time (4pm, 4:00 PM), or a word
+_TOKEN_PATTERN = re.compile(
+    r"(?P<dosage>\d+(?:\.\d+)?\s*(?:mcg|mg|ml|g|units?|tablets?|pills?|capsules?|caps?))(?![a-z])"
+    r"|(?P<clock>(?P<hour>\d{1,2})(?::(?P<minute>\d{2}))?\s*(?P<meridiem>am|pm))\b"
+    r"|(?P<word>[a-z][\w'-]*)",
+    re.IGNORECASE,
+)
+
+# Semantic time words -> (priority, time). Lower priority wins, as morning > night > lunch.
+PERIOD_TIMES = {
+    "morning": (0, "8:00 AM"), "mornings": (0, "8:00 AM"),
+    "night": (1, "9:00 PM"), "nights": (1, "9:00 PM"), "nightly": (1, "9:00 PM"), "tonight": (1, "9:00 PM"),
+    "bed": (1, "9:00 PM"), "bedtime": (1, "9:00 PM"),
+    "lunch": (2, "1:00 PM"), "lunchtime": (2, "1:00 PM"), "noon": (2, "1:00 PM"), "afternoon": (2, "1:00 PM"),
+}
+
+# Stop Words (Verbs, Prepositions)
+STOP_WORDS = frozenset({
+    "take", "give", "eat", "drink", "use", "apply", "medication", "medicine", "pill", "tablet", "capsule",
+    "every", "at", "daily", "the", "a", "an", "for", "with", "in",
+    "pills", "tablets", "capsules", "caps", "tabs", "dose", "of", "to", "and", "by", "mouth",
+    "one", "two", "once", "twice", "times", "day", "after", "before",
+})
+
+_TERMINAL = ""  # trie key holding the display name (never a valid token)
+
+
+@dataclass
+class Extraction:
+    name: Optional[str] = None
+    dosage: Optional[str] = None
+    time: Optional[str] = None
+
+
+class MedicationExtractor:
+    def __init__(self, terms: List[str]):
+        self.trie: Dict[str, dict] = {}
+        self.size = 0
+        for term in terms:
+            self.add_term(term)
+
+    @classmethod
+    def from_file(cls, path: str = DEFAULT_LEXICON_PATH) -> "MedicationExtractor":
+        with open(path, "r", encoding="utf-8") as f:
+            terms = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        return cls(terms)
+
+    def add_term(self, term: str):
+        words = [m.group(0).lower() for m in _TOKEN_PATTERN.finditer(term)]
+        if not words:
+            return
+        node = self.trie
+        for w in words:
+            node = node.setdefault(w, {})
+        if _TERMINAL not in node:
+            self.size += 1
+        node[_TERMINAL] = term
+
+    def _match_at(self, words: List[str], start: int) -> Optional[tuple]:
+        """Longest lexicon term beginning at words[start] -> (display name, word count)."""
+        node = self.trie.get(words[start])
+        if node is None:
+            return None
+        best = (node[_TERMINAL], 1) if _TERMINAL in node else None
+        i = start + 1
+        while i < len(words):
+            node = node.get(words[i])
+            if node is None:
+                break
+            i += 1
+            if _TERMINAL in node:
+                best = (node[_TERMINAL], i - start)
+        return best
+
+    def extract(self, text: str) -> Extraction:
+        dosage = None
+        clock = None
+        period = None
+        words: List[str] = []     # lowercased tokens, for lexicon lookup
+        originals: List[str] = [] # as typed, for the capitalization heuristic
+
+        # 1. Tokenize once: dosage, time and name candidates together
+        for m in _TOKEN_PATTERN.finditer(text):
+            kind = m.lastgroup
+            if kind == "word":
+                word = m.group("word")
+                lower = word.lower()
+                hint = PERIOD_TIMES.get(lower)
+                if hint is not None:
+                    if period is None or hint[0] < period[0]:
+                        period = hint
+                    continue
+                words.append(lower)
+                originals.append(word)
+            elif kind == "dosage":
+                if dosage is None:
+                    dosage = m.group("dosage").lower()
+            elif clock is None:
+                # Normalize 4pm / 4:30pm -> 4:00 PM / 4:30 PM
+                clock = f"{int(m.group('hour'))}:{m.group('minute') or '00'} {m.group('meridiem').upper()}"
+
+        time = period[1] if period else clock
+
+        # 2. Known drug (longest match, leftmost first)
+        name = None
+        for i in range(len(words)):
+            match = self._match_at(words, i)
+            if match:
+                name = match[0]
+                break
+
+        # 3. Fallback: first capitalized word that is NOT a stop word
+        if not name:
+            for word, lower in zip(originals, words):
+                if lower not in STOP_WORDS and len(lower) > 2 and word[0].isupper():
+                    name = word
+                    break
+
+        # 4. If still no name, try non-capitalized words that aren't stop words
+        if not name:
+            for word, lower in zip(originals, words):
+                if lower not in STOP_WORDS and len(lower) > 3 and not any(c.isdigit() for c in word):
+                    name = word.capitalize()
+                    break
+
+        return Extraction(name=name, dosage=dosage, time=time)
+
+    def extract_batch(self, texts: List[str]) -> List[Extraction]:
+        extract = self.extract
+        return [extract(t) for t in texts]
+
+
+def load_extractor(path: Optional[str] = None) -> MedicationExtractor:
+    path = path or os.getenv("DRUG_LEXICON_PATH", DEFAULT_LEXICON_PATH)
+    extractor = MedicationExtractor.from_file(path)
+    print(f"✅ Drug Lexicon Loaded: {extractor.size} terms")
+    return extractor
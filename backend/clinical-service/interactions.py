@@ -0,0 +1,198 @@
+"""
+Drug-Interaction Engine.
+
+Loads a rule store (aliases, drug classes, pair/class rules) from JSON and
+precomputes an adjacency index: drug -> {other_drug: rule}. Checking a
+regimen of N meds is then N set intersections against that index.
+"""
+import json
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(__file__), "data", "interactions.json")
+
+# Higher rank = more severe. Used for ranking and for resolving overlapping rules.
+SEVERITY_RANK = {"LOW": 1, "MEDIUM": 2, "HIGH": 3, "CONTRAINDICATED": 4}
+
+CLASS_PREFIX = "class:"
+
+# Dosage / form noise stripped before lookup ("Ibuprofen 200mg tablet" -> "ibuprofen")
+_NOISE_PATTERN = re.compile(
+    r"\b\d+(\.\d+)?\s*(mg|g|mcg|ml|units|iu|%)?\b|\b(tablets?|tabs?|pills?|capsules?|caps?|oral|er|xr|sr|dr|hcl)\b"
+)
+_SPACE_PATTERN = re.compile(r"\s+")
+
+
+@dataclass(frozen=True)
+class Rule:
+    severity: str
+    warning: str
+    specific: bool  # True for drug-drug rules, False for class-derived rules
+
+
+@dataclass(frozen=True)
+class Interaction:
+    drug_a: str
+    drug_b: str
+    severity: str
+    warning: str
+
+    @property
+    def rank(self) -> int:
+        return SEVERITY_RANK.get(self.severity, 0)
+
+
+class InteractionEngine:
+    def __init__(self, aliases: Dict[str, str], classes: Dict[str, List[str]],
+                 rules: List[dict], drugs: Iterable[str] = ()):
+        self.aliases = {k.lower(): v.lower() for k, v in aliases.items()}
+        self.classes = {name: {d.lower() for d in members} for name, members in classes.items()}
+        self.index: Dict[str, Dict[str, Rule]] = {}
+
+        self.known: Set[str] = {d.lower() for d in drugs}
+        self.known.update(self.aliases.values())
+        for members in self.classes.values():
+            self.known.update(members)
+
+        # Class rules first so drug-specific rules can override them
+        ordered = sorted(rules, key=lambda r: all(not e.startswith(CLASS_PREFIX) for e in r["between"]))
+        for rule in ordered:
+            self._add_rule(rule)
+
+        # Normalization results depend on the lexicon, so cache per engine
+        self.normalize = lru_cache(maxsize=16384)(self._normalize)
+
+    @classmethod
+    def from_file(cls, path: str = DEFAULT_RULES_PATH) -> "InteractionEngine":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            aliases=data.get("aliases", {}),
+            classes=data.get("classes", {}),
+            rules=data.get("rules", []),
+            drugs=data.get("drugs", []),
+        )
+
+    # --- Index Construction ---
+    def _expand(self, endpoint: str) -> Set[str]:
+        endpoint = endpoint.lower()
+        if endpoint.startswith(CLASS_PREFIX):
+            return self.classes.get(endpoint[len(CLASS_PREFIX):], set())
+        return {self.aliases.get(endpoint, endpoint)}
+
+    def _add_rule(self, rule: dict):
+        a, b = rule["between"]
+        specific = not (a.startswith(CLASS_PREFIX) or b.startswith(CLASS_PREFIX))
+        entry = Rule(severity=rule["severity"].upper(), warning=rule["warning"], specific=specific)
+
+        left, right = self._expand(a), self._expand(b)
+        self.known.update(left)
+        self.known.update(right)
+        for x in left:
+            for y in right:
+                if x != y:
+                    self._link(x, y, entry)
+
+    def _link(self, x: str, y: str, entry: Rule):
+        existing = self.index.get(x, {}).get(y)
+        if existing is not None:
+            # Drug-specific rules win over class rules; otherwise keep the more severe one
+            if existing.specific and not entry.specific:
+                return
+            if existing.specific == entry.specific and SEVERITY_RANK[existing.severity] >= SEVERITY_RANK[entry.severity]:
+                return
+        self.index.setdefault(x, {})[y] = entry
+        self.index.setdefault(y, {})[x] = entry
+
+    @property
+    def pair_count(self) -> int:
+        return sum(len(v) for v in self.index.values()) // 2
+
+    # --- Lookup ---
+    def _normalize(self, name: str) -> str:
+        """Maps a free-text medication name to its canonical generic id."""
+        text = name.lower().strip()
+        if text in self.aliases:
+            return self.aliases[text]
+        if text in self.known:
+            return text
+
+        text = _NOISE_PATTERN.sub(" ", text)
+        text = _SPACE_PATTERN.sub(" ", text).strip(" .,;")
+        if text in self.aliases:
+            return self.aliases[text]
+        if text in self.known:
+            return text
+
+        # "Aspirin low dose" -> "aspirin"
+        first = text.split(" ", 1)[0] if text else text
+        if first in self.aliases:
+            return self.aliases[first]
+        if first in self.known:
+            return first
+        return text
+
+    def is_known(self, name: str) -> bool:
+        return self.normalize(name) in self.known
+
+    def _resolve(self, names: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        """Returns ({canonical_id: display_name}, [unknown display names])."""
+        resolved: Dict[str, str] = {}
+        unknown: List[str] = []
+        for name in names:
+            if not name or not name.strip():
+                continue
+            canonical = self.normalize(name)
+            if canonical in self.known:
+                resolved.setdefault(canonical, name.strip())
+            else:
+                unknown.append(name.strip())
+        return resolved, unknown
+
+    def check(self, new_med: str, current_meds: List[str]) -> Tuple[List[Interaction], List[str]]:
+        """
+        Checks one new medication against a current list.
+        Returns (interactions ranked by severity, names the rule store does not know).
+        """
+        current, unknown = self._resolve(current_meds)
+        new_id = self.normalize(new_med)
+        if new_id not in self.known:
+            return [], [new_med.strip()] + unknown
+
+        neighbours = self.index.get(new_id, {})
+        hits = []
+        for other in neighbours.keys() & current.keys():
+            rule = neighbours[other]
+            hits.append(Interaction(new_med.strip(), current[other], rule.severity, rule.warning))
+        hits.sort(key=lambda i: (-i.rank, i.drug_b.lower()))
+        return hits, unknown
+
+    def check_regimen(self, meds: List[str]) -> Tuple[List[Interaction], List[str]]:
+        """
+        Checks every pair in a full regimen.
+        Returns (interactions ranked by severity, names the rule store does not know).
+        """
+        resolved, unknown = self._resolve(meds)
+        present = resolved.keys()
+
+        hits = []
+        for drug_id, display in resolved.items():
+            neighbours = self.index.get(drug_id)
+            if not neighbours:
+                continue
+            for other in neighbours.keys() & present:
+                if drug_id < other:  # each pair once
+                    rule = neighbours[other]
+                    hits.append(Interaction(display, resolved[other], rule.severity, rule.warning))
+        hits.sort(key=lambda i: (-i.rank, i.drug_a.lower(), i.drug_b.lower()))
+        return hits, unknown
+
+
+def load_engine(path: Optional[str] = None) -> InteractionEngine:
+    path = path or os.getenv("INTERACTION_RULES_PATH", DEFAULT_RULES_PATH)
+    engine = InteractionEngine.from_file(path)
+    print(f"✅ Interaction Engine Loaded: {len(engine.known)} drugs, {engine.pair_count} pairs")
+    return engine
@@ -0,0 +1,246 @@
+"""
+Document analysis jobs.
+
+Uploads are spooled to disk and hashed, then queued for a bounded pool of
+asyncio workers. Results land in a local SQLite result store that clients
+poll (or stream). Identical uploads (same sha256 + mime type) reuse the
+existing job instead of calling Gemini again: a pending one always, a finished
+one while its result is younger than `result_ttl` seconds.
+"""
+import asyncio
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+QUEUED, RUNNING, DONE, ERROR = "queued", "running", "done", "error"
+FINISHED = (DONE, ERROR)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobStore:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS document_jobs ("
+            "id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, mime_type TEXT, status TEXT NOT NULL, "
+            "result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_document_jobs_hash ON document_jobs(content_hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_document_jobs_status ON document_jobs(status)")
+
+    def create(self, content_hash: str, mime_type: str) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO document_jobs (id, content_hash, mime_type, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, content_hash, mime_type, QUEUED, now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM document_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_reusable(self, content_hash: str, max_age: float) -> Optional[dict]:
+        """Latest job for this content that is pending, or done less than max_age seconds ago."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM document_jobs WHERE content_hash = ? "
+                "AND (status IN (?, ?) OR (status = ? AND updated_at >= ?)) "
+                "ORDER BY created_at DESC LIMIT 1",
+                (content_hash, QUEUED, RUNNING, DONE, time.time() - max_age),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None):
+        with self._lock:
+            self._db.execute(
+                "UPDATE document_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, result, error, time.time(), job_id),
+            )
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM document_jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM document_jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+def spool_upload(src, spool_dir: str, mime_type: str, chunk_size: int = 1024 * 1024,
+                 hold: Callable[[str], None] = lambda content_hash: None) -> Tuple[str, str]:
+    """
+    Copies an upload to spool_dir while hashing it. Returns (content_hash, path). Blocking.
+    hold(content_hash) is called before the file appears under its final name.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    digest = hashlib.sha256((mime_type or "").encode("utf-8") + b"\0")
+    tmp_path = os.path.join(spool_dir, f"upload-{uuid.uuid4().hex}.part")
+    with open(tmp_path, "wb") as out:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    content_hash = digest.hexdigest()
+    path = os.path.join(spool_dir, content_hash)
+    hold(content_hash)
+    os.replace(tmp_path, path)
+    return content_hash, path
+
+
+class DocumentJobQueue:
+    def __init__(self, store: JobStore, handler: Callable[[bytes, str], Awaitable[str]],
+                 spool_dir: str, workers: int = 4, max_queue: int = 100, result_ttl: float = 86400.0):
+        self.store = store
+        self.handler = handler
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._waiters: Dict[str, asyncio.Event] = {}
+        # Spooled files still needed by a submission that has not created its job yet
+        self._holds: Dict[str, int] = {}
+        self._spool_lock = threading.Lock()
+        self.active = 0
+
+    # --- Lifecycle ---
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+        # Resume work interrupted by a restart (uploads are still spooled on disk)
+        for job in self.store.unfinished():
+            if os.path.exists(self._path(job["content_hash"])) and not self._queue.full():
+                self.store.update(job["id"], QUEUED)
+                self._queue.put_nowait(job)
+            else:
+                self.store.update(job["id"], ERROR, error="Interrupted before processing")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    # --- Submission ---
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.spool_dir, content_hash)
+
+    def _hold(self, content_hash: str):
+        with self._spool_lock:
+            self._holds[content_hash] = self._holds.get(content_hash, 0) + 1
+
+    def _release(self, content_hash: str, discard: bool):
+        with self._spool_lock:
+            remaining = self._holds.pop(content_hash, 0) - 1
+            if remaining > 0:
+                self._holds[content_hash] = remaining
+            if discard:
+                self._discard(content_hash)
+
+    def _discard(self, content_hash: str):
+        """Removes a spooled file nothing needs any more: no submission holds it, no job is pending. Under _spool_lock."""
+        if self._holds.get(content_hash) or any(j["content_hash"] == content_hash for j in self.store.unfinished()):
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(content_hash))
+
+    async def submit(self, upload, mime_type: str) -> Tuple[dict, bool]:
+        """Spools and enqueues an upload. Returns (job, deduplicated)."""
+        loop = asyncio.get_running_loop()
+        content_hash, _ = await loop.run_in_executor(None, spool_upload, upload, self.spool_dir, mime_type,
+                                                     1024 * 1024, self._hold)
+        # The hold keeps finishing workers from removing the file until the job row exists
+        discard = True
+        try:
+            existing = self.store.find_reusable(content_hash, self.result_ttl)
+            if existing:
+                return existing, True
+
+            if self._queue.full():
+                raise QueueFullError("Document queue is full")
+
+            job_id = self.store.create(content_hash, mime_type)
+            job = self.store.get(job_id)
+            self._queue.put_nowait(job)
+            discard = False
+            return job, False
+        finally:
+            # A reused pending job keeps its file (it is pending); a done one does not need the copy
+            self._release(content_hash, discard)
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """Waits until the job finishes (or timeout) and returns its latest state."""
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINISHED:
+            return job
+        event = self._waiters.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.store.get(job_id)
+
+    def snapshot(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "active": self.active,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "result_ttl": self.result_ttl,
+            "jobs": self.store.counts(),
+        }
+
+    # --- Workers ---
+    async def _worker(self, worker_id: int):
+        while True:
+            job = await self._queue.get()
+            self.active += 1
+            try:
+                await self._run(job)
+            finally:
+                self.active -= 1
+                self._queue.task_done()
+
+    async def _run(self, job: dict):
+        job_id = job["id"]
+        path = self._path(job["content_hash"])
+        self.store.update(job_id, RUNNING)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            result = await self.handler(content, job["mime_type"])
+            self.store.update(job_id, DONE, result=result)
+        except Exception as e:
+            print(f"Document Job {job_id} Failed: {e}")
+            self.store.update(job_id, ERROR, error=str(e))
+        finally:
+            # Keep the spooled file only while another job or submission for the same content needs it
+            with self._spool_lock:
+                self._discard(job["content_hash"])
+            event = self._waiters.pop(job_id, None)
+            if event:
+                event.set()
@@ -0,0 +1,174 @@
+"""
+Content-addressed cache for Gemini responses.
+
+Two tiers:
+  1. In-process LRU (OrderedDict) - microsecond hits.
+  2. Local SQLite file (WAL) - survives restarts and is shared by workers on the same node.
+
+Keys are sha256(model + normalized inputs), so "Metformin 500mg  morning" and
+"metformin 500mg morning" hit the same entry. Values must be JSON-serializable.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+_MISSING = object()
+
+
+def _normalize(part: Any) -> Any:
+    if isinstance(part, str):
+        return " ".join(part.lower().split())
+    if isinstance(part, (list, tuple)):
+        return [_normalize(p) for p in part]
+    return part
+
+
+def make_key(model: str, *parts: Any) -> str:
+    payload = json.dumps([model, [_normalize(p) for p in parts]], separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, db_path: Optional[str] = None, ttl_seconds: float = 86400,
+                 max_entries: int = 10000, disk_max_entries: int = 100000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+        self._db = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)")
+            except Exception as e:
+                print(f"❌ LLM Cache Disk Tier Disabled: {e}")
+                self._db = None
+
+    # --- Public API ---
+    def get(self, model: str, *parts: Any, default: Any = None) -> Any:
+        key = make_key(model, *parts)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry[1]
+                del self._memory[key]
+
+            value = self._disk_get(key, now)
+            if value is not _MISSING:
+                self.stats["disk_hits"] += 1
+                return value
+
+            self.stats["misses"] += 1
+            return default
+
+    def set(self, model: str, value: Any, *parts: Any):
+        key = make_key(model, *parts)
+        expires_at = time.time() + self.ttl_seconds
+
+        with self._lock:
+            self.stats["sets"] += 1
+            self._memory_put(key, expires_at, value)
+            self._disk_put(key, expires_at, value)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db:
+                self._db.execute("DELETE FROM llm_cache")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = lookups - self.stats["misses"]
+            return {
+                **self.stats,
+                "memory_entries": len(self._memory),
+                "disk_enabled": self._db is not None,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    # --- Tiers ---
+    def _memory_put(self, key: str, expires_at: float, value: Any):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _disk_get(self, key: str, now: float) -> Any:
+        if not self._db:
+            return _MISSING
+        try:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return _MISSING
+            if row[1] <= now:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return _MISSING
+            self._db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            value = json.loads(row[0])
+            self._memory_put(key, row[1], value)  # promote
+            return value
+        except Exception as e:
+            print(f"LLM Cache Read Error: {e}")
+            return _MISSING
+
+    def _disk_put(self, key: str, expires_at: float, value: Any):
+        if not self._db:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, time.time()),
+            )
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= 500:
+                self._prune_disk()
+        except Exception as e:
+            print(f"LLM Cache Write Error: {e}")
+
+    def _prune_disk(self):
+        """Drops expired rows, then least-recently-used rows beyond disk_max_entries."""
+        self._writes_since_prune = 0
+        removed = self._db.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        count = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        overflow = count - self.disk_max_entries
+        if overflow > 0:
+            removed += self._db.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)",
+                (overflow,),
+            ).rowcount
+        self.stats["evictions"] += removed
+
+
+def cache_from_env() -> LLMCache:
+    db_path = os.getenv("LLM_CACHE_PATH", "llm_cache.db") or None  # empty string = memory only
+    return LLMCache(
+        db_path=db_path,
+        ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")),
+        max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+        disk_max_entries=int(os.getenv("LLM_CACHE_DISK_MAX_ENTRIES", "100000")),
+    )
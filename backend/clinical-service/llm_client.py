@@ -0,0 +1,186 @@
+"""
+Shared async Gemini client.
+
+Every Gemini call in the service goes through AsyncLLMClient.generate so that:
+  - calls never block the event loop (generate_content_async + asyncio.sleep),
+  - each model has its own bounded semaphore (max in-flight calls),
+  - each model has a token bucket; a 429 pauses only that model's bucket,
+  - transient failures retry with exponential backoff and jitter.
+
+AsyncLLMClient.stream yields text chunks as Gemini produces them; it only
+retries failures that happen before the first chunk has been yielded.
+"""
+import asyncio
+import os
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+import google.generativeai as genai
+
+_RETRY_HINT_PATTERN = re.compile(r"retry(?:_delay)?\D{0,20}?(\d+(?:\.\d+)?)\s*s", re.IGNORECASE)
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return "429" in str(error) or type(error).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+
+def is_retryable(error: Exception) -> bool:
+    if is_rate_limited(error):
+        return True
+    return type(error).__name__ in ("ServiceUnavailable", "DeadlineExceeded", "InternalServerError") \
+        or "503" in str(error)
+
+
+def _retry_hint(error: Exception) -> Optional[float]:
+    """Gemini 429s usually carry a suggested delay ("Please retry in 4.2s")."""
+    match = _RETRY_HINT_PATTERN.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float):
+        """Called on 429: hold back this model's callers without touching other models."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class AsyncLLMClient:
+    def __init__(self, max_concurrency: int = 4, rate_per_minute: float = 60,
+                 max_retries: int = 3, base_delay: float = 2.0, max_delay: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.rate_per_minute = rate_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0, "streams": 0}
+        self._first_chunk_total = 0.0
+
+    def _limits(self, model_name: str):
+        if model_name not in self._semaphores:
+            self._semaphores[model_name] = asyncio.Semaphore(self.max_concurrency)
+            self._buckets[model_name] = TokenBucket(
+                rate_per_second=self.rate_per_minute / 60.0,
+                capacity=max(1.0, float(self.max_concurrency)),
+            )
+        return self._semaphores[model_name], self._buckets[model_name]
+
+    def _backoff(self, attempt: int, hint: Optional[float] = None) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        if hint:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def generate(self, model_name: str, contents: Any) -> str:
+        """Returns response.text, retrying transient errors. Raises the last error."""
+        semaphore, bucket = self._limits(model_name)
+
+        for attempt in range(self.max_retries):
+            await bucket.acquire()
+            try:
+                async with semaphore:
+                    self.stats["calls"] += 1
+                    model = genai.GenerativeModel(model_name)
+                    response = await model.generate_content_async(contents)
+                    return response.text
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries - 1:
+                    self.stats["failures"] += 1
+                    raise
+
+                delay = self._backoff(attempt, _retry_hint(e))
+                if is_rate_limited(e):
+                    self.stats["rate_limited"] += 1
+                    bucket.penalize(delay)
+                self.stats["retries"] += 1
+                print(f"LLM call to {model_name} failed (Try {attempt + 1}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def stream(self, model_name: str, contents: Any) -> AsyncIterator[str]:
+        """Yields response text chunks as they arrive. Holds a concurrency slot until the stream ends."""
+        semaphore, bucket = self._limits(model_name)
+
+        for attempt in range(self.max_retries):
+            await bucket.acquire()
+            started = time.monotonic()
+            yielded = False
+            try:
+                async with semaphore:
+                    self.stats["calls"] += 1
+                    model = genai.GenerativeModel(model_name)
+                    response = await model.generate_content_async(contents, stream=True)
+                    async for chunk in response:
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            continue  # Chunk without text parts (e.g. finish/safety metadata)
+                        if not text:
+                            continue
+                        if not yielded:
+                            yielded = True
+                            self.stats["streams"] += 1
+                            self._first_chunk_total += time.monotonic() - started
+                        yield text
+                    return
+            except Exception as e:
+                # Once text has reached the caller a retry would duplicate it
+                if yielded or not is_retryable(e) or attempt == self.max_retries - 1:
+                    self.stats["failures"] += 1
+                    raise
+
+                delay = self._backoff(attempt, _retry_hint(e))
+                if is_rate_limited(e):
+                    self.stats["rate_limited"] += 1
+                    bucket.penalize(delay)
+                self.stats["retries"] += 1
+                print(f"LLM stream to {model_name} failed (Try {attempt + 1}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    def snapshot(self) -> dict:
+        streams = self.stats["streams"]
+        return {
+            **self.stats,
+            "avg_first_chunk_ms": round(self._first_chunk_total / streams * 1000, 1) if streams else 0.0,
+            "models": {
+                name: {
+                    "in_flight": self.max_concurrency - sem._value,
+                    "blocked_for": round(max(0.0, self._buckets[name].blocked_until - time.monotonic()), 2),
+                }
+                for name, sem in self._semaphores.items()
+            },
+        }
+
+
+def client_from_env() -> AsyncLLMClient:
+    return AsyncLLMClient(
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+        rate_per_minute=float(os.getenv("LLM_RATE_PER_MINUTE", "60")),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    )
@@ -1,20 +1,40 @@
 import google.generativeai as genai
 import os
-import re
-import time
+import asyncio
+import codecs
+import tempfile
 import datetime
 import json
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from dataclasses import asdict
 from dotenv import load_dotenv
+from interactions import load_engine, SEVERITY_RANK
+from llm_cache import cache_from_env
+from llm_client import client_from_env
+from extraction import load_extractor
+import deid
+from chat_history import ChatHistoryCache, Session
+from storage import store_from_env
+from jobs import DocumentJobQueue, JobStore, QueueFullError, DONE, ERROR, FINISHED
 
 load_dotenv()
 
 # Configure Gemini
 # User must run: GEMINI_API_KEY=xyz uvicorn main:app ...
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+TEXT_MODEL = "gemini-2.5-flash-preview-09-2025"
+
+# Response cache for repeated prompts (see llm_cache.py for LLM_CACHE_* settings)
+llm_cache = cache_from_env()
+
+# Shared async client: per-model concurrency + rate limits (see llm_client.py for LLM_* settings)
+llm = client_from_env()
 
 app = FastAPI(title="MedX Clinical Intelligence Service")
 
@@ -32,60 +52,49 @@ class InteractionCheckRequest(BaseModel):
     new_med: str
     current_meds: List[str]
 
+class InteractionDetail(BaseModel):
+    drug_a: str
+    drug_b: str
+    severity: str
+    warning: str
+
 class InteractionResponse(BaseModel):
     warning: Optional[str] = None
     severity: Optional[str] = None # LOW, MEDIUM, HIGH, CONTRAINDICATED
+    interactions: List[InteractionDetail] = []
 
-# --- Knowledge Base (Mock Rule Engine) ---
-# In production, this would query a graph DB or external API (e.g. RxNorm)
-INTERACTION_RULES = {
-    # NSAID + NSAID = Ulcer Risk
-    frozenset(["aspirin", "ibuprofen"]): {
-        "warning": "Taking multiple NSAIDs increases risk of stomach bleeding.",
-        "severity": "MEDIUM"
-    },
-    frozenset(["advil", "aspirin"]): {
-        "warning": "Taking multiple NSAIDs increases risk of stomach bleeding.",
-        "severity": "MEDIUM"
-    },
-    # Warfarin Interactions (High Risk)
-    frozenset(["warfarin", "aspirin"]): {
-        "warning": "High risk of bleeding! Aspirin enhances the effect of Warfarin.",
-        "severity": "HIGH"
-    },
-    frozenset(["warfarin", "ibuprofen"]): {
-        "warning": "High risk of bleeding! Ibuprofen interferes with Warfarin.",
-        "severity": "HIGH"
-    },
-    # ACE Inhibitor + Potassium Sparing
-    frozenset(["lisinopril", "spironolactone"]): {
-        "warning": "Risk of Hyperkalemia (High Potassium). Monitor blood levels.",
-        "severity": "MEDIUM"
-    }
-}
+# --- Knowledge Base (Rule Engine) ---
+# Rules live in data/interactions.json (override with INTERACTION_RULES_PATH).
+# In production, this would be generated from an external source (e.g. RxNorm)
+interaction_engine = load_engine()
 
 # --- Logic ---
-def check_for_interactions(new_med_name: str, current_med_names: List[str]) -> InteractionResponse:
-    new_med = new_med_name.lower().strip()
-    
-    # 1. Fast Rule Check
-    for med in current_med_names:
-        current = med.lower().strip()
-        pair = frozenset([new_med, current])
-        
-        if pair in INTERACTION_RULES:
-            rule = INTERACTION_RULES[pair]
-            return InteractionResponse(
-                warning=f"Interaction detected with {current.title()}: {rule['warning']}",
-                severity=rule['severity']
-            )
-            
+async def check_for_interactions(new_med_name: str, current_med_names: List[str]) -> InteractionResponse:
+    # 1. Fast Rule Check (all interactions, most severe first)
+    hits, unknown = interaction_engine.check(new_med_name, current_med_names)
+
+    if hits:
+        top = hits[0]
+        return InteractionResponse(
+            warning=f"Interaction detected with {top.drug_b.title()}: {top.warning}",
+            severity=top.severity,
+            interactions=[InteractionDetail(**asdict(hit)) for hit in hits]
+        )
+
+    # Every drug is in the rule store and no rule matched: nothing to ask the AI
+    if not unknown:
+        return InteractionResponse(warning=None, severity=None)
+
     # 2. AI Fallback (Gemini)
     if not os.getenv("GEMINI_API_KEY"):
          return InteractionResponse(warning=None, severity=None)
          
+    cache_parts = ("interaction", new_med_name, sorted(current_med_names, key=str.lower))
+    cached = llm_cache.get(TEXT_MODEL, *cache_parts)
+    if cached is not None:
+        return InteractionResponse(**cached)
+
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash-preview-09-2025")
         current_list = ", ".join(current_med_names)
         
         prompt = f"""
@@ -107,21 +116,143 @@ def check_for_interactions(new_med_name: str, current_med_names: List[str]) -> I
         Return ONLY valid JSON. No markdown.
         """
         
-        response = model.generate_content(prompt)
-        text = response.text.replace('```json', '').replace('```', '').strip()
+        response_text = await llm.generate(TEXT_MODEL, prompt)
+        text = response_text.replace('```json', '').replace('```', '').strip()
         
         data = json.loads(text)
         
-        return InteractionResponse(
-            warning=data.get('warning'),
-            severity=data.get('severity')
-        )
+        result = {"warning": data.get('warning'), "severity": data.get('severity')}
+        llm_cache.set(TEXT_MODEL, result, *cache_parts)
+        return InteractionResponse(**result)
         
     except Exception as e:
         print(f"AI Safety Check Failed: {e}")
         # Fail safe - allow if AI check fails, but log it
         return InteractionResponse(warning=None, severity=None)
 
+# --- Batch (Whole-Regimen) Checks ---
+class RegimenCheck(BaseModel):
+    patient_id: Optional[str] = None
+    medications: List[str]
+
+class BatchInteractionRequest(BaseModel):
+    medications: Optional[List[str]] = None # Single full regimen
+    regimens: List[RegimenCheck] = [] # Or many patients at once
+
+class RegimenResult(BaseModel):
+    patient_id: Optional[str] = None
+    interactions: List[InteractionDetail] = []
+    unresolved: List[str] = [] # Drugs the rule store does not know
+
+class BatchInteractionResponse(BaseModel):
+    results: List[RegimenResult]
+    ai_pairs_checked: int = 0
+
+AI_BATCH_MAX_PAIRS = int(os.getenv("AI_BATCH_MAX_PAIRS", "150"))
+
+def _pair_cache_key(pair: tuple) -> List[str]:
+    return sorted(name.casefold() for name in pair)
+
+async def _ai_check_pairs(pairs: List[tuple]) -> Tuple[dict, int]:
+    """
+    Sends every unresolved pair to Gemini in as few prompts as possible.
+    Returns ({(med_a, med_b): {"severity": ..., "warning": ...}} for significant pairs only,
+    number of pairs sent to Gemini; cache hits are not counted).
+    """
+    found = {}
+    if not pairs or not os.getenv("GEMINI_API_KEY"):
+        return found, 0
+
+    # Pairs answered before (including "no interaction") never reach the prompt
+    uncached = []
+    for pair in pairs:
+        cached = llm_cache.get(TEXT_MODEL, "interaction-pair", _pair_cache_key(pair))
+        if cached is None:
+            uncached.append(pair)
+        elif cached.get("severity"):
+            found[pair] = cached
+
+    for start in range(0, len(uncached), AI_BATCH_MAX_PAIRS):
+        chunk = uncached[start:start + AI_BATCH_MAX_PAIRS]
+        pair_lines = "\n".join(f'{i}. "{a}" + "{b}"' for i, (a, b) in enumerate(chunk))
+
+        prompt = f"""
+        Act as a Clinical Pharmacist. Check each numbered medication pair below for interactions.
+
+        {pair_lines}
+
+        Return a JSON array containing ONLY the pairs with a MODERATE, HIGH, or CONTRAINDICATED interaction:
+        [
+            {{"pair": 0, "warning": "Brief clinical explanation of the risk.", "severity": "HIGH" or "MEDIUM" or "CONTRAINDICATED"}}
+        ]
+
+        If no pair has a significant interaction, return [].
+        Return ONLY valid JSON. No markdown.
+        """
+
+        try:
+            response_text = await llm.generate(TEXT_MODEL, prompt)
+            text = response_text.replace('```json', '').replace('```', '').strip()
+            for item in json.loads(text):
+                idx = item.get("pair")
+                if isinstance(idx, int) and 0 <= idx < len(chunk) and item.get("severity"):
+                    found[chunk[idx]] = {"severity": item["severity"], "warning": item.get("warning") or "Potential interaction flagged by AI review."}
+            for pair in chunk:
+                llm_cache.set(TEXT_MODEL, found.get(pair, {"severity": None}), "interaction-pair", _pair_cache_key(pair))
+        except Exception as e:
+            # Fail safe - report rule hits only, but log it
+            print(f"AI Batch Safety Check Failed: {e}")
+
+    return found, len(uncached)
+
+def _distinct_names(names: List[str]) -> List[str]:
+    """Names differing only by case or surrounding spaces are one drug; the first spelling is kept."""
+    distinct = {}
+    for name in names:
+        if name and name.strip():
+            distinct.setdefault(name.strip().casefold(), name.strip())
+    return list(distinct.values())
+
+async def check_regimens(regimens: List[RegimenCheck]) -> BatchInteractionResponse:
+    results = []
+    pending = {} # pair key -> (med_a, med_b), deduplicated across all regimens
+    regimen_pairs = []
+
+    # 1. Rule pass over every regimen
+    for regimen in regimens:
+        meds = _distinct_names(regimen.medications)
+        hits, unknown = interaction_engine.check_regimen(meds)
+        results.append(RegimenResult(
+            patient_id=regimen.patient_id,
+            interactions=[InteractionDetail(**asdict(hit)) for hit in hits],
+            unresolved=unknown
+        ))
+
+        # Pairs touching an unknown drug can only be answered by the AI
+        unknown_set = set(unknown)
+        keys = []
+        for i, a in enumerate(meds):
+            for b in meds[i + 1:]:
+                if a in unknown_set or b in unknown_set:
+                    key = tuple(_pair_cache_key((a, b)))
+                    pending.setdefault(key, (a, b))
+                    keys.append(key)
+        regimen_pairs.append(keys)
+
+    # 2. One combined AI pass for everything the rules could not resolve
+    pair_keys = list(pending)
+    ai_found, ai_checked = await _ai_check_pairs([pending[k] for k in pair_keys])
+    ai_by_key = {k: ai_found[pending[k]] for k in pair_keys if pending[k] in ai_found}
+
+    for result, keys in zip(results, regimen_pairs):
+        for key in keys:
+            if key in ai_by_key:
+                a, b = pending[key]
+                result.interactions.append(InteractionDetail(drug_a=a, drug_b=b, **ai_by_key[key]))
+        result.interactions.sort(key=lambda i: -SEVERITY_RANK.get(i.severity, 0))
+
+    return BatchInteractionResponse(results=results, ai_pairs_checked=ai_checked)
+
 class ExtractionRequest(BaseModel):
     text: str
 
@@ -130,91 +261,31 @@ class ExtractionResponse(BaseModel):
     dosage: Optional[str] = None
     time: Optional[str] = None
 
+class BatchExtractionRequest(BaseModel):
+    texts: List[str]
+    use_ai: bool = True # False forces the rule extractor (fast path for bulk imports)
+
 # --- NLP Logic ---
 
-def _extract_regex_fallback(text: str) -> ExtractionResponse:
-    """Fallback using Regex if AI fails"""
-    text_clean = text.strip()
-    text_lower = text_clean.lower()
-    
-    # 1. Extract Dosage (e.g. 50mg, 100 mg, 5ml)
-    dosage_pattern = r"(\d+(\.\d+)?\s*(mg|g|mcg|ml|units|tablet|pill|cap))"
-    dosage_match = re.search(dosage_pattern, text_lower)
-    dosage = dosage_match.group(0) if dosage_match else None
-    
-    # 2. Extract Time
-    # Semantic mapping
-    time = None
-    if "morning" in text_lower:
-        time = "8:00 AM"
-    elif "night" in text_lower or "bed" in text_lower:
-        time = "9:00 PM"
-    elif "lunch" in text_lower or "noon" in text_lower:
-        time = "1:00 PM"
-    else:
-        # Regex for HH:MM AM/PM or HH AM/PM (e.g. 4pm, 4:00pm, 4 PM)
-        time_pattern = r"(\d{1,2}(:\d{2})?\s*(AM|PM|am|pm))"
-        time_match = re.search(time_pattern, text_clean, re.IGNORECASE) 
-        if time_match:
-            time = time_match.group(0).upper()
-            # Normalize 4pm -> 4:00 PM
-            if ":" not in time:
-                parts = re.split(r"(AM|PM)", time)
-                if len(parts) > 1:
-                    time = f"{parts[0].strip()}:00 {parts[1]}"
-
-    # 3. Extract Name
-    
-    # Remove dosage/time from considerations
-    removable_parts = []
-    if dosage: removable_parts.append(dosage)
-    if time and 'time_match' in locals() and time_match: removable_parts.append(time_match.group(0))
-    
-    temp_text = text_clean
-    for part in removable_parts:
-        temp_text = temp_text.replace(part, "")
-        
-    # Stop Words (Verbs, Prepositions)
-    STOP_WORDS = {"take", "give", "eat", "drink", "use", "apply", "medication", "medicine", "pill", "tablet", "capsule", "every", "at", "daily", "the", "a", "an", "for", "with", "in"}
-    
-    known_drugs = ["Lisinopril", "Metformin", "Atorvastatin", "Aspirin", "Ibuprofen", "Warfarin", "Advil", "Tylenol", "Amoxicillin", "Paracetamol"]
-    name = None
-    
-    # Check Known List
-    for drug in known_drugs:
-        if drug.lower() in text_lower:
-            name = drug
-            break
-            
-    if not name:
-        # Fallback: Find first capitalized word that is NOT a stop word
-        words = temp_text.split()
-        for w in words:
-            clean_w = w.strip(".,!?").lower()
-            if clean_w not in STOP_WORDS and len(clean_w) > 2 and w[0].isupper():
-                name = w.strip(".,!?")
-                break
-        
-        # If still no name, try non-capitalized words that aren't stop words
-        if not name:
-             for w in words:
-                clean_w = w.strip(".,!?").lower()
-                if clean_w not in STOP_WORDS and len(clean_w) > 3 and not any(char.isdigit() for char in w):
-                     name = w.strip(".,!?").capitalize()
-                     break
+# Rule-based extractor over data/drug_lexicon.txt (override with DRUG_LEXICON_PATH)
+med_extractor = load_extractor()
 
-    return ExtractionResponse(name=name, dosage=dosage, time=time)
+def _extract_regex_fallback(text: str) -> ExtractionResponse:
+    """Fallback using the compiled rule extractor if AI fails"""
+    return ExtractionResponse(**asdict(med_extractor.extract(text)))
 
-def extract_med_info(text: str) -> ExtractionResponse:
+async def extract_med_info(text: str) -> ExtractionResponse:
     """
     Extracts medication info using Gemini 2.0, falling back to regex.
     """
     if not os.getenv("GEMINI_API_KEY"):
         return _extract_regex_fallback(text)
+
+    cached = llm_cache.get(TEXT_MODEL, "extract", text)
+    if cached is not None:
+        return ExtractionResponse(**cached)
         
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash-preview-09-2025")
-        
         prompt = f"""
         Extract structured medication data from this text: "{text}"
         
@@ -227,15 +298,13 @@ def extract_med_info(text: str) -> ExtractionResponse:
         Example Output: {{"name": "Aspirin", "dosage": "81mg", "time": "08:00 AM"}}
         """
         
-        response = model.generate_content(prompt)
-        raw_text = response.text.replace('```json', '').replace('```', '').strip()
+        response_text = await llm.generate(TEXT_MODEL, prompt)
+        raw_text = response_text.replace('```json', '').replace('```', '').strip()
         data = json.loads(raw_text)
         
-        return ExtractionResponse(
-            name=data.get('name'),
-            dosage=data.get('dosage'),
-            time=data.get('time')
-        )
+        result = {"name": data.get('name'), "dosage": data.get('dosage'), "time": data.get('time')}
+        llm_cache.set(TEXT_MODEL, result, "extract", text)
+        return ExtractionResponse(**result)
         
     except Exception as e:
         print(f"Gemini NLP Extraction Failed: {e}")
@@ -302,39 +371,56 @@ def _map_to_fhir(extraction: ExtractionResponse) -> dict:
 # --- De-identification Logic ---
 def _scrub_phi(text: str) -> str:
     """
-    Basic Regex-based PHI scrubber.
+    Regex-based PHI scrubber (single combined pass, see deid.py).
     Removes Emails, Phone Numbers, and SSN-like patterns.
     """
-    # 1. Emails
-    text = re.sub(r'[\w\.-]+@[\w\.-]+\.\w+', '[EMAIL]', text)
-    
-    # 2. Phone Numbers (Simple: 3 digits - 3 digits - 4 digits)
-    text = re.sub(r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b', '[PHONE]', text)
-    
-    # 3. SSN / ID patterns (Simple: 3-2-4)
-    text = re.sub(r'\b\d{3}-\d{2}-\d{4}\b', '[ID]', text)
-    
-    return text
+    return deid.scrub(text)
 
 # --- Endpoints ---
 @app.get("/")
 def root():
     return {"status": "Clinical Intelligence Service Running"}
 
+@app.get("/cache/stats")
+def cache_stats():
+    return {**llm_cache.snapshot(), "llm": llm.snapshot(), "chat_sessions": chat_sessions.snapshot()}
+
 @app.post("/interactions/check", response_model=InteractionResponse)
-def check_interactions(request: InteractionCheckRequest):
-    return check_for_interactions(request.new_med, request.current_meds)
+async def check_interactions(request: InteractionCheckRequest):
+    return await check_for_interactions(request.new_med, request.current_meds)
+
+@app.post("/interactions/check-batch", response_model=BatchInteractionResponse)
+async def check_interactions_batch(request: BatchInteractionRequest):
+    """
+    Checks whole regimens (one list, or many patients' lists) in a single pass.
+    """
+    regimens = list(request.regimens)
+    if request.medications:
+        regimens.insert(0, RegimenCheck(medications=request.medications))
+    if not regimens:
+        raise HTTPException(status_code=400, detail="Provide medications or regimens")
+    return await check_regimens(regimens)
 
 @app.post("/nlp/extract", response_model=ExtractionResponse)
-def nlp_extract(request: ExtractionRequest):
-    return extract_med_info(request.text)
+async def nlp_extract(request: ExtractionRequest):
+    return await extract_med_info(request.text)
+
+@app.post("/nlp/extract-batch", response_model=List[ExtractionResponse])
+async def nlp_extract_batch(request: BatchExtractionRequest):
+    """
+    Extracts medication info from many sentences in one call.
+    """
+    if not request.use_ai or not os.getenv("GEMINI_API_KEY"):
+        return [ExtractionResponse(**asdict(e)) for e in med_extractor.extract_batch(request.texts)]
+    # Concurrency is bounded per model by the shared LLM client
+    return await asyncio.gather(*(extract_med_info(text) for text in request.texts))
 
 @app.post("/fhir/convert")
-def fhir_convert(request: ExtractionRequest):
+async def fhir_convert(request: ExtractionRequest):
     """
     Extracts info and converts to FHIR.
     """
-    extraction = extract_med_info(request.text)
+    extraction = await extract_med_info(request.text)
     return _map_to_fhir(extraction)
 
 @app.post("/nlp/deidentify")
@@ -342,18 +428,60 @@ def deidentify_text(request: ExtractionRequest):
     """
     Removes potential PHI from text.
     """
-    clean_text = _scrub_phi(request.text)
-    return {"original_length": len(request.text), "clean_text": clean_text}
+    clean_text, counts = deid.scrub_with_counts(request.text)
+    return {"original_length": len(request.text), "clean_text": clean_text, "redactions": counts}
+
+DEID_SPOOL_MAX_MEMORY = 8 * 1024 * 1024 # Scrubbed output beyond this spills to a temp file
 
-from google.cloud import firestore
+@app.post("/nlp/deidentify/stream")
+async def deidentify_stream(request: Request, field: str = "text", summary: bool = True):
+    """
+    De-identifies large uploads (chunked body) with constant memory.
+    - application/x-ndjson: scrubs `field` of each record, adds per-record "redactions",
+      and ends with a {"summary": ...} record when summary=true.
+    - anything else: treated as plain text.
+    The body is scrubbed chunk-by-chunk as it arrives into a spooled temp file, then streamed back.
+    Per-category counts are returned in the X-Redactions header.
+    """
+    is_ndjson = "ndjson" in request.headers.get("content-type", "")
+    scrubber = deid.NDJSONScrubber(field) if is_ndjson else deid.StreamingScrubber()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    spool = tempfile.SpooledTemporaryFile(max_size=DEID_SPOOL_MAX_MEMORY, mode="w+b")
+
+    try:
+        async for chunk in request.stream():
+            text = decoder.decode(chunk)
+            if text:
+                out = await run_in_threadpool(scrubber.feed, text)
+                spool.write(out.encode("utf-8"))
+        out = scrubber.feed(decoder.decode(b"", final=True)) + scrubber.flush()
+        spool.write(out.encode("utf-8"))
+        if is_ndjson and summary:
+            spool.write(scrubber.summary().encode("utf-8"))
+    except Exception as e:
+        spool.close()
+        print(f"De-identification Stream Failed: {e}")
+        raise HTTPException(status_code=400, detail=f"Could not process input: {e}")
+
+    spool.seek(0)
+
+    def read_spool():
+        try:
+            while True:
+                block = spool.read(64 * 1024)
+                if not block:
+                    break
+                yield block
+        finally:
+            spool.close()
+
+    media_type = "application/x-ndjson" if is_ndjson else "text/plain; charset=utf-8"
+    return StreamingResponse(read_spool(), media_type=media_type,
+                             headers={"X-Redactions": json.dumps(dict(scrubber.counts))})
 
 # --- Database ---
-try:
-    db = firestore.Client()
-    print("✅ Firestore Client Initialized")
-except Exception as e:
-    print(f"❌ Firestore Init Failed: {e}")
-    db = None
+# Firestore by default; STORAGE_BACKEND=local for the embedded store (see storage.py)
+db = store_from_env()
 
 # --- Models ---
 class ChatRequest(BaseModel):
@@ -364,143 +492,187 @@ class ChatResponse(BaseModel):
     response: str
 
 # --- Chat Logic ---
-@app.post("/chat", response_model=ChatResponse)
-def chat_with_medical_assistant(request: ChatRequest):
-    """
-    Context-aware medical chat using Gemini + Firestore History.
-    """
-    if not os.getenv("GEMINI_API_KEY"):
-         raise HTTPException(status_code=503, detail="AI Service Config Missing")
-
-    # 1. Fetch History
-    history_text = ""
-    if db:
-        try:
-            # Get last 6 messages (3 turns)
-            history_ref = db.collection("chat_sessions").document(request.session_id).collection("messages")
-            docs = history_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(6).stream()
-            
-            msgs = []
-            for doc in docs:
-                data = doc.to_dict()
-                msgs.append(f"{data['role']}: {data['content']}")
-            
-            history_text = "\n".join(reversed(msgs)) 
-        except Exception as e:
-            print(f"History Fetch Error: {e}")
+def _load_session(session_id: str, limit: int) -> Session:
+    """Summary fields from the session doc plus the newest unsummarized messages."""
+    meta = db.get("chat_sessions", session_id) or {}
+    summarized_until = meta.get("summarized_until", "")
+
+    where = [("timestamp", ">", summarized_until)] if summarized_until else []
+    docs = db.query(f"chat_sessions/{session_id}/messages", where=where,
+                    order_by="timestamp", descending=True, limit=limit)
+
+    messages = [
+        {"role": doc.data["role"], "content": doc.data["content"], "timestamp": doc.data.get("timestamp", "")}
+        for doc in docs
+    ]
+    return Session(summary=meta.get("summary", ""), summarized_until=summarized_until,
+                   messages=list(reversed(messages)))
+
+def _save_session(session_id: str, new_messages: List[dict], session: Session):
+    writes = [(f"chat_sessions/{session_id}/messages", None, message, False) for message in new_messages]
+    if session.summarized_until:
+        writes.append(("chat_sessions", session_id,
+                       {"summary": session.summary, "summarized_until": session.summarized_until}, True))
+    db.batch_write(writes)
+
+async def _summarize_chat(summary: str, messages: List[dict]) -> str:
+    lines = [
+        "Update the running summary of a conversation between a patient and a medical assistant.",
+        "Keep medications, doses, symptoms, conditions, allergies and instructions that were given.",
+        "Write at most 120 words of plain text.",
+        "",
+        "CURRENT SUMMARY:",
+        summary or "(none)",
+        "",
+        "NEW MESSAGES:",
+    ]
+    lines += [f"{m['role']}: {m['content']}" for m in messages]
+    return (await llm.generate(TEXT_MODEL, "\n".join(lines))).strip()
+
+# Warm sessions need no Firestore reads; history is written through (see chat_history.py)
+chat_sessions = ChatHistoryCache(
+    loader=_load_session if db else None,
+    writer=_save_session if db else None,
+    summarizer=_summarize_chat,
+    max_sessions=int(os.getenv("CHAT_CACHE_MAX_SESSIONS", "1000")),
+    idle_seconds=float(os.getenv("CHAT_CACHE_IDLE_SECONDS", "1800")),
+    recent_messages=int(os.getenv("CHAT_RECENT_MESSAGES", "6")),
+    summarize_batch=int(os.getenv("CHAT_SUMMARIZE_BATCH", "6")),
+)
 
-    # 2. Call Gemini
-    try:
-        model = genai.GenerativeModel("gemini-2.5-flash-preview-09-2025")
-        
-        system_prompt = """
+CHAT_SYSTEM_PROMPT = """
         You are 'MedX Assistant', a helpful, empathetic, and professional medical assistant.
         - Answer health questions, explain medications, and clarify instructions.
         - DO NOT diagnose conditions or prescribe meds. Always advise consulting a doctor for serious issues.
         - Keep answers concise and easy to understand.
-        - Use the conversation history below to provide context-aware answers.
+        - Use the conversation summary and history below to provide context-aware answers.
         """
-        
-        full_prompt = f"{system_prompt}\n\nHISTORY:\n{history_text}\n\nUSER: {request.message}\nASSISTANT:"
-        
-        response = model.generate_content(full_prompt)
-        ai_reply = response.text.strip()
-        
-        # 3. Save to History (Async typically, but sync for MVP)
-        if db:
-            batch = db.batch()
-            doc_user = history_ref.document()
-            batch.set(doc_user, {
-                "role": "USER",
-                "content": request.message, 
-                "timestamp": datetime.datetime.utcnow().isoformat()
-            })
-            
-            doc_ai = history_ref.document()
-            batch.set(doc_ai, {
-                "role": "ASSISTANT",
-                "content": ai_reply,
-                "timestamp": datetime.datetime.utcnow().isoformat()
-            })
-            batch.commit()
-            
-        return ChatResponse(response=ai_reply)
 
+async def _build_chat_prompt(session_id: str, message: str) -> str:
+    session = await chat_sessions.get(session_id)
+    return chat_sessions.build_prompt(CHAT_SYSTEM_PROMPT, session, message)
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_with_medical_assistant(request: ChatRequest, background_tasks: BackgroundTasks):
+    """
+    Context-aware medical chat using Gemini + cached session history (written through to Firestore).
+    History is written after the response is sent.
+    """
+    if not os.getenv("GEMINI_API_KEY"):
+         raise HTTPException(status_code=503, detail="AI Service Config Missing")
+
+    full_prompt = await _build_chat_prompt(request.session_id, request.message)
+    try:
+        response_text = await llm.generate(TEXT_MODEL, full_prompt)
     except Exception as e:
         print(f"Gemini Chat Failed: {e}")
         raise HTTPException(status_code=500, detail="AI Chat Failed")
 
+    ai_reply = response_text.strip()
+    background_tasks.add_task(chat_sessions.append, request.session_id, request.message, ai_reply)
+    return ChatResponse(response=ai_reply)
+
+@app.post("/chat/stream")
+async def stream_chat_with_medical_assistant(request: ChatRequest):
+    """
+    Streaming variant of /chat (Server-Sent Events).
+    Emits `data: {"delta": "..."}` per chunk, then `event: done` with the full reply
+    (or `event: error`). History is saved once the stream has finished.
+    """
+    if not os.getenv("GEMINI_API_KEY"):
+         raise HTTPException(status_code=503, detail="AI Service Config Missing")
+
+    full_prompt = await _build_chat_prompt(request.session_id, request.message)
+    parts: List[str] = []
+
+    async def events():
+        try:
+            async for text in llm.stream(TEXT_MODEL, full_prompt):
+                parts.append(text)
+                yield f"data: {json.dumps({'delta': text})}\n\n"
+        except Exception as e:
+            print(f"Gemini Chat Stream Failed: {e}")
+            parts.clear()  # Don't persist a half-finished reply
+            yield f"event: error\ndata: {json.dumps({'detail': 'AI Chat Failed'})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({'response': ''.join(parts).strip()})}\n\n"
+
+    async def save():
+        await chat_sessions.append(request.session_id, request.message, "".join(parts).strip())
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # no-transform / X-Accel-Buffering stop intermediaries from buffering the stream
+        headers={"Cache-Control": "no-cache, no-transform", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(save),
+    )
+
 # --- Document Analysis (Gemini) ---
+async def _analyze_content(content: bytes, mime_type: str) -> str:
+    """
+    Runs document analysis and returns the cleaned JSON text. Raises if every model fails.
+    """
+    # User requested 2.0+ models only
+    models_to_try = [
+        "gemini-2.5-flash-preview-09-2025", 
+        "gemini-2.5-flash-image"
+    ]
+    
+    last_error = None
+    result_text = None
+
+    prompt = """
+    Analyze this medical document image. 
+    Extract key clinical data such as:
+    - Patient Name
+    - Test Names and Results (Value + Unit)
+    - Medication Names and Dosages
+    - Date of Report
+    
+    Return the result as a clean, structured JSON object. 
+    Example format:
+    {
+      "patient_name": "...",
+      "date": "...",
+      "tests": [{"name": "Hemoglobin", "value": "13.5", "unit": "g/dL"}],
+      "medications": [...]
+    }
+    Only return the JSON. No markdown formatting.
+    """
+
+    for model_name in models_to_try:
+        # Rate limits (429) are retried with backoff inside the shared client
+        try:
+            print(f"Attempting analysis with model: {model_name}")
+            result_text = await llm.generate(model_name, [
+                {'mime_type': mime_type, 'data': content},
+                prompt
+            ])
+            print(f"Success with {model_name}")
+            # Audit Log (Scrubbed)
+            print(f"Audit Log: {_scrub_phi(result_text)}")
+            break # Break model loop if we have a result
+        except Exception as e:
+            print(f"Failed with {model_name}: {e}")
+            last_error = e
+    
+    if result_text is None:
+        raise last_error or Exception("All 2.0+ models failed. Please check Quota.")
+
+    # Clean up JSON (remove markdowns)
+    text = result_text.replace('```json', '').replace('```', '').strip()
+    if text.startswith("```json"):
+        text = text[7:-3].strip()
+    if text.startswith("```"): 
+        text = text[3:-3].strip()
+    return text
+
 @app.post("/documents/analyze")
 async def analyze_document(file: UploadFile = File(...)):
     try:
         content = await file.read()
-        
-        # User requested 2.0+ models only
-        models_to_try = [
-            "gemini-2.5-flash-preview-09-2025", 
-            "gemini-2.5-flash-image"
-        ]
-        
-        last_error = None
-        result_text = None
-
-        prompt = """
-        Analyze this medical document image. 
-        Extract key clinical data such as:
-        - Patient Name
-        - Test Names and Results (Value + Unit)
-        - Medication Names and Dosages
-        - Date of Report
-        
-        Return the result as a clean, structured JSON object. 
-        Example format:
-        {
-          "patient_name": "...",
-          "date": "...",
-          "tests": [{"name": "Hemoglobin", "value": "13.5", "unit": "g/dL"}],
-          "medications": [...]
-        }
-        Only return the JSON. No markdown formatting.
-        """
-
-        for model_name in models_to_try:
-            # Retry logic for Rate Limits (429)
-            for attempt in range(3):
-                try:
-                    print(f"Attempting analysis with model: {model_name} (Try {attempt+1})")
-                    model = genai.GenerativeModel(model_name)
-                    response = model.generate_content([
-                        {'mime_type': file.content_type, 'data': content},
-                        prompt
-                    ])
-                    result_text = response.text
-                    print(f"Success with {model_name}")
-                    # Audit Log (Scrubbed)
-                    print(f"Audit Log: {_scrub_phi(result_text)}")
-                    break # Break retry loop
-                except Exception as e:
-                    print(f"Failed with {model_name}: {e}")
-                    last_error = e
-                    if "429" in str(e):
-                        time.sleep(4) # Wait 4 seconds before retrying
-                        continue
-                    else:
-                        break # Don't retry for non-429 errors (e.g. 404)
-            
-            if result_text:
-                break # Break model loop if we have a result
-        
-        if result_text is None:
-            raise last_error or Exception("All 2.0+ models failed. Please check Quota.")
-
-        # Clean up JSON (remove markdowns)
-        text = result_text.replace('```json', '').replace('```', '').strip()
-        if text.startswith("```json"):
-            text = text[7:-3].strip()
-        if text.startswith("```"): 
-            text = text[3:-3].strip()
-            
+        text = await _analyze_content(content, file.content_type)
         return {"status": "success", "data": text}
         
     except Exception as e:
@@ -510,3 +682,83 @@ async def analyze_document(file: UploadFile = File(...)):
             "note": f"AI Analysis Failed: {str(e)}",
             "data": None
         }
+
+# --- Document Analysis Jobs (async submit + poll) ---
+document_jobs = DocumentJobQueue(
+    store=JobStore(os.getenv("DOC_JOBS_DB_PATH", "document_jobs.db")),
+    handler=_analyze_content,
+    spool_dir=os.getenv("DOC_JOBS_SPOOL_DIR", "document_spool"),
+    workers=int(os.getenv("DOC_JOBS_WORKERS", "4")),
+    max_queue=int(os.getenv("DOC_JOBS_MAX_QUEUE", "100")),
+    result_ttl=float(os.getenv("DOC_JOBS_RESULT_TTL_SECONDS", "86400")),
+)
+
+@app.on_event("startup")
+async def start_document_jobs():
+    await document_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_document_jobs():
+    await document_jobs.stop()
+
+def _job_view(job: dict) -> dict:
+    view = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == DONE:
+        view["data"] = job["result"]
+    elif job["status"] == ERROR:
+        view["note"] = f"AI Analysis Failed: {job['error']}"
+    return view
+
+@app.post("/documents/jobs", status_code=202)
+async def submit_document_job(file: UploadFile = File(...)):
+    """
+    Queues a document for analysis and returns a job id immediately.
+    Identical uploads are deduplicated by content hash.
+    """
+    try:
+        job, deduplicated = await document_jobs.submit(file.file, file.content_type)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Document queue is full, retry shortly",
+                            headers={"Retry-After": "5"})
+    return {**_job_view(job), "deduplicated": deduplicated}
+
+@app.get("/documents/jobs/stats")
+def document_job_stats():
+    return document_jobs.snapshot()
+
+@app.get("/documents/jobs/{job_id}")
+async def get_document_job(job_id: str, wait: float = 0):
+    """
+    Returns job status (and result once done). wait=N long-polls up to N seconds (max 30).
+    """
+    job = await document_jobs.wait(job_id, min(wait, 30)) if wait > 0 else document_jobs.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _job_view(job)
+
+@app.get("/documents/jobs/{job_id}/events")
+async def stream_document_job(job_id: str):
+    """
+    Server-Sent Events: emits the job status on every change until it finishes.
+    """
+    job = document_jobs.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        last_status = None
+        while True:
+            current = await document_jobs.wait(job_id, 5)
+            if current is None:
+                # Purged while streaming
+                yield f"data: {json.dumps({'job_id': job_id, 'status': 'not_found'})}\n\n"
+                break
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield f"data: {json.dumps(_job_view(current))}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            if current["status"] in FINISHED:
+                break
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,366 @@
+"""
+Document storage shared by the MedX services.
+
+Services talk to a small document API (get / set / create / update / query ...)
+instead of the Firestore client directly. Two backends implement it:
+
+- FirestoreStore: Google Cloud Firestore (production default).
+- LocalStore: one embedded SQLite file in WAL mode, with expression indexes on
+  the fields the services filter on. Lets the whole stack run on a single node
+  (edge clinics, load tests, benchmarks) without network round trips.
+
+Select with STORAGE_BACKEND=firestore|local and LOCAL_DB_PATH.
+This file is kept identical in every service that stores documents.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    from google.cloud import firestore
+    from google.api_core import exceptions as gcp_exceptions
+except ImportError:  # Local-only installs
+    firestore = None
+    gcp_exceptions = None
+
+# Fields the services filter or sort on; LocalStore keeps an index for each
+INDEXED_FIELDS = ("organization_id", "role", "doctor_id", "patient_id", "user_id", "timestamp", "datetime", "updated_at")
+ANALYZE_EVERY_WRITES = 5000
+
+Where = Sequence[Tuple[str, str, Any]]  # (field, op, value); op in ==, !=, <, <=, >, >=, in
+Write = Tuple[str, Optional[str], dict, bool]  # (collection, doc_id or None for a new id, data, merge)
+
+
+class Document(NamedTuple):
+    id: str
+    data: dict
+
+
+class NotFoundError(Exception):
+    pass
+
+
+class AlreadyExistsError(Exception):
+    pass
+
+
+class InvalidCursorError(ValueError):
+    """start_after names a document that does not exist (deleted, or never a cursor)."""
+
+
+def new_id() -> str:
+    """20-character ids, like Firestore's auto ids."""
+    return uuid.uuid4().hex[:20]
+
+
+class FirestoreStore:
+    def __init__(self, client=None):
+        if firestore is None:
+            raise RuntimeError("google-cloud-firestore is not installed")
+        self.client = client or firestore.Client()
+
+    def _ref(self, collection: str, doc_id: str):
+        return self.client.collection(collection).document(doc_id)
+
+    def get(self, collection: str, doc_id: str) -> Optional[dict]:
+        snapshot = self._ref(collection, doc_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def get_many(self, collection: str, doc_ids: Iterable[str]) -> Dict[str, dict]:
+        refs = [self._ref(collection, doc_id) for doc_id in dict.fromkeys(doc_ids)]
+        if not refs:
+            return {}
+        return {s.id: s.to_dict() for s in self.client.get_all(refs) if s.exists}
+
+    def set(self, collection: str, doc_id: str, data: dict, merge: bool = False):
+        self._ref(collection, doc_id).set(data, merge=merge)
+
+    def create(self, collection: str, doc_id: str, data: dict):
+        try:
+            self._ref(collection, doc_id).create(data)
+        except gcp_exceptions.AlreadyExists:
+            raise AlreadyExistsError(f"{collection}/{doc_id}")
+
+    def add(self, collection: str, data: dict) -> str:
+        doc_id = new_id()
+        self.set(collection, doc_id, data)
+        return doc_id
+
+    def update(self, collection: str, doc_id: str, fields: dict):
+        try:
+            self._ref(collection, doc_id).update(fields)
+        except gcp_exceptions.NotFound:
+            raise NotFoundError(f"{collection}/{doc_id}")
+
+    def delete(self, collection: str, doc_id: str):
+        self._ref(collection, doc_id).delete()
+
+    def batch_write(self, writes: Sequence[Write]):
+        # Firestore caps a batch at 500 writes
+        for start in range(0, len(writes), 500):
+            batch = self.client.batch()
+            for collection, doc_id, data, merge in writes[start:start + 500]:
+                batch.set(self._ref(collection, doc_id or new_id()), data, merge=merge)
+            batch.commit()
+
+    def query(self, collection: str, where: Where = (), order_by: Optional[str] = None,
+              descending: bool = False, limit: Optional[int] = None, start_after: Optional[str] = None,
+              select: Optional[Sequence[str]] = None) -> List[Document]:
+        ref = self.client.collection(collection)
+        for field, op, value in where:
+            ref = ref.where(field, op, value)
+        if order_by:
+            direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+            ref = ref.order_by(order_by, direction=direction)
+        if start_after:
+            cursor = self._ref(collection, start_after).get()
+            if not cursor.exists:
+                raise InvalidCursorError(start_after)
+            ref = ref.start_after(cursor)
+        if select:
+            ref = ref.select(list(select))
+        if limit:
+            ref = ref.limit(limit)
+        return [Document(doc.id, doc.to_dict()) for doc in ref.stream()]
+
+    def transact_update(self, collection: str, doc_id: str, fn: Callable[[dict], Optional[dict]]) -> dict:
+        """
+        Atomic read-modify-write. fn(current) returns the fields to update (or None for no write)
+        and may be retried on contention, so it must not have side effects.
+        Returns the document after the update.
+        """
+        ref = self._ref(collection, doc_id)
+
+        @firestore.transactional
+        def run(transaction):
+            snapshot = ref.get(transaction=transaction)
+            if not snapshot.exists:
+                raise NotFoundError(f"{collection}/{doc_id}")
+            data = snapshot.to_dict()
+            updates = fn(data)
+            if updates:
+                transaction.update(ref, updates)
+                data.update(updates)
+            return data
+
+        return run(self.client.transaction())
+
+
+_FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+_OPERATORS = {"==": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+
+
+def _field_expr(field: str) -> str:
+    # The path is inlined (not bound) so the expression matches the index definitions
+    if not _FIELD_PATTERN.match(field):
+        raise ValueError(f"Invalid field name: {field!r}")
+    return f"json_extract(data, '$.{field}')"
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, default=str, separators=(",", ":"))
+
+
+class LocalStore:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # Several services may share one file on a single node
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "collection TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (collection, id))"
+        )
+        for field in INDEXED_FIELDS:
+            self._db.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_documents_{field} ON documents(collection, {_field_expr(field)})"
+            )
+        self._writes = 0
+        self._analyze()
+
+    def _analyze(self):
+        # Planner statistics let multi-field filters pick the most selective index.
+        # analysis_limit samples each index, so this stays cheap on large files.
+        self._db.execute("PRAGMA analysis_limit=1000")
+        self._db.execute("ANALYZE documents")
+        self._writes = 0
+
+    def _read(self, collection: str, doc_id: str) -> Optional[dict]:
+        row = self._db.execute(
+            "SELECT data FROM documents WHERE collection = ? AND id = ?", (collection, doc_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, collection: str, doc_id: str, data: dict):
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+            (collection, doc_id, _dumps(data)),
+        )
+        self._writes += 1
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE also serializes against other processes sharing the file
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            if self._writes >= ANALYZE_EVERY_WRITES:
+                self._analyze()
+
+    def get(self, collection: str, doc_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._read(collection, doc_id)
+
+    def get_many(self, collection: str, doc_ids: Iterable[str]) -> Dict[str, dict]:
+        ids = list(dict.fromkeys(doc_ids))
+        found = {}
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT id, data FROM documents WHERE collection = ? AND id IN ({','.join('?' * len(chunk))})",
+                    (collection, *chunk),
+                ).fetchall()
+                found.update((doc_id, json.loads(data)) for doc_id, data in rows)
+        return found
+
+    def set(self, collection: str, doc_id: str, data: dict, merge: bool = False):
+        with self._transaction():
+            if merge:
+                data = {**(self._read(collection, doc_id) or {}), **data}
+            self._write(collection, doc_id, data)
+
+    def create(self, collection: str, doc_id: str, data: dict):
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT INTO documents (collection, id, data) VALUES (?, ?, ?)",
+                    (collection, doc_id, _dumps(data)),
+                )
+                self._writes += 1
+        except sqlite3.IntegrityError:
+            raise AlreadyExistsError(f"{collection}/{doc_id}")
+
+    def add(self, collection: str, data: dict) -> str:
+        doc_id = new_id()
+        self.create(collection, doc_id, data)
+        return doc_id
+
+    def update(self, collection: str, doc_id: str, fields: dict):
+        with self._transaction():
+            current = self._read(collection, doc_id)
+            if current is None:
+                raise NotFoundError(f"{collection}/{doc_id}")
+            current.update(fields)
+            self._write(collection, doc_id, current)
+
+    def delete(self, collection: str, doc_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM documents WHERE collection = ? AND id = ?", (collection, doc_id))
+
+    def batch_write(self, writes: Sequence[Write]):
+        with self._transaction():
+            for collection, doc_id, data, merge in writes:
+                doc_id = doc_id or new_id()
+                if merge:
+                    data = {**(self._read(collection, doc_id) or {}), **data}
+                self._write(collection, doc_id, data)
+
+    def query(self, collection: str, where: Where = (), order_by: Optional[str] = None,
+              descending: bool = False, limit: Optional[int] = None, start_after: Optional[str] = None,
+              select: Optional[Sequence[str]] = None) -> List[Document]:
+        sql = ["SELECT id, data FROM documents WHERE collection = ?"]
+        params: List[Any] = [collection]
+
+        for field, op, value in where:
+            expr = _field_expr(field)
+            if op == "in":
+                values = list(value)
+                if not values:
+                    return []
+                sql.append(f"AND {expr} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+            elif op == "==" and value is None:
+                sql.append(f"AND {expr} IS NULL")
+            elif op in _OPERATORS:
+                sql.append(f"AND {expr} {_OPERATORS[op]} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported operator: {op}")
+
+        direction = "DESC" if descending else "ASC"
+        after = "<" if descending else ">"
+        with self._lock:
+            cursor = self._read(collection, start_after) if start_after else None
+            if start_after and cursor is None:
+                raise InvalidCursorError(start_after)
+            if order_by:
+                expr = _field_expr(order_by)
+                # Firestore leaves out documents that lack the order_by field
+                sql.append(f"AND {expr} IS NOT NULL")
+                if start_after:
+                    value = cursor
+                    for part in order_by.split("."):
+                        value = value.get(part) if isinstance(value, dict) else None
+                    sql.append(f"AND ({expr} {after} ? OR ({expr} = ? AND id {after} ?))")
+                    params.extend([value, value, start_after])
+                sql.append(f"ORDER BY {expr} {direction}, id {direction}")
+            elif start_after or limit:
+                # Pages need a stable order; plain filters skip the sort so the planner can use a field index
+                if start_after:
+                    sql.append(f"AND id {after} ?")
+                    params.append(start_after)
+                sql.append(f"ORDER BY id {direction}")
+            if limit:
+                sql.append("LIMIT ?")
+                params.append(limit)
+            rows = self._db.execute(" ".join(sql), params).fetchall()
+
+        docs = []
+        for doc_id, data in rows:
+            record = json.loads(data)
+            if select:
+                record = {k: record[k] for k in select if k in record}
+            docs.append(Document(doc_id, record))
+        return docs
+
+    def transact_update(self, collection: str, doc_id: str, fn: Callable[[dict], Optional[dict]]) -> dict:
+        """Atomic read-modify-write; see FirestoreStore.transact_update."""
+        with self._transaction():
+            data = self._read(collection, doc_id)
+            if data is None:
+                raise NotFoundError(f"{collection}/{doc_id}")
+            updates = fn(data)
+            if updates:
+                data.update(updates)
+                self._write(collection, doc_id, data)
+            return data
+
+
+def store_from_env():
+    """Returns the configured store, or None if it cannot be initialized (endpoints then answer 503)."""
+    backend = os.getenv("STORAGE_BACKEND", "firestore").lower()
+    try:
+        if backend == "local":
+            store = LocalStore(os.getenv("LOCAL_DB_PATH", "medx_local.db"))
+        else:
+            store = FirestoreStore()
+        print(f"✅ Storage Initialized ({backend})")
+        return store
+    except Exception as e:
+        print(f"❌ Storage Init Failed ({backend}): {e}")
+        return None
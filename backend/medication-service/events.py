@@ -0,0 +1,245 @@
+"""
+Buffered event writer for medication analytics.
+
+Request handlers call emit(), which only appends to an in-memory buffer, so an
+analytics write never adds to request latency. A background task flushes the
+buffer in batches: once `max_batch` events are waiting or every
+`flush_interval` seconds, whichever comes first.
+
+A batch the sink cannot take (network error, outage) is appended to a local
+JSONL spool file and replayed, oldest first, once the sink recovers. The
+buffer is bounded by `max_buffer`; past that, events are dropped and counted.
+stop() drains the buffer on shutdown, so an orderly restart loses nothing.
+
+Sinks are small blocking classes with a write(rows) method, run in a worker
+thread: BigQuerySink for production, HttpSink to push batches to another
+service (analytics-service rollups), JsonlSink for offline runs and tests.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Optional
+
+import httpx
+
+
+class BigQuerySink:
+    name = "bigquery"
+
+    def __init__(self, client, table_ref, id_field: Optional[str] = "event_id"):
+        self.client = client
+        self.table_ref = table_ref
+        self.id_field = id_field
+        self.rejected = 0
+
+    def write(self, rows: List[dict]):
+        # insertIds let BigQuery de-duplicate a batch that is retried after an ambiguous failure
+        row_ids = [row.get(self.id_field) for row in rows] if self.id_field else None
+        errors = self.client.insert_rows_json(self.table_ref, rows, row_ids=row_ids)
+        if errors:
+            # Per-row errors (bad schema/values) would fail again on replay: count them, don't spool
+            self.rejected += len(errors)
+            print(f"BigQuery rejected {len(errors)} rows: {errors[:3]}")
+
+
+class HttpSink:
+    def __init__(self, url: str, headers: Callable[[], dict] = dict, timeout: float = 10.0, name: str = "http"):
+        self.name = name
+        self.url = url
+        self.headers = headers  # Called per batch (signed principals expire)
+        self.client = httpx.Client(timeout=timeout)
+
+    def write(self, rows: List[dict]):
+        r = self.client.post(self.url, json=rows, headers=self.headers())
+        r.raise_for_status()  # Any failure spools the batch; the receiver de-duplicates by event_id
+
+
+class JsonlSink:
+    name = "jsonl"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, rows: List[dict]):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+class EventWriter:
+    def __init__(self, sink, max_batch: int = 500, flush_interval: float = 2.0,
+                 max_buffer: int = 10000, spool_path: Optional[str] = None, retry_interval: float = 30.0):
+        self.sink = sink
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spool_path = spool_path
+        self.retry_interval = retry_interval
+
+        self._buffer: deque = deque()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._retry_at = 0.0  # monotonic time before which the spool is not replayed
+        self.stats = {"emitted": 0, "written": 0, "batches": 0, "spooled": 0, "replayed": 0,
+                      "dropped": 0, "sink_errors": 0}
+
+    # --- Producer side (request handlers) ---
+    def emit(self, row: dict):
+        """Queues one event. Never blocks and never raises."""
+        if len(self._buffer) >= self.max_buffer:
+            self.stats["dropped"] += 1
+            if self.stats["dropped"] % 1000 == 1:
+                print(f"❌ Event buffer full, dropped {self.stats['dropped']} events so far")
+            return
+        self._buffer.append(row)
+        self.stats["emitted"] += 1
+        if len(self._buffer) >= self.max_batch and self._loop is not None:
+            # Safe from the event loop and from threadpool handlers alike
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # --- Flusher ---
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        print(f"✅ Event writer started ({self.sink.name}, batch {self.max_batch}, every {self.flush_interval}s)")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:  # Keep the flusher alive whatever happens
+                print(f"Event Flush Error: {e}")
+
+    def _take(self) -> List[dict]:
+        batch = []
+        while self._buffer and len(batch) < self.max_batch:
+            batch.append(self._buffer.popleft())
+        return batch
+
+    async def flush(self):
+        """Writes everything buffered so far (spooling what the sink refuses)."""
+        if self._spool_pending() and time.monotonic() >= self._retry_at:
+            await asyncio.to_thread(self._replay_spool)
+
+        while self._buffer:
+            batch = self._take()
+            if self._spool_pending():
+                # Keep order: while older events sit in the spool, new ones queue behind them
+                await asyncio.to_thread(self._spool, batch)
+                continue
+            await asyncio.to_thread(self._write_or_spool, batch)
+
+    async def stop(self):
+        """Stops the flusher and drains the buffer (called on shutdown)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._retry_at = 0.0  # One last replay attempt
+        await self.flush()
+
+    # --- Blocking helpers (worker thread) ---
+    def _write_or_spool(self, batch: List[dict]):
+        try:
+            self.sink.write(batch)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception as e:
+            self.stats["sink_errors"] += 1
+            print(f"Event Sink Error ({self.sink.name}): {e}")
+            self._retry_at = time.monotonic() + self.retry_interval
+            self._spool(batch)
+
+    def _spool_pending(self) -> bool:
+        return bool(self.spool_path) and os.path.exists(self.spool_path)
+
+    def _spool(self, batch: List[dict]):
+        if not self.spool_path:
+            self.stats["dropped"] += len(batch)
+            return
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(row, default=str) + "\n" for row in batch)
+        self.stats["spooled"] += len(batch)
+
+    def _replay_spool(self):
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for start in range(0, len(rows), self.max_batch):
+            batch = rows[start:start + self.max_batch]
+            try:
+                self.sink.write(batch)
+            except Exception as e:
+                self.stats["sink_errors"] += 1
+                print(f"Event Spool Replay Error ({self.sink.name}): {e}")
+                self._retry_at = time.monotonic() + self.retry_interval
+                # Keep only what is still unsent
+                tmp = self.spool_path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.writelines(json.dumps(row, default=str) + "\n" for row in rows[start:])
+                os.replace(tmp, self.spool_path)
+                return
+            self.stats["written"] += len(batch)
+            self.stats["replayed"] += len(batch)
+            self.stats["batches"] += 1
+        os.remove(self.spool_path)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "sink": self.sink.name,
+            "buffered": len(self._buffer),
+            "spool_pending": self._spool_pending(),
+        }
+
+
+def events_from_env(bq_factory: Callable[[], Optional[BigQuerySink]]) -> Optional[EventWriter]:
+    """
+    EVENT_SINK=bigquery (default) | jsonl | none. `bq_factory` builds the BigQuery sink
+    (None when BigQuery is unavailable). Tuning: EVENT_BATCH_SIZE, EVENT_FLUSH_SECONDS,
+    EVENT_BUFFER_SIZE, EVENT_SPOOL_PATH, EVENT_JSONL_PATH.
+    """
+    kind = os.getenv("EVENT_SINK", "bigquery").lower()
+    if kind == "jsonl":
+        sink = JsonlSink(os.getenv("EVENT_JSONL_PATH", "medication_events.jsonl"))
+    elif kind == "bigquery":
+        sink = bq_factory()
+    else:
+        sink = None
+    if sink is None:
+        print(f"❌ Event writer disabled (EVENT_SINK={kind})")
+        return None
+    return EventWriter(
+        sink,
+        max_batch=int(os.getenv("EVENT_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("EVENT_FLUSH_SECONDS", "2")),
+        max_buffer=int(os.getenv("EVENT_BUFFER_SIZE", "10000")),
+        spool_path=os.getenv("EVENT_SPOOL_PATH", "medication_events.spool.jsonl") or None,
+    )
+
+
+def http_events_from_env(headers: Callable[[], dict] = dict) -> Optional[EventWriter]:
+    """Second writer pushing the same events to ANALYTICS_EVENTS_URL (unset: disabled)."""
+    url = os.getenv("ANALYTICS_EVENTS_URL")
+    if not url:
+        return None
+    sink = HttpSink(url, headers, name="analytics")
+    return EventWriter(
+        sink,
+        max_batch=int(os.getenv("EVENT_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("EVENT_FLUSH_SECONDS", "2")),
+        max_buffer=int(os.getenv("EVENT_BUFFER_SIZE", "10000")),
+        spool_path=os.getenv("ANALYTICS_EVENTS_SPOOL_PATH", "medication_events.analytics.spool.jsonl") or None,
+    )
@@ -1,18 +1,29 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
+import json
 import uuid
 import os
 from google.cloud import bigquery
-from google.cloud import firestore
+from google.api_core.exceptions import NotFound
+from storage import store_from_env, NotFoundError, InvalidCursorError
+from identity import (
+    get_principal, service_principal_header, require_principal, acting_user, may_act_for, SERVICE_ROLE, STAFF_ROLES,
+)
+from events import BigQuerySink, events_from_env, http_events_from_env
+from reminders import reminders_from_env, is_timezone, local_date
 
 # --- Configurations ---
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "medx-health-platform")
 DATASET_ID = "medx_analytics"
 TABLE_ID = "medication_events"
 COLLECTION_NAME = "medications"
+OWNER_FIELD = "user_id"  # Indexed in both stores (storage.INDEXED_FIELDS)
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
 
 # --- App Initialization ---
 app = FastAPI(title="MedX Medication Service")
@@ -27,13 +38,8 @@ app.add_middleware(
 )
 
 # --- Database Clients ---
-# Firestore
-try:
-    db = firestore.Client()
-    print("✅ Firestore Client Initialized")
-except Exception as e:
-    print(f"❌ Firestore Init Failed: {e}")
-    db = None
+# Document store: Firestore by default, STORAGE_BACKEND=local for the embedded store (see storage.py)
+db = store_from_env()
 
 # BigQuery
 try:
@@ -43,19 +49,52 @@ except Exception as e:
     print(f"❌ BigQuery Init Failed: {e}")
     bq_client = None
 
+# Built once; reused by every batch insert
+table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID) if bq_client else None
+
+# Medication events are buffered and written in batches off the request path (see events.py)
+event_writer = events_from_env(lambda: BigQuerySink(bq_client, table_ref) if bq_client else None)
+# Same events pushed to analytics-service's adherence rollups (ANALYTICS_EVENTS_URL), own buffer and spool
+rollup_writer = http_events_from_env(lambda: service_principal_header("medication-service"))
+event_writers = [w for w in (event_writer, rollup_writer) if w]
+
+# Reminders: medication times in a minute-bucketed wheel, due ones sent through
+# notification-service's /send-bulk every minute (see reminders.py)
+reminders = reminders_from_env(db, lambda: service_principal_header("medication-service"))
+
+def log_event(med_id: str, user_id: Optional[str], event_type: str, status: str, details: str,
+              local_day: Optional[str] = None):
+    """local_day: the medication's calendar day (its timezone) the event counts for in adherence rollups."""
+    row = {
+        "event_id": str(uuid.uuid4()),
+        "med_id": med_id,
+        "user_id": user_id,
+        "event_type": event_type,
+        "status": status,
+        "timestamp": datetime.utcnow().isoformat(),
+        "details": details,
+        "local_day": local_day,
+    }
+    for writer in event_writers:
+        writer.emit(row)
+
 @app.on_event("startup")
 async def startup_event():
     # Ensure BigQuery Table Exists
     if bq_client:
         try:
-            dataset_ref = bq_client.dataset(DATASET_ID)
-            table_ref = dataset_ref.table(TABLE_ID)
             try:
-                bq_client.get_table(table_ref)
-            except Exception:
+                table = bq_client.get_table(table_ref)
+                if "user_id" not in {f.name for f in table.schema}:
+                    # Events carry their owner since the adherence rollups
+                    table.schema = [*table.schema, bigquery.SchemaField("user_id", "STRING", mode="NULLABLE")]
+                    bq_client.update_table(table, ["schema"])
+                    print(f"Added user_id to BigQuery table: {TABLE_ID}")
+            except NotFound:
                 schema = [
                     bigquery.SchemaField("event_id", "STRING", mode="REQUIRED"),
                     bigquery.SchemaField("med_id", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("user_id", "STRING", mode="NULLABLE"),
                     bigquery.SchemaField("event_type", "STRING", mode="REQUIRED"),
                     bigquery.SchemaField("status", "STRING", mode="NULLABLE"),
                     bigquery.SchemaField("timestamp", "TIMESTAMP", mode="REQUIRED"),
@@ -66,114 +105,321 @@ async def startup_event():
                 print(f"Created BigQuery table: {TABLE_ID}")
         except Exception as e:
             print(f"BigQuery Setup Failed: {e}")
+    for writer in event_writers:
+        await writer.start()
+    if reminders:
+        await reminders.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if reminders:
+        await reminders.stop()
+    for writer in event_writers:
+        await writer.stop()
 
 # --- Models ---
 class Medication(BaseModel):
     id: Optional[str] = None
+    user_id: Optional[str] = None
     name: str
     dosage: str
     time: str
+    timezone: Optional[str] = None
     isTaken: bool = False
+    taken_on: Optional[str] = None # Local day (YYYY-MM-DD) isTaken was set on
 
 class MedicationCreate(BaseModel):
     name: str
     dosage: str
     time: str
+    timezone: Optional[str] = None # IANA name, e.g. "Asia/Kolkata"; default REMINDER_TIMEZONE
+    user_id: Optional[str] = None # Owner; defaults to the caller. Staff and internal callers may set it.
+
+class ToggleRequest(BaseModel):
+    isTaken: Optional[bool] = None # Target state; omitted = flip
+
+class BulkStatusRequest(BaseModel):
+    isTaken: bool = True
+    med_ids: List[str] = []
+    time: Optional[str] = None # Instead of med_ids: every medication of the owner at this time
+    user_id: Optional[str] = None # Owner for `time`; defaults to the caller
+
+class BulkStatusResult(BaseModel):
+    updated: List[str] = []
+    unchanged: List[str] = []
+    not_found: List[str] = []
+
+MEDICATION_FIELDS = ("user_id", "name", "dosage", "time", "timezone", "isTaken", "taken_on")
+
+def now_iso() -> str:
+    return datetime.utcnow().isoformat()
+
+# --- Helpers ---
+def resolve_owner(principal: Optional[dict], user_id: Optional[str]) -> Optional[str]:
+    """
+    Whose medications a request may touch. Patients only ever get their own; staff may name a
+    user of their organization. Internal callers (service role) may leave the owner unset.
+    Requests that did not come through the gateway with a token are rejected.
+    """
+    principal = require_principal(principal)
+    if principal.get("role") == SERVICE_ROLE:
+        return user_id
+    return acting_user(principal, user_id, db)
+
+def taken_today(data: dict) -> bool:
+    """isTaken counts for the local day it was set on only (documents from before taken_on keep isTaken)."""
+    if not data.get("isTaken", False):
+        return False
+    return data.get("taken_on") in (None, local_date(data.get("timezone")))
+
+def status_updates(data: dict, is_taken: bool) -> dict:
+    """Fields written when a medication is marked taken or not; updated_at feeds the reminder sync."""
+    return {
+        "isTaken": is_taken,
+        "taken_on": local_date(data.get("timezone")) if is_taken else None,
+        "updated_at": now_iso(),
+    }
+
+class OwnerLookupNeeded(Exception):
+    """
+    Callers may only touch medications they may act for: their own, their organization's for
+    staff, any for the service role; others are reported as missing. A staff caller's check reads
+    the owner's organization, which cannot happen inside a transaction: this aborts it instead.
+    """
+    def __init__(self, owner: Optional[str]):
+        super().__init__(owner)
+        self.owner = owner
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    selected = [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id"]
+    unknown = [f for f in selected if f not in MEDICATION_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
+
+def medication_page(owner: Optional[str], page_size: int, start_after: Optional[str],
+                    select: Optional[List[str]]) -> List[dict]:
+    where = [(OWNER_FIELD, "==", owner)] if owner else []
+    # No order_by: pages follow document id, which needs no composite index in Firestore
+    # isTaken is reported per day, which needs the day it was set on
+    extra = [f for f in ("taken_on", "timezone") if select and "isTaken" in select and f not in select]
+    docs = db.query(COLLECTION_NAME, where=where, limit=page_size, start_after=start_after,
+                    select=select + extra if select else None)
+    page = []
+    for doc in docs:
+        item = {**doc.data, "id": doc.id}
+        if item.get("isTaken") and not taken_today(item):
+            item["isTaken"] = False
+        for field in extra:
+            item.pop(field, None)
+        page.append(item)
+    return page
+
+def ndjson_export(owner: Optional[str], page_size: int, first: List[dict], select: Optional[List[str]]):
+    """Streams every matching medication, one JSON object per line, a page at a time (from the first page)."""
+    page = first
+    while True:
+        if page:
+            yield "".join(json.dumps(item, default=str) + "\n" for item in page)
+        if len(page) < page_size:
+            return
+        page = medication_page(owner, page_size, page[-1]["id"], select)
 
 # --- Endpoints ---
 
 @app.get("/")
 async def root():
-    return {"status": "Medication Service Running (Firestore)"}
+    return {"status": f"Medication Service Running ({os.getenv('STORAGE_BACKEND', 'firestore')})"}
+
+@app.get("/events/stats")
+def event_stats():
+    return {writer.sink.name: writer.snapshot() for writer in event_writers}
+
+@app.get("/reminders/stats")
+def reminder_stats():
+    if not reminders:
+        raise HTTPException(status_code=404, detail="Reminders are disabled")
+    return reminders.snapshot()
 
 @app.get("/medications", response_model=List[Medication])
-async def get_medications():
-    """Fetch all medications from Firestore."""
+def get_medications(
+    user_id: Optional[str] = None,
+    page_size: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    principal: Optional[dict] = Depends(get_principal),
+):
+    """
+    One page of the caller's medications, ordered by id. When more remain, the X-Next-Cursor
+    response header holds the `start_after` value for the next page.
+    `fields` (comma-separated) limits the returned fields; `id` is always included.
+    `format=ndjson` streams every remaining medication as newline-delimited JSON (exports).
+    """
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
-    
+
+    owner = resolve_owner(principal, user_id)
+    select = parse_fields(fields)
+
     try:
-        meds_ref = db.collection(COLLECTION_NAME)
-        docs = meds_ref.stream()
-        
-        results = []
-        for doc in docs:
-            data = doc.to_dict()
-            data['id'] = doc.id
-            results.append(Medication(**data))
-        return results
+        # Read before responding so a bad cursor is a 400, also for streamed exports
+        page = medication_page(owner, page_size, start_after, select)
+    except InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Unknown start_after cursor")
     except Exception as e:
         print(f"Firestore Read Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    if format == "ndjson":
+        return StreamingResponse(ndjson_export(owner, page_size, page, select), media_type="application/x-ndjson")
+
+    # Stored documents are returned as-is: no per-item model validation on the read path
+    headers = {"X-Next-Cursor": page[-1]["id"]} if len(page) == page_size else {}
+    return JSONResponse(page, headers=headers)
+
 @app.post("/medications", response_model=Medication)
-async def add_medication(med: MedicationCreate):
-    """Add a new medication to Firestore."""
+async def add_medication(med: MedicationCreate, principal: Optional[dict] = Depends(get_principal)):
+    """Add a new medication."""
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
+    owner = resolve_owner(principal, med.user_id)
+    if med.timezone and not is_timezone(med.timezone):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {med.timezone}")
     try:
-        doc_ref = db.collection(COLLECTION_NAME).document()
         new_med_data = {
+            "user_id": owner,
             "name": med.name,
             "dosage": med.dosage,
             "time": med.time,
-            "isTaken": False
+            "timezone": med.timezone,
+            "isTaken": False,
+            "taken_on": None,
+            "updated_at": now_iso(),
         }
-        doc_ref.set(new_med_data)
+        med_id = db.add(COLLECTION_NAME, new_med_data)
+        if reminders:
+            reminders.upsert(med_id, new_med_data)
         
-        # Log to BigQuery
-        if bq_client:
-            row = {
-                "event_id": str(uuid.uuid4()),
-                "med_id": doc_ref.id,
-                "event_type": "MEDICATION_ADDED",
-                "status": "SCHEDULED",
-                "timestamp": datetime.utcnow().isoformat(),
-                "details": f"Added {med.name}"
-            }
-            bq_client.insert_rows_json(bq_client.dataset(DATASET_ID).table(TABLE_ID), [row])
+        # Analytics event (buffered, written in the background)
+        log_event(med_id, owner, "MEDICATION_ADDED", "SCHEDULED", f"Added {med.name}", local_date(med.timezone))
         
-        return Medication(id=doc_ref.id, **new_med_data)
+        return Medication(id=med_id, **new_med_data)
     except Exception as e:
         print(f"Firestore Write Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.patch("/medications/{med_id}/toggle", response_model=Medication)
-async def toggle_medication(med_id: str):
-    """Toggle isTaken status in Firestore."""
+def toggle_medication(
+    med_id: str,
+    body: Optional[ToggleRequest] = None,
+    idempotency_key: Optional[str] = Header(None),
+    principal: Optional[dict] = Depends(get_principal),
+):
+    """
+    Flips isTaken, or sets it to body.isTaken when given, in one atomic read-modify-write.
+    isTaken is per day: a medication taken on an earlier (local) day counts as not taken.
+    A retry carrying the same Idempotency-Key as the last applied toggle changes nothing.
+    """
     if not db:
         raise HTTPException(status_code=503, detail="Database unavailable")
 
+    principal = require_principal(principal)
+    target = body.isTaken if body else None
+    changed = False
+    staff_access: Dict[str, bool] = {}  # Owner -> may a staff caller act for them
+
+    def apply(current: dict) -> Optional[dict]:
+        nonlocal changed
+        changed = False
+        owner = current.get(OWNER_FIELD)
+        if principal.get("role") != SERVICE_ROLE and owner != principal["sub"]:
+            if principal.get("role") not in STAFF_ROLES:
+                raise HTTPException(status_code=404, detail="Medication not found")
+            if owner not in staff_access:
+                raise OwnerLookupNeeded(owner)  # No store reads inside the transaction
+            if not staff_access[owner]:
+                raise HTTPException(status_code=404, detail="Medication not found")
+        if idempotency_key and current.get("last_toggle_key") == idempotency_key:
+            return None  # Already applied
+        taken = taken_today(current)
+        new_status = (not taken) if target is None else target
+        if new_status == taken:
+            return None  # Explicit state already set
+        changed = True
+        updates = status_updates(current, new_status)
+        if idempotency_key:
+            updates["last_toggle_key"] = idempotency_key
+        return updates
+
     try:
-        doc_ref = db.collection(COLLECTION_NAME).document(med_id)
-        doc = doc_ref.get()
-        
-        if not doc.exists:
-            raise HTTPException(status_code=404, detail="Medication not found")
-            
-        current_data = doc.to_dict()
-        new_status = not current_data.get("isTaken", False)
-        
-        doc_ref.update({"isTaken": new_status})
-        
-        # Log to BigQuery
-        if bq_client:
-            row = {
-                "event_id": str(uuid.uuid4()),
-                "med_id": med_id,
-                "event_type": "MEDICATION_TOGGLED", 
-                "status": "TAKEN" if new_status else "SKIPPED",
-                "timestamp": datetime.utcnow().isoformat(),
-                "details": str(new_status)
-            }
-            bq_client.insert_rows_json(bq_client.dataset(DATASET_ID).table(TABLE_ID), [row])
-            print(f"✅ Logged to BigQuery: {row}")
-            
-        current_data['isTaken'] = new_status
-        current_data['id'] = med_id
-        return Medication(**current_data)
-        
+        # One read-modify-write; staff acting for another user add one organization lookup and a retry
+        while True:
+            try:
+                data = db.transact_update(COLLECTION_NAME, med_id, apply)
+                break
+            except OwnerLookupNeeded as e:
+                staff_access[e.owner] = may_act_for(principal, e.owner, db)
+    except NotFoundError:
+        raise HTTPException(status_code=404, detail="Medication not found")
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Firestore Update Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+
+    if changed:
+        if reminders:
+            reminders.upsert(med_id, data)
+        # Analytics event (buffered, written in the background)
+        log_event(med_id, data.get(OWNER_FIELD), "MEDICATION_TOGGLED", "TAKEN" if data["isTaken"] else "SKIPPED", str(data["isTaken"]),
+                  data.get("taken_on") or local_date(data.get("timezone")))
+    return Medication(**{**data, "id": med_id})
+
+@app.patch("/medications/status", response_model=BulkStatusResult)
+def set_medications_status(req: BulkStatusRequest, principal: Optional[dict] = Depends(get_principal)):
+    """
+    Sets isTaken on many medications at once: the listed ids, or every medication of the owner
+    scheduled at `time` (a whole dose). One batched read and one batched write.
+    Setting an explicit state is idempotent, so retries are safe.
+    """
+    if not db:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    if not req.med_ids and req.time is None:
+        raise HTTPException(status_code=400, detail="Provide med_ids or time")
+    require_principal(principal)
+
+    try:
+        if req.med_ids:
+            found = db.get_many(COLLECTION_NAME, req.med_ids)
+        else:
+            owner = resolve_owner(principal, req.user_id)
+            if owner is None:
+                raise HTTPException(status_code=400, detail="user_id is required")
+            docs = db.query(COLLECTION_NAME, where=[(OWNER_FIELD, "==", owner)])
+            found = {doc.id: doc.data for doc in docs if doc.data.get("time") == req.time}
+
+        # Medications the caller may not touch are reported as missing, like single toggles
+        found = {med_id: data for med_id, data in found.items() if may_act_for(principal, data.get(OWNER_FIELD), db)}
+        result = BulkStatusResult(not_found=[i for i in req.med_ids if i not in found])
+        for med_id, data in found.items():
+            (result.unchanged if taken_today(data) == req.isTaken else result.updated).append(med_id)
+
+        updates = {med_id: status_updates(found[med_id], req.isTaken) for med_id in result.updated}
+        if updates:
+            db.batch_write([(COLLECTION_NAME, med_id, fields, True) for med_id, fields in updates.items()])
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Firestore Update Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    for med_id in result.updated:
+        if reminders:
+            reminders.upsert(med_id, {**found[med_id], **updates[med_id]})
+        log_event(med_id, found[med_id].get(OWNER_FIELD), "MEDICATION_TOGGLED", "TAKEN" if req.isTaken else "SKIPPED", str(req.isTaken),
+                  updates[med_id]["taken_on"] or local_date(found[med_id].get("timezone")))
+    return result
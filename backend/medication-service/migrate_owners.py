@@ -0,0 +1,49 @@
+"""
+Assigns an owner to medications created before they had one.
+
+Medications added before the user_id field existed are invisible to every
+logged-in user (listings filter on user_id). This pages through the
+collection and sets user_id on every document that lacks it.
+
+Usage:
+    python migrate_owners.py --owner patient@example.com            # dry run
+    python migrate_owners.py --owner patient@example.com --apply
+
+Uses the same store settings as the service (STORAGE_BACKEND, LOCAL_DB_PATH).
+"""
+import argparse
+import datetime
+
+from storage import store_from_env
+
+COLLECTION_NAME = "medications"
+OWNER_FIELD = "user_id"
+PAGE_SIZE = 500
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--owner", required=True, help="user_id (email) to own the unowned medications")
+parser.add_argument("--apply", action="store_true", help="write the changes (default: only report)")
+args = parser.parse_args()
+
+db = store_from_env()
+if db is None:
+    raise SystemExit(1)
+
+scanned, unowned, start_after = 0, [], None
+while True:
+    # Firestore cannot filter on a missing field, so every document is read once
+    page = db.query(COLLECTION_NAME, limit=PAGE_SIZE, start_after=start_after, select=[OWNER_FIELD])
+    scanned += len(page)
+    unowned += [doc.id for doc in page if not doc.data.get(OWNER_FIELD)]
+    if len(page) < PAGE_SIZE:
+        break
+    start_after = page[-1].id
+
+print(f"Scanned {scanned} medications, {len(unowned)} without an owner")
+if args.apply and unowned:
+    # updated_at lets running reminder dispatchers pick up the new owners (see reminders.py)
+    stamp = datetime.datetime.utcnow().isoformat()
+    db.batch_write([(COLLECTION_NAME, med_id, {OWNER_FIELD: args.owner, "updated_at": stamp}, True) for med_id in unowned])
+    print(f"✅ Assigned {len(unowned)} medications to {args.owner}")
+elif unowned:
+    print("Dry run: re-run with --apply to assign them")
@@ -0,0 +1,382 @@
+"""
+Medication reminder dispatcher.
+
+Medication times are free-form strings ("8:00 AM", "08:00", "20:30", "9 PM")
+in the medication's own timezone (`timezone`, an IANA name; default
+REMINDER_TIMEZONE, else UTC). They are parsed once into a minute of the day
+and the medication is placed in that minute's bucket of a one-day timing wheel
+(1440 buckets per timezone). Adds and toggles move single entries; a tick only
+reads, for every timezone in use, the bucket of that zone's current minute.
+
+Every minute the dispatcher takes the due buckets, skips medications already
+taken that local day (`taken_on`, set by toggles), folds each user's
+medications into one reminder ("Time to take Aspirin (100mg), Metformin
+(500mg)") and posts them to notification-service's POST /send-bulk in
+batches, `post_concurrency` at a time. A tick that ran late catches up on the
+minutes it missed (at most `catchup_minutes`).
+
+With several instances, each (UTC) minute is claimed with a create() on a
+reminder_ticks document, so only one instance sends it; the claiming instance
+deletes claims older than a day once an hour. The wheel is loaded with one
+full scan at startup and then kept in sync incrementally: every
+`sync_interval` seconds, only medications whose `updated_at` moved since the
+last sync are read (with an overlap for clock skew between instances).
+"""
+import asyncio
+import datetime
+import functools
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from storage import AlreadyExistsError, InvalidCursorError
+
+COLLECTION_NAME = "medications"
+TICK_COLLECTION = "reminder_ticks"
+MINUTES_PER_DAY = 24 * 60
+LOAD_PAGE_SIZE = 1000
+REMINDER_FIELDS = ["user_id", "name", "dosage", "time", "timezone", "taken_on", "updated_at"]
+DEFAULT_TIMEZONE = os.getenv("REMINDER_TIMEZONE", "UTC")
+SYNC_OVERLAP = datetime.timedelta(minutes=2)  # Tolerated clock skew between instances' updated_at stamps
+TICK_RETENTION = datetime.timedelta(days=1)
+
+_TIME_PATTERN = re.compile(r"^\s*(\d{1,2})(?:[:.](\d{2}))?\s*(?:([ap])\.?\s*m?\.?)?\s*$", re.IGNORECASE)
+
+Reminder = Tuple[str, str, str, Optional[str]]  # (user_id, name, dosage, taken_on)
+
+
+def parse_time(value: Optional[str]) -> Optional[int]:
+    """'8:00 AM' -> 480, '20:30' -> 1230, '12 AM' -> 0. None if the string is not a time."""
+    match = _TIME_PATTERN.match(value or "")
+    if not match:
+        return None
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2) or 0), (match.group(3) or "").lower()
+    if minute > 59:
+        return None
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == "p" else 0)
+    elif hour > 23:
+        return None
+    return hour * 60 + minute
+
+
+@functools.lru_cache(maxsize=None)
+def _zone(name: str):
+    from zoneinfo import ZoneInfo
+    return ZoneInfo(name)
+
+
+def is_timezone(name: str) -> bool:
+    try:
+        _zone(name)
+        return True
+    except Exception:
+        return False
+
+
+def zone_name(data: dict) -> str:
+    """The medication's timezone, or the default when unset or unknown."""
+    name = data.get("timezone")
+    return name if name and is_timezone(name) else DEFAULT_TIMEZONE
+
+
+def local_date(name: Optional[str], at: Optional[datetime.datetime] = None) -> str:
+    """Calendar day in timezone `name` at UTC instant `at` (default: now), as YYYY-MM-DD."""
+    at = at or datetime.datetime.utcnow()
+    zone = _zone(name if name and is_timezone(name) else DEFAULT_TIMEZONE)
+    return at.replace(tzinfo=datetime.timezone.utc).astimezone(zone).date().isoformat()
+
+
+class ReminderWheel:
+    """Medications by timezone and local minute of the day; O(1) to add, move or remove one."""
+
+    def __init__(self):
+        self._buckets: Dict[str, List[Dict[str, Reminder]]] = {}
+        self._slot_of: Dict[str, Tuple[str, int]] = {}
+        self.unscheduled = set()  # Medications whose time could not be parsed (or without an owner)
+
+    def upsert(self, med_id: str, data: dict):
+        self.remove(med_id)
+        minute = parse_time(data.get("time"))
+        if minute is None or not data.get("user_id"):
+            self.unscheduled.add(med_id)
+            return
+        zone = zone_name(data)
+        buckets = self._buckets.get(zone)
+        if buckets is None:
+            buckets = self._buckets[zone] = [{} for _ in range(MINUTES_PER_DAY)]
+        buckets[minute][med_id] = (data["user_id"], data.get("name", ""), data.get("dosage", ""), data.get("taken_on"))
+        self._slot_of[med_id] = (zone, minute)
+
+    def remove(self, med_id: str):
+        self.unscheduled.discard(med_id)
+        slot = self._slot_of.pop(med_id, None)
+        if slot is not None:
+            del self._buckets[slot[0]][slot[1]][med_id]
+
+    def zones(self) -> List[str]:
+        return list(self._buckets)
+
+    def due(self, zone: str, minute: int) -> Dict[str, Reminder]:
+        buckets = self._buckets.get(zone)
+        return dict(buckets[minute]) if buckets else {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+
+def _notifications(due: Dict[str, Tuple[Reminder, str, str]]) -> List[dict]:
+    """One notification per user for everything not yet taken that local day: {med_id: (reminder, day, HH:MM)}."""
+    by_user: Dict[str, List[Tuple[str, str, str, str]]] = {}
+    for med_id, ((user_id, name, dosage, taken_on), day, label) in due.items():
+        if taken_on != day:
+            by_user.setdefault(user_id, []).append((med_id, name, dosage, label))
+    return [
+        {
+            "user_id": user_id,
+            "title": "Medication reminder",
+            "body": "Time to take " + ", ".join(f"{name} ({dosage})" if dosage else name for _, name, dosage, _ in meds),
+            "data": {"type": "medication_reminder", "time": meds[0][3], "med_ids": ",".join(m[0] for m in meds)},
+        }
+        for user_id, meds in by_user.items()
+    ]
+
+
+class ReminderScheduler:
+    def __init__(self, db, notify_url: str, headers: Callable[[], dict] = dict, batch_size: int = 1000,
+                 sync_interval: float = 60.0, catchup_minutes: int = 5, timeout: float = 30.0,
+                 post_concurrency: int = 4):
+        self.db = db
+        self.notify_url = notify_url
+        self.headers = headers  # Called per request (signed principals expire)
+        self.batch_size = batch_size
+        self.post_concurrency = post_concurrency
+        self.sync_interval = sync_interval
+        self.catchup_minutes = catchup_minutes
+        self.timeout = timeout
+
+        self._wheel = ReminderWheel()
+        self._lock = threading.Lock()
+        self._watermark: Optional[datetime.datetime] = None  # UTC; changes after it are not applied yet
+        self._synced_at = 0.0
+        self._last_tick: Optional[datetime.datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = {"ticks": 0, "skipped_ticks": 0, "due": 0, "notifications": 0, "sent": 0, "no_token": 0,
+                      "requests": 0, "request_errors": 0, "loaded": 0, "synced": 0, "pruned_ticks": 0}
+
+    @staticmethod
+    def now() -> datetime.datetime:
+        """Current UTC minute (naive)."""
+        return datetime.datetime.utcnow().replace(second=0, microsecond=0)
+
+    # --- Index maintenance (request handlers, any thread) ---
+    def upsert(self, med_id: str, data: dict):
+        with self._lock:
+            self._wheel.upsert(med_id, data)
+
+    def remove(self, med_id: str):
+        with self._lock:
+            self._wheel.remove(med_id)
+
+    def load(self):
+        """Startup: loads every medication into a fresh wheel, a page at a time (blocking; run in a thread)."""
+        started = datetime.datetime.utcnow()
+        wheel, start_after, count = ReminderWheel(), None, 0
+        while True:
+            page = self.db.query(COLLECTION_NAME, limit=LOAD_PAGE_SIZE, start_after=start_after, select=REMINDER_FIELDS)
+            for doc in page:
+                wheel.upsert(doc.id, doc.data)
+            count += len(page)
+            if len(page) < LOAD_PAGE_SIZE:
+                break
+            start_after = page[-1].id
+        with self._lock:
+            self._wheel = wheel
+        # Writes made during the scan (here or elsewhere) are picked up by the next sync
+        self._watermark = started
+        self._synced_at = time.monotonic()
+        self.stats["loaded"] += count
+
+    def sync(self):
+        """Applies medications changed since the last sync on any instance (blocking; run in a thread)."""
+        started = datetime.datetime.utcnow()
+        where = [("updated_at", ">", (self._watermark - SYNC_OVERLAP).isoformat())]
+        start_after = None
+        while True:
+            # Pages continue after the last (updated_at, id), so documents sharing a stamp are not skipped
+            try:
+                page = self.db.query(COLLECTION_NAME, where=where, order_by="updated_at", limit=LOAD_PAGE_SIZE,
+                                     start_after=start_after, select=REMINDER_FIELDS)
+            except InvalidCursorError:
+                # Cursor document deleted meanwhile: restart at its stamp (re-applied rows are harmless)
+                where, start_after = [("updated_at", ">=", last["updated_at"])], None
+                continue
+            with self._lock:
+                for doc in page:
+                    self._wheel.upsert(doc.id, doc.data)
+            self.stats["synced"] += len(page)
+            if len(page) < LOAD_PAGE_SIZE:
+                break
+            start_after, last = page[-1].id, page[-1].data
+        self._watermark = started
+        self._synced_at = time.monotonic()
+
+    # --- Dispatch ---
+    def _claim(self, minute: datetime.datetime) -> bool:
+        """True for exactly one instance per minute."""
+        try:
+            self.db.create(TICK_COLLECTION, f"{minute:%Y%m%dT%H%M}",
+                           {"minute": minute.isoformat(), "claimed_at": datetime.datetime.utcnow().isoformat()})
+            return True
+        except AlreadyExistsError:
+            return False
+
+    def _prune_ticks(self, minute: datetime.datetime):
+        cutoff = (minute - TICK_RETENTION).isoformat()
+        old = self.db.query(TICK_COLLECTION, where=[("minute", "<", cutoff)], limit=LOAD_PAGE_SIZE)
+        for doc in old:
+            self.db.delete(TICK_COLLECTION, doc.id)
+        self.stats["pruned_ticks"] += len(old)
+
+    def _due(self, minute: datetime.datetime) -> Dict[str, Tuple[Reminder, str, str]]:
+        """Everything due at UTC `minute`, with the local day and time of its timezone."""
+        at = minute.replace(tzinfo=datetime.timezone.utc)
+        due = {}
+        with self._lock:
+            for zone in self._wheel.zones():
+                local = at.astimezone(_zone(zone))
+                day, label = local.date().isoformat(), f"{local:%H:%M}"
+                for med_id, reminder in self._wheel.due(zone, local.hour * 60 + local.minute).items():
+                    due[med_id] = (reminder, day, label)
+        return due
+
+    async def _post(self, notifications: List[dict]):
+        semaphore = asyncio.Semaphore(self.post_concurrency)
+        await asyncio.gather(*(
+            self._post_batch(notifications[start:start + self.batch_size], semaphore)
+            for start in range(0, len(notifications), self.batch_size)
+        ))
+
+    async def _post_batch(self, batch: List[dict], semaphore: asyncio.Semaphore):
+        async with semaphore:
+            self.stats["requests"] += 1
+            try:
+                r = await self._client.post(self.notify_url, json={"messages": batch}, headers=self.headers())
+                r.raise_for_status()
+                report = r.json()
+                self.stats["sent"] += report.get("sent", 0)
+                self.stats["no_token"] += report.get("no_token", 0)
+            except Exception as e:
+                # notification-service retries FCM itself; a failed hand-off is reported, not re-sent
+                self.stats["request_errors"] += 1
+                print(f"Reminder Dispatch Error: {e}")
+
+    async def dispatch(self, minute: datetime.datetime) -> int:
+        """Sends the reminders due at UTC `minute`; returns how many notifications went out."""
+        if not await asyncio.to_thread(self._claim, minute):
+            self.stats["skipped_ticks"] += 1
+            return 0
+        if minute.minute == 0:
+            try:
+                await asyncio.to_thread(self._prune_ticks, minute)
+            except Exception as e:
+                print(f"Reminder Tick Prune Error: {e}")
+        due = self._due(minute)
+        notifications = _notifications(due)
+        self.stats["ticks"] += 1
+        self.stats["due"] += len(due)
+        self.stats["notifications"] += len(notifications)
+        if notifications:
+            await self._post(notifications)
+        return len(notifications)
+
+    async def tick(self):
+        """Dispatches every minute since the last tick (catching up at most `catchup_minutes`)."""
+        now = self.now()
+        if self._last_tick is None:
+            self._last_tick = now - datetime.timedelta(minutes=1)
+        first = max(self._last_tick + datetime.timedelta(minutes=1),
+                    now - datetime.timedelta(minutes=self.catchup_minutes - 1))
+        minute = first
+        while minute <= now:
+            await self.dispatch(minute)
+            self._last_tick = minute
+            minute += datetime.timedelta(minutes=1)
+
+    # --- Loop ---
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=self.timeout)
+        self._task = asyncio.create_task(self._run())
+        print(f"✅ Reminder dispatcher started (-> {self.notify_url})")
+
+    async def _run(self):
+        while self._watermark is None:
+            try:
+                await asyncio.to_thread(self.load)
+                print(f"✅ Reminder wheel loaded: {len(self._wheel)} medications")
+            except Exception as e:
+                print(f"❌ Reminder wheel load failed, retrying: {e}")
+                await asyncio.sleep(self.sync_interval)
+        while True:
+            # Wake just after each minute boundary
+            await asyncio.sleep(60 - time.time() % 60 + 0.05)
+            try:
+                if time.monotonic() - self._synced_at >= self.sync_interval:
+                    await asyncio.to_thread(self.sync)
+                await self.tick()
+            except Exception as e:  # Keep the dispatcher alive whatever happens
+                print(f"Reminder Tick Error: {e}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            scheduled, unscheduled, zones = len(self._wheel), len(self._wheel.unscheduled), len(self._wheel.zones())
+        return {
+            **self.stats,
+            "scheduled": scheduled,
+            "unscheduled": unscheduled,
+            "timezones": zones,
+            "synced_through": self._watermark.isoformat() if self._watermark else None,
+            "last_tick": self._last_tick.isoformat() if self._last_tick else None,
+        }
+
+
+def reminders_from_env(db, headers: Callable[[], dict] = dict) -> Optional[ReminderScheduler]:
+    """
+    Enabled when NOTIFICATION_SERVICE_URL is set. Tuning: REMINDER_BATCH_SIZE, REMINDER_POST_CONCURRENCY,
+    REMINDER_SYNC_SECONDS, REMINDER_CATCHUP_MINUTES, REMINDER_TIMEZONE (default zone, e.g. Asia/Kolkata).
+    """
+    base_url = os.getenv("NOTIFICATION_SERVICE_URL")
+    if not base_url or db is None:
+        print("❌ Reminder dispatcher disabled (NOTIFICATION_SERVICE_URL not set)")
+        return None
+    if not is_timezone(DEFAULT_TIMEZONE):
+        print(f"❌ Reminder dispatcher disabled (unknown REMINDER_TIMEZONE={DEFAULT_TIMEZONE})")
+        return None
+    return ReminderScheduler(
+        db,
+        base_url.rstrip("/") + "/send-bulk",
+        headers,
+        batch_size=int(os.getenv("REMINDER_BATCH_SIZE", "1000")),
+        sync_interval=float(os.getenv("REMINDER_SYNC_SECONDS", "60")),
+        catchup_minutes=int(os.getenv("REMINDER_CATCHUP_MINUTES", "5")),
+        post_concurrency=int(os.getenv("REMINDER_POST_CONCURRENCY", "4")),
+    )
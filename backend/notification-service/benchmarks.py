@@ -0,0 +1,41 @@
+"""
+Delivery engine benchmarks for notification-service (mock transport, no network).
+
+Usage:
+    python benchmarks.py burst                  # 100k reminders, 50ms per FCM call
+    python benchmarks.py burst --messages 20000 --latency-ms 120 --failure-rate 0.02
+"""
+import argparse
+import asyncio
+
+from delivery import DeliveryEngine, MockTransport, Outgoing
+
+
+def bench_burst(messages: int, latency_ms: float, failure_rate: float, invalid_rate: float):
+    """The 8 AM reminder burst: one message per patient, a handful of distinct medication texts."""
+    outgoing = [
+        Outgoing(token=f"token-{i}", title="Medication reminder", body=f"Time to take medication #{i % 50}",
+                 user_id=f"user-{i}")
+        for i in range(messages)
+    ]
+    print(f"{messages} messages, {latency_ms}ms per call, {failure_rate:.1%} transient, {invalid_rate:.1%} invalid")
+    print(f"{'concurrency':>11} {'seconds':>8} {'msg/s':>9} {'batches':>8} {'sent':>8} {'failed':>7}")
+    for concurrency in (1, 4, 16, 64):
+        transport = MockTransport(latency_ms / 1000, failure_rate, invalid_rate, seed=1)
+        engine = DeliveryEngine(transport, concurrency=concurrency, backoff=0.05)
+        report = asyncio.run(engine.deliver(outgoing))
+        print(f"{concurrency:>11} {report.seconds:>8.2f} {messages / report.seconds:>9.0f} "
+              f"{report.batches:>8} {report.sent:>8} {report.failed:>7}")
+
+
+BENCHMARKS = {"burst": bench_burst}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--invalid-rate", type=float, default=0.005)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.messages, args.latency_ms, args.failure_rate, args.invalid_rate)
@@ -0,0 +1,240 @@
+"""
+Bulk push delivery.
+
+deliver() takes any number of outgoing messages (one device token each),
+groups those with the same title/body/data, cuts the groups into batches of
+up to 500 (the FCM per-call limit) and sends the batches concurrently, at
+most `concurrency` in flight.
+
+Per-token outcomes are classified:
+- sent
+- transient (unavailable, internal, quota, deadline): retried with
+  exponential backoff and jitter, up to `max_retries` times, as a smaller
+  batch of just the failed tokens
+- invalid (unregistered / bad token): reported to `on_invalid_tokens` so the
+  token can be pruned, never retried
+- failed: anything else
+
+Transports:
+- FcmTransport: firebase_admin messaging.send_each for a batch (a shared-
+  payload batch becomes send_each_for_multicast), on a bounded thread pool
+  because the Admin SDK is blocking.
+- MockTransport: no network; configurable latency and failure/invalid
+  rates, for load tests and local runs.
+"""
+import asyncio
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+FCM_BATCH_LIMIT = 500
+
+SENT, TRANSIENT, INVALID, FAILED = "sent", "transient", "invalid", "failed"
+
+
+@dataclass
+class Outgoing:
+    token: str
+    title: str
+    body: str
+    data: Optional[Dict[str, str]] = None
+    user_id: Optional[str] = None
+
+    def payload_key(self) -> Tuple:
+        return self.title, self.body, tuple(sorted((self.data or {}).items()))
+
+
+@dataclass
+class DeliveryReport:
+    requested: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    batches: int = 0
+    invalid_tokens: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requested": self.requested,
+            "sent": self.sent,
+            "failed": self.failed,
+            "invalid": len(self.invalid_tokens),
+            "retried": self.retried,
+            "batches": self.batches,
+            "seconds": round(self.seconds, 3),
+        }
+
+
+# --- Transports: send(batch) -> one outcome per message, in order ---
+
+class FcmTransport:
+    name = "fcm"
+
+    def __init__(self, workers: int = 16):
+        from firebase_admin import exceptions, messaging  # Only needed when FCM is configured
+        self.messaging = messaging
+        self.transient = (
+            exceptions.UnavailableError, exceptions.InternalError, exceptions.DeadlineExceededError,
+            exceptions.ResourceExhaustedError, messaging.QuotaExceededError,
+        )
+        self.invalid = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+        self.invalid_argument = exceptions.InvalidArgumentError
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fcm")
+
+    def _classify(self, error: Optional[Exception]) -> str:
+        if error is None:
+            return SENT
+        if isinstance(error, self.invalid):
+            return INVALID
+        if isinstance(error, self.invalid_argument) and "registration" in str(error).lower():
+            return INVALID
+        if isinstance(error, self.transient):
+            return TRANSIENT
+        return FAILED
+
+    def _send_sync(self, batch: List[Outgoing]) -> List[str]:
+        m = self.messaging
+        first = batch[0]
+        notification = m.Notification(title=first.title, body=first.body)
+        try:
+            if all(o.payload_key() == first.payload_key() for o in batch):
+                response = m.send_each_for_multicast(
+                    m.MulticastMessage(tokens=[o.token for o in batch], notification=notification, data=first.data)
+                )
+            else:
+                response = m.send_each([
+                    m.Message(token=o.token, notification=m.Notification(title=o.title, body=o.body), data=o.data)
+                    for o in batch
+                ])
+        except Exception as e:  # Whole call failed (auth, network): same outcome for every message
+            outcome = self._classify(e)
+            print(f"FCM Batch Error: {e}")
+            return [outcome] * len(batch)
+        return [self._classify(r.exception) for r in response.responses]
+
+    async def send(self, batch: List[Outgoing]) -> List[str]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._send_sync, batch)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class MockTransport:
+    name = "mock"
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, invalid_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.invalid_rate = invalid_rate
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    async def send(self, batch: List[Outgoing]) -> List[str]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        outcomes = []
+        for _ in batch:
+            roll = self._random.random()
+            if roll < self.invalid_rate:
+                outcomes.append(INVALID)
+            elif roll < self.invalid_rate + self.failure_rate:
+                outcomes.append(TRANSIENT)
+            else:
+                outcomes.append(SENT)
+        return outcomes
+
+    def shutdown(self):
+        pass
+
+
+# --- Engine ---
+
+class DeliveryEngine:
+    def __init__(self, transport, batch_size: int = FCM_BATCH_LIMIT, concurrency: int = 16,
+                 max_retries: int = 3, backoff: float = 0.5,
+                 on_invalid_tokens: Optional[Callable[[List[Outgoing]], Awaitable[None]]] = None):
+        self.transport = transport
+        self.batch_size = min(batch_size, FCM_BATCH_LIMIT)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_invalid_tokens = on_invalid_tokens
+        self._semaphore: Optional[asyncio.Semaphore] = None  # Created on the serving loop (Python 3.9)
+        self.stats = {"requested": 0, "sent": 0, "failed": 0, "invalid": 0, "retried": 0, "batches": 0}
+
+    def _batches(self, messages: List[Outgoing]) -> List[List[Outgoing]]:
+        groups: Dict[Tuple, List[Outgoing]] = {}
+        for m in messages:
+            groups.setdefault(m.payload_key(), []).append(m)
+        batches, mixed = [], []
+        for group in groups.values():
+            full = len(group) - len(group) % self.batch_size
+            batches += [group[i:i + self.batch_size] for i in range(0, full, self.batch_size)]
+            mixed += group[full:]  # Remainders of different payloads share send_each batches
+        batches += [mixed[i:i + self.batch_size] for i in range(0, len(mixed), self.batch_size)]
+        return batches
+
+    async def _send_batch(self, batch: List[Outgoing], report: DeliveryReport, invalid: List[Outgoing]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        attempt = 0
+        while batch:
+            async with self._semaphore:
+                outcomes = await self.transport.send(batch)
+            report.batches += 1
+            retry = []
+            for message, outcome in zip(batch, outcomes):
+                if outcome == SENT:
+                    report.sent += 1
+                elif outcome == INVALID:
+                    invalid.append(message)
+                elif outcome == TRANSIENT and attempt < self.max_retries:
+                    retry.append(message)
+                else:
+                    report.failed += 1
+            if retry:
+                attempt += 1
+                report.retried += len(retry)
+                # Full jitter keeps retries from many batches from landing together
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            batch = retry
+
+    async def deliver(self, messages: List[Outgoing]) -> DeliveryReport:
+        started = time.perf_counter()
+        report = DeliveryReport(requested=len(messages))
+        invalid: List[Outgoing] = []
+        await asyncio.gather(*(self._send_batch(b, report, invalid) for b in self._batches(messages)))
+
+        report.invalid_tokens = [m.token for m in invalid]
+        if invalid and self.on_invalid_tokens:
+            try:
+                await self.on_invalid_tokens(invalid)
+            except Exception as e:
+                print(f"Token Prune Error: {e}")
+        report.seconds = time.perf_counter() - started
+
+        for key, value in report.as_dict().items():
+            if key in self.stats:
+                self.stats[key] += value
+        return report
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "transport": self.transport.name, "concurrency": self.concurrency}
+
+
+def transport_from_env(firebase_enabled: bool):
+    """NOTIFICATION_TRANSPORT=fcm|mock (default: fcm when Firebase is configured)."""
+    kind = os.getenv("NOTIFICATION_TRANSPORT", "fcm" if firebase_enabled else "mock").lower()
+    if kind == "fcm" and firebase_enabled:
+        return FcmTransport(workers=int(os.getenv("FCM_WORKERS", "16")))
+    return MockTransport(
+        latency=float(os.getenv("MOCK_LATENCY_MS", "0")) / 1000,
+        failure_rate=float(os.getenv("MOCK_FAILURE_RATE", "0")),
+        invalid_rate=float(os.getenv("MOCK_INVALID_RATE", "0")),
+    )
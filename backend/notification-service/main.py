@@ -1,10 +1,15 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials
 import os
+import asyncio
+from delivery import DeliveryEngine, Outgoing, transport_from_env
+from storage import store_from_env
+from identity import get_principal, acting_user, may_act_for, require_principal, STAFF_ROLES, SERVICE_ROLE
+from tokens import TokenRegistry
 
 # --- App Initialization ---
 app = FastAPI(title="MedX Notification Service")
@@ -29,14 +34,103 @@ else:
     print("Warning: serviceAccountKey.json not found. Notifications will be mocked.")
     FIREBASE_ENABLED = False
 
+# --- Device Tokens ---
+# Document store: Firestore by default, STORAGE_BACKEND=local for the embedded store (see storage.py)
+db = store_from_env()
+# user_id -> FCM tokens, cached in process (see tokens.py)
+registry = TokenRegistry(
+    db,
+    ttl=float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300")),
+    max_users=int(os.getenv("TOKEN_CACHE_MAX_USERS", "100000")),
+    lookup_concurrency=int(os.getenv("TOKEN_LOOKUP_CONCURRENCY", "8")),
+) if db else None
+
+# --- Delivery Engine ---
+# Batched, concurrent sends with retries (see delivery.py). Without Firebase this is the mock transport.
+async def prune_tokens(messages: List[Outgoing]):
+    """Unregisters the tokens FCM reported as no longer valid."""
+    print(f"Invalid FCM tokens: {len(messages)}")
+    if registry:
+        await asyncio.to_thread(registry.prune, {m.token: m.user_id for m in messages})
+
+delivery = DeliveryEngine(
+    transport_from_env(FIREBASE_ENABLED),
+    concurrency=int(os.getenv("DELIVERY_CONCURRENCY", "16")),
+    max_retries=int(os.getenv("DELIVERY_MAX_RETRIES", "3")),
+    on_invalid_tokens=prune_tokens,
+)
+
 # --- Models ---
 class NotificationRequest(BaseModel):
-    user_id: str # Ideally would map to FCM token in DB
-    fcm_token: Optional[str] = None # Direct token for testing
+    user_id: str # Sent to every registered device of the user
+    fcm_token: Optional[str] = None # Direct token (skips the registry)
+    title: str
+    body: str
+    data: Optional[dict] = None
+
+class BulkNotification(BaseModel):
+    user_id: Optional[str] = None # Resolved to registered devices when no token is given
+    fcm_token: Optional[str] = None
+    tokens: List[str] = []
     title: str
     body: str
     data: Optional[dict] = None
 
+class BulkNotificationRequest(BaseModel):
+    messages: List[BulkNotification]
+
+class DeviceRegistration(BaseModel):
+    token: str
+    platform: Optional[str] = None # android | ios | web
+    user_id: Optional[str] = None # Owner; defaults to the caller. Staff and internal callers may set it.
+
+def fcm_data(data: Optional[dict]) -> Optional[dict]:
+    # FCM data payloads are string-to-string
+    return {str(k): str(v) for k, v in data.items()} if data else None
+
+def resolve_owner(principal: Optional[dict], user_id: Optional[str]) -> str:
+    """
+    Whose devices a request manages: the caller's, or `user_id` for the service role and for
+    staff of the user's organization. Requests without a principal are rejected.
+    """
+    if principal is not None and principal.get("role") == SERVICE_ROLE and not user_id:
+        raise HTTPException(status_code=400, detail="user_id is required")
+    return acting_user(principal, user_id, db)
+
+def require_sender(principal: Optional[dict]):
+    """Pushes are sent by other services (reminders) and staff, never by patients or anonymously."""
+    if principal is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    if principal.get("role") not in STAFF_ROLES + (SERVICE_ROLE,):
+        raise HTTPException(status_code=403, detail="Not allowed to send notifications")
+
+async def check_recipients(principal: dict, user_ids: List[Optional[str]], raw_tokens: bool):
+    """
+    Staff may only notify users of their own organization, and only through registered devices:
+    raw tokens are for internal callers. 403 if any recipient is out of reach.
+    """
+    if principal.get("role") == SERVICE_ROLE:
+        return
+    if raw_tokens:
+        raise HTTPException(status_code=403, detail="Raw device tokens are for internal callers only")
+    recipients = list(dict.fromkeys(u for u in user_ids if u))
+
+    def allowed() -> bool:
+        return all(may_act_for(principal, user_id, db) for user_id in recipients)
+
+    if not await asyncio.to_thread(allowed):
+        raise HTTPException(status_code=403, detail="Not allowed to notify this user")
+
+async def resolve_tokens(user_ids: List[str]) -> dict:
+    """user_id -> registered tokens; served from the registry cache, misses fetched in one pass."""
+    if not registry or not user_ids:
+        return {}
+    try:
+        return await asyncio.to_thread(registry.tokens_for, user_ids)
+    except Exception as e:
+        print(f"Token Lookup Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # --- Routes ---
 
 @app.get("/")
@@ -47,37 +141,113 @@ async def root():
     }
 
 @app.post("/send")
-async def send_notification(notification: NotificationRequest):
+async def send_notification(notification: NotificationRequest, principal: Optional[dict] = Depends(get_principal)):
     """
-    Sends a push notification to a user via FCM.
+    Sends a push notification to a user via FCM (service callers, or staff to their organization).
     """
+    require_sender(principal)
+    await check_recipients(principal, [notification.user_id], bool(notification.fcm_token))
     print(f"Received Notification Request: {notification}")
 
     if not FIREBASE_ENABLED:
         # Mock success
         return {"status": "success", "message": "Notification mocked (FCM not configured)", "id": "mock-id-123"}
     
-    # 1. Get Token (Simulated logic: in production, fetch from DB using user_id)
-    target_token = notification.fcm_token
-    if not target_token:
-        # Mock lookup
-        # target_token = db.get_token(notification.user_id)
-        raise HTTPException(status_code=400, detail="FCM Token required (User ID lookup not implemented yet)")
-
-    # 2. Construct Message
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=notification.title,
-            body=notification.body,
-        ),
-        data=notification.data,
-        token=target_token,
-    )
+    # 1. Get Tokens: the given one, else every registered device of the user
+    if notification.fcm_token:
+        targets = [notification.fcm_token]
+    else:
+        if not registry:
+            raise HTTPException(status_code=503, detail="Token registry unavailable")
+        targets = (await resolve_tokens([notification.user_id])).get(notification.user_id, [])
+        if not targets:
+            raise HTTPException(status_code=404, detail="No registered devices for user")
+
+    # 2. Send through the delivery engine (off the event loop, retried if FCM is briefly unavailable)
+    data = fcm_data(notification.data)
+    report = await delivery.deliver([
+        Outgoing(token=t, title=notification.title, body=notification.body, data=data, user_id=notification.user_id)
+        for t in targets
+    ])
+    if report.sent:
+        return {"status": "success", "message": "Notification sent", "devices": report.sent}
+    if len(report.invalid_tokens) == len(targets):
+        raise HTTPException(status_code=410, detail="FCM token is no longer valid")
+    raise HTTPException(status_code=502, detail="FCM delivery failed")
+
+@app.post("/send-bulk")
+async def send_bulk(req: BulkNotificationRequest, principal: Optional[dict] = Depends(get_principal)):
+    """
+    Sends many notifications in one call: batched by 500, sent concurrently, transient
+    failures retried. Messages without tokens go to every registered device of their user_id.
+    Returns a delivery report; invalid tokens are listed and unregistered.
+    Service callers, or staff to users of their organization (registered devices only).
+    """
+    require_sender(principal)
+    await check_recipients(principal, [n.user_id for n in req.messages],
+                           any(n.tokens or n.fcm_token for n in req.messages))
+    # One registry pass for every user that needs a lookup
+    resolved = await resolve_tokens([n.user_id for n in req.messages if n.user_id and not (n.tokens or n.fcm_token)])
+    outgoing, missing = [], 0
+    for n in req.messages:
+        tokens = list(dict.fromkeys([*n.tokens, *([n.fcm_token] if n.fcm_token else [])]))
+        if not tokens and n.user_id:
+            tokens = resolved.get(n.user_id, [])
+        if not tokens:
+            missing += 1
+            continue
+        data = fcm_data(n.data)
+        outgoing += [Outgoing(token=t, title=n.title, body=n.body, data=data, user_id=n.user_id) for t in tokens]
 
+    report = await delivery.deliver(outgoing)
+    return {**report.as_dict(), "no_token": missing, "invalid_tokens": report.invalid_tokens}
+
+@app.post("/devices")
+def register_device(device: DeviceRegistration, principal: Optional[dict] = Depends(get_principal)):
+    """Registers (or refreshes) a device token for the caller. A user may have many devices."""
+    if not registry:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    owner = resolve_owner(principal, device.user_id)
     try:
-        # 3. Send
-        response = messaging.send(message)
-        return {"status": "success", "message": "Notification sent", "id": response}
+        registry.register(owner, device.token, device.platform)
     except Exception as e:
-        print(f"FCM Error: {e}")
+        print(f"Token Register Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "registered", "user_id": owner}
+
+@app.get("/devices")
+def list_devices(user_id: Optional[str] = None, principal: Optional[dict] = Depends(get_principal)):
+    if not registry:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return registry.devices(resolve_owner(principal, user_id))
+
+@app.delete("/devices/{token}")
+def unregister_device(token: str, principal: Optional[dict] = Depends(get_principal)):
+    """Removes a device token (logout, app uninstall)."""
+    if not registry:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    principal = require_principal(principal)
+    try:
+        owner = registry.owner(token)
+        # Devices the caller may not manage are reported as missing
+        if owner is None or not may_act_for(principal, owner, db):
+            raise HTTPException(status_code=404, detail="Device not found")
+        registry.unregister(token, owner)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Token Unregister Error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "unregistered"}
+
+@app.get("/devices/stats")
+def device_stats():
+    return registry.snapshot() if registry else {}
+
+@app.get("/delivery/stats")
+async def delivery_stats():
+    return delivery.snapshot()
+
+@app.on_event("shutdown")
+def shutdown_delivery():
+    delivery.transport.shutdown()
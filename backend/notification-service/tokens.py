@@ -0,0 +1,141 @@
+"""
+Device token registry: user_id -> FCM registration tokens.
+
+Each registered device is one document in `device_tokens`, keyed by a hash of
+the token (FCM tokens are long and a device belongs to one user at a time, so
+re-registering a token under another user moves it). A user may have any
+number of devices.
+
+Sends resolve users through an in-process LRU cache (`max_users` entries,
+`ttl` seconds), so notifying a known user costs no store round trip. Misses
+are fetched together: one "in" query per 30 users, run `lookup_concurrency` at
+a time (a daily reminder burst misses the cache for most users), and users
+without devices are cached too. Registrations, unregistrations and pruned tokens update the
+cache of this instance immediately; other instances see them within `ttl`.
+"""
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+COLLECTION_NAME = "device_tokens"
+IN_QUERY_LIMIT = 30  # Firestore caps "in" filters at 30 values
+
+
+def token_id(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:40]
+
+
+class TokenRegistry:
+    def __init__(self, db, ttl: float = 300.0, max_users: int = 100000, lookup_concurrency: int = 8):
+        self.db = db
+        self.ttl = ttl
+        self.max_users = max_users
+        self._lookups = ThreadPoolExecutor(max_workers=lookup_concurrency, thread_name_prefix="token-lookup")
+        self._cache: "OrderedDict[str, Tuple[Tuple[str, ...], float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "queries": 0, "registered": 0, "unregistered": 0, "pruned": 0}
+
+    # --- Cache ---
+    def _cached(self, user_id: str, now: float) -> Optional[Tuple[str, ...]]:
+        entry = self._cache.get(user_id)
+        if entry is None or entry[1] <= now:
+            return None
+        self._cache.move_to_end(user_id)
+        return entry[0]
+
+    def _put(self, user_id: str, tokens: Iterable[str], expires: float):
+        self._cache[user_id] = (tuple(dict.fromkeys(tokens)), expires)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+
+    def _edit(self, user_id: Optional[str], add: Optional[str] = None, drop: Iterable[str] = ()):
+        """Applies a write to a cached entry (uncached users are simply loaded on next use)."""
+        entry = self._cache.get(user_id) if user_id else None
+        if entry is not None:
+            dropped = set(drop)
+            tokens = [t for t in entry[0] if t not in dropped] + ([add] if add else [])
+            self._cache[user_id] = (tuple(dict.fromkeys(tokens)), entry[1])
+
+    # --- Lookup ---
+    def tokens_for(self, user_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Tokens of every given user; users without devices map to []."""
+        now = time.monotonic()
+        result: Dict[str, List[str]] = {}
+        missing: List[str] = []
+        with self._lock:
+            for user_id in dict.fromkeys(user_ids):
+                tokens = self._cached(user_id, now)
+                if tokens is None:
+                    missing.append(user_id)
+                else:
+                    result[user_id] = list(tokens)
+            self.stats["hits"] += len(result)
+            self.stats["misses"] += len(missing)
+        if not missing:
+            return result
+
+        def fetch(chunk: List[str]):
+            return self.db.query(COLLECTION_NAME, where=[("user_id", "in", chunk)], select=["user_id", "token"])
+
+        chunks = [missing[start:start + IN_QUERY_LIMIT] for start in range(0, len(missing), IN_QUERY_LIMIT)]
+        pages = [fetch(chunks[0])] if len(chunks) == 1 else list(self._lookups.map(fetch, chunks))
+        self.stats["queries"] += len(chunks)
+        found: Dict[str, List[str]] = {user_id: [] for user_id in missing}
+        for docs in pages:
+            for doc in docs:
+                found[doc.data["user_id"]].append(doc.data["token"])
+
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for user_id, tokens in found.items():
+                self._put(user_id, tokens, expires)
+        result.update(found)
+        return result
+
+    def devices(self, user_id: str) -> List[dict]:
+        docs = self.db.query(COLLECTION_NAME, where=[("user_id", "==", user_id)])
+        return [{k: v for k, v in doc.data.items() if k != "user_id"} for doc in docs]
+
+    # --- Writes ---
+    def register(self, user_id: str, token: str, platform: Optional[str] = None):
+        doc_id = token_id(token)
+        previous = self.db.get(COLLECTION_NAME, doc_id)
+        self.db.set(COLLECTION_NAME, doc_id, {
+            "user_id": user_id,
+            "token": token,
+            "platform": platform,
+            "updated_at": datetime.datetime.utcnow().isoformat(),
+        })
+        with self._lock:
+            if previous and previous.get("user_id") != user_id:
+                self._edit(previous.get("user_id"), drop=[token])  # Device changed hands
+            self._edit(user_id, add=token)
+        self.stats["registered"] += 1
+
+    def owner(self, token: str) -> Optional[str]:
+        data = self.db.get(COLLECTION_NAME, token_id(token))
+        return data.get("user_id") if data else None
+
+    def unregister(self, token: str, user_id: Optional[str] = None):
+        """Removes a device. `user_id` is the owner if already known (saves a read)."""
+        user_id = user_id or self.owner(token)
+        self.db.delete(COLLECTION_NAME, token_id(token))
+        with self._lock:
+            self._edit(user_id, drop=[token])
+        self.stats["unregistered"] += 1
+
+    def prune(self, tokens: Dict[str, Optional[str]]):
+        """Deletes tokens FCM reported as invalid ({token: user_id or None})."""
+        for token, user_id in tokens.items():
+            self.db.delete(COLLECTION_NAME, token_id(token))
+            with self._lock:
+                self._edit(user_id, drop=[token])
+        self.stats["pruned"] += len(tokens)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "cached_users": len(self._cache), "ttl": self.ttl}
@@ -8,3 +8,48 @@ resource "google_firestore_database" "database" {
 
   depends_on = [google_project_service.apis]
 }
+
+# appointment-service slot engine: booked intervals of up to 30 doctors over a date range
+# (doctor_id IN [...] AND datetime >= from AND datetime < to)
+resource "google_firestore_index" "appointments_doctor_datetime" {
+  database   = google_firestore_database.database.name
+  collection = "appointments"
+
+  fields {
+    field_path = "doctor_id"
+    order      = "ASCENDING"
+  }
+
+  fields {
+    field_path = "datetime"
+    order      = "ASCENDING"
+  }
+}
+
+# appointment-service list_appointments: equality filters + datetime range, ordered by datetime.
+# (doctor_id alone reuses appointments_doctor_datetime above.)
+locals {
+  appointment_list_indexes = {
+    patient_datetime               = ["patient_id", "datetime"]
+    status_datetime                = ["status", "datetime"]
+    doctor_status_datetime         = ["doctor_id", "status", "datetime"]
+    patient_status_datetime        = ["patient_id", "status", "datetime"]
+    doctor_patient_datetime        = ["doctor_id", "patient_id", "datetime"]
+    doctor_patient_status_datetime = ["doctor_id", "patient_id", "status", "datetime"]
+  }
+}
+
+resource "google_firestore_index" "appointments_list" {
+  for_each = local.appointment_list_indexes
+
+  database   = google_firestore_database.database.name
+  collection = "appointments"
+
+  dynamic "fields" {
+    for_each = each.value
+    content {
+      field_path = fields.value
+      order      = "ASCENDING"
+    }
+  }
+}